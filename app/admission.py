@@ -0,0 +1,215 @@
+import asyncio
+import math
+import os
+import time
+
+from collections import deque
+from typing import Optional
+from starlette.routing import Match
+from . import env  # noqa: F401  loads .env
+from .metrics import admission_in_flight, admission_queue_depth, admission_rejected, admission_wait
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# route class -> (requests running at once, requests allowed to queue, seconds a request may wait in the queue).
+# each one can be overridden with ADMISSION_<CLASS>_LIMIT / _QUEUE / _WAIT_SECONDS.
+# cheap reads get plenty of room, anything that holds a pooled connection (or a bcrypt worker) for long
+# gets a few slots, so together they can't pile up behind the pool's DB_POOL_SIZE + DB_MAX_OVERFLOW
+DEFAULT_CLASS_LIMITS = {
+    "read": (32, 64, 0.5),
+    "list": (4, 16, 2.0),
+    "write": (8, 32, 1.0),
+    "hash": (4, 16, 2.0),
+    "bulk": (1, 2, 5.0),
+    "default": (16, 32, 1.0),
+}
+
+# route template -> class. routes not listed are in "default", EXEMPT_ROUTES are never limited
+ROUTE_CLASSES = {
+    "/get_user/{user_id}": "read",
+    "/search_users/{user_id}": "read",
+    "/get_pin/{user_id}/{pin_id}": "read",
+    "/get_pin_feed/{user_id}": "read",
+    "/get_pins_in_bbox/{user_id}": "read",
+    "/get_pins_near/{user_id}": "read",
+    "/get_pin_clusters/{user_id}": "read",
+    "/sync_pins/{user_id}": "read",
+    "/get_pin_media/{user_id}/{pin_id}": "read",
+    "/get_media_urls/{user_id}": "read",
+    "/get_all_users": "list",
+    "/get_all_pins/{user_id}": "list",
+    "/export_pins/{user_id}": "list",
+    "/create_pin/{user_id}": "write",
+    "/delete_pin/{user_id}/{pin_id}": "write",
+    "/update_user/{user_id}": "write",
+    "/delete_user/{user_id}": "write",
+    "/create_partnership/{user_id_1}/{user_id_2}": "write",
+    "/delete_partnership/{partnership_id}": "write",
+    "/create_pin_media/{user_id}/{pin_id}": "write",
+    "/complete_pin_media/{user_id}/{media_id}": "write",
+    "/create_user": "hash",
+    "/login": "hash",
+    "/logout": "write",
+    "/bulk_create_pins/{user_id}": "bulk",
+}
+# health checks and scrapes have to answer even when everything else is shedding
+EXEMPT_ROUTES = {"/", "/metrics", "/check-db", "/check-replicas", "/purge-status", "/auth-stats", "/slow-queries", "/cache-stats", "/docs", "/openapi.json"}
+
+
+def _class_limits(name: str) -> tuple[int, int, float]:
+    limit, queue, wait = DEFAULT_CLASS_LIMITS[name]
+    prefix = f"ADMISSION_{name.upper()}"
+    return (int(os.getenv(f"{prefix}_LIMIT", str(limit))),
+            int(os.getenv(f"{prefix}_QUEUE", str(queue))),
+            float(os.getenv(f"{prefix}_WAIT_SECONDS", str(wait))))
+
+
+class RouteClass:
+    """
+    A concurrency limit with a bounded FIFO queue in front of it. a request that finds
+    the queue full, or doesn't get a slot before its deadline, is turned away right
+    away instead of waiting on the connection pool until it times out
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def retry_after(self) -> int:
+        # by then the queue we just saw has had time to drain
+        return max(1, math.ceil(self.max_wait))
+
+    async def acquire(self) -> Optional[str]:
+        """
+        Wait for a slot
+
+        Returns:
+            None once admitted, otherwise why the request was shed ("queue_full" or "timeout")
+        """
+        if self.active < self.limit and not self._waiters:
+            self._admit(0.0)
+            return None
+        if len(self._waiters) >= self.max_queue:
+            return self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        admission_queue_depth.set(self.name, value=len(self._waiters))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # the client went away. if release() already handed us the slot, hand it on
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._drop(waiter)
+            raise
+
+        if waiter.done() and not waiter.cancelled():
+            # release() moved its slot over to us, self.active already counts it
+            self.admitted += 1
+            admission_wait.observe(self.name, value=time.perf_counter() - start)
+            return None
+        self._drop(waiter)
+        return self._reject("timeout")
+
+    def release(self):
+        # hand the slot straight to the oldest waiter still around, so nobody can cut in line
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            admission_queue_depth.set(self.name, value=len(self._waiters))
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        admission_in_flight.set(self.name, value=self.active)
+
+    def _admit(self, waited: float):
+        self.active += 1
+        self.admitted += 1
+        admission_in_flight.set(self.name, value=self.active)
+        admission_wait.observe(self.name, value=waited)
+
+    def _drop(self, waiter: asyncio.Future):
+        waiter.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        admission_queue_depth.set(self.name, value=len(self._waiters))
+
+    def _reject(self, reason: str) -> str:
+        self.rejected += 1
+        admission_rejected.inc(self.name, reason)
+        return reason
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "max_queue": self.max_queue, "max_wait_seconds": self.max_wait,
+                "active": self.active, "queued": len(self._waiters), "admitted": self.admitted,
+                "rejected": self.rejected}
+
+
+route_classes = {name: RouteClass(name, *_class_limits(name)) for name in DEFAULT_CLASS_LIMITS}
+
+
+class AdmissionMiddleware:
+    """
+    Plain ASGI middleware that puts every request through its route class's RouteClass.
+    it matches the route itself (the router hasn't run yet), and leaves the match in
+    scope["route"] so MetricsMiddleware can label shed requests by route too
+    """
+
+    def __init__(self, app, router, enabled: bool = ADMISSION_ENABLED):
+        self.app = app
+        self.router = router
+        self.enabled = enabled
+
+    def _route_path(self, scope) -> Optional[str]:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                scope["route"] = route
+                return route.path
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        route_path = self._route_path(scope)
+        if route_path is None or route_path in EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = route_classes[ROUTE_CLASSES.get(route_path, "default")]
+        reason = await route_class.acquire()
+        if reason is not None:
+            await _send_overloaded(send, route_class)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.release()
+
+
+async def _send_overloaded(send, route_class: RouteClass):
+    body = b'{"detail":"server is busy, retry later"}'
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(route_class.retry_after).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
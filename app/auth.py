@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from fastapi import HTTPException, Request
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import env  # noqa: F401  loads .env
+from .database import SessionLocal, db_now
+from .models import UserSessionModel
+from .sync import SYNC_OVERLAP_SECONDS
+
+# key access tokens are signed with. every worker has to use the same one, without it
+# each worker makes up its own and tokens only work on the worker that issued them
+AUTH_SECRET = os.getenv("AUTH_SECRET", "")
+# how long an access token is good for, clients log in again after that
+AUTH_TOKEN_TTL_SECONDS = int(os.getenv("AUTH_TOKEN_TTL_SECONDS", "900"))
+# reject requests to authenticated routes that don't send a token. off while clients move over,
+# until then a token is checked when there is one
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "false").lower() in ("1", "true", "yes")
+# how often each worker picks up sessions revoked by the others (logout, delete_user)
+AUTH_REVOCATION_REFRESH_SECONDS = float(os.getenv("AUTH_REVOCATION_REFRESH_SECONDS", "5"))
+# tokens whose signature was already checked, so a client's next requests skip it
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+
+TOKEN_VERSION = "v1"
+
+if not AUTH_SECRET:
+    logging.warning("AUTH_SECRET is not set, tokens are signed with a random key and only work on this worker until it restarts")
+    AUTH_SECRET = secrets.token_urlsafe(32)
+
+
+class TokenClaims(NamedTuple):
+    user_id: int
+    session_id: str
+    expires: int
+
+
+class InvalidToken(Exception):
+    """
+    The token is malformed, badly signed, expired or revoked
+    """
+
+
+def _signature(payload: str, secret: str) -> str:
+    digest = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def issue_token(user_id: int, session_id: str, expires: int, secret: Optional[str] = None) -> str:
+    """
+    Sign an access token. it is "v1.<user_id>.<session_id>.<expires>.<signature>", readable
+    by anyone, but only this app can make one that passes decode_token
+
+    Args:
+        user_id: who the token is for
+        session_id: user_sessions row it belongs to, what logout revokes
+        expires: unix time the token stops working
+        secret: signing key, AUTH_SECRET by default
+
+    Returns:
+        str: the token
+    """
+    payload = f"{TOKEN_VERSION}.{user_id}.{session_id}.{expires}"
+    return f"{payload}.{_signature(payload, secret or AUTH_SECRET)}"
+
+
+def decode_token(token: str, secret: Optional[str] = None, now: Optional[float] = None) -> TokenClaims:
+    """
+    Check a token's signature and expiry, nothing else (see SessionStore.validate)
+
+    Raises:
+        InvalidToken: if it isn't one of ours or it has expired
+    """
+    payload, _, signature = token.rpartition(".")
+    parts = payload.split(".")
+    if len(parts) != 4 or parts[0] != TOKEN_VERSION:
+        raise InvalidToken("malformed token")
+    # compared as bytes, compare_digest refuses str with non-ascii characters (headers are latin-1)
+    if not hmac.compare_digest(signature.encode(), _signature(payload, secret or AUTH_SECRET).encode()):
+        raise InvalidToken("bad signature")
+    try:
+        claims = TokenClaims(int(parts[1]), parts[2], int(parts[3]))
+    except ValueError:
+        raise InvalidToken("malformed token")
+    if claims.expires <= (time.time() if now is None else now):
+        raise InvalidToken("token expired")
+    return claims
+
+
+class SessionStore:
+    """
+    What a worker knows about sessions, so checking a token never needs the database:
+    an LRU of tokens it has already verified, and the sessions that were revoked before
+    their tokens ran out.
+
+    Revocations made on this worker count right away. the ones made by other workers are
+    read from user_sessions every AUTH_REVOCATION_REFRESH_SECONDS, so a token revoked
+    elsewhere keeps working for at most that long. only revoked sessions that haven't
+    expired are kept, there can't be more of them than logins in the last AUTH_TOKEN_TTL_SECONDS
+    """
+
+    def __init__(self, max_tokens: int = AUTH_TOKEN_CACHE_SIZE):
+        self.max_tokens = max_tokens
+        # token -> claims, most recently used last
+        self._verified: OrderedDict[str, TokenClaims] = OrderedDict()
+        # session_id -> when its token expires, after that the entry isn't needed anymore
+        self._revoked: dict[str, int] = {}
+        self._synced_at: Optional[datetime.datetime] = None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def validate(self, token: str, now: Optional[float] = None) -> TokenClaims:
+        """
+        The claims of a token that is validly signed, not expired and not revoked
+
+        Raises:
+            InvalidToken: otherwise
+        """
+        now = time.time() if now is None else now
+        claims = self._verified.get(token)
+        if claims is None:
+            self.misses += 1
+            try:
+                claims = decode_token(token, now=now)
+            except InvalidToken:
+                self.rejected += 1
+                raise
+            self._verified[token] = claims
+            if len(self._verified) > self.max_tokens:
+                self._verified.popitem(last=False)
+        else:
+            self.hits += 1
+            self._verified.move_to_end(token)
+            if claims.expires <= now:
+                del self._verified[token]
+                self.rejected += 1
+                raise InvalidToken("token expired")
+        if claims.session_id in self._revoked:
+            self.rejected += 1
+            raise InvalidToken("session revoked")
+        return claims
+
+    def revoke(self, session_id: str, expires: int):
+        # its tokens can stay in _verified, validate checks _revoked either way
+        self._revoked[session_id] = expires
+
+    def _prune(self, now: float):
+        for session_id in [session_id for session_id, expires in self._revoked.items() if expires <= now]:
+            del self._revoked[session_id]
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Pick up the sessions revoked since the last refresh, by any worker
+        """
+        # read the clock first, anything revoked while we read is picked up by the next refresh
+        now = await db_now(db)
+        query = (select(UserSessionModel.session_id, UserSessionModel.expires_date)
+                 .filter(and_(UserSessionModel.revoked_date.is_not(None),
+                              UserSessionModel.expires_date > datetime.datetime.utcnow())))
+        if self._synced_at is not None:
+            query = query.filter(UserSessionModel.revoked_date >= self._synced_at - datetime.timedelta(seconds=SYNC_OVERLAP_SECONDS))
+        for session_id, expires_date in await db.execute(query):
+            self.revoke(session_id, _unix_time(expires_date))
+        self._prune(time.time())
+        self._synced_at = now
+
+    async def run_forever(self, interval: float = AUTH_REVOCATION_REFRESH_SECONDS):
+        """
+        Refresh the revoked sessions every interval until cancelled, see the app's lifespan
+        """
+        while True:
+            try:
+                async with SessionLocal() as db:
+                    await self.refresh(db)
+            except Exception as e:
+                logging.error(f"Error refreshing revoked sessions: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {"verified_tokens": len(self._verified), "revoked_sessions": len(self._revoked),
+                "hits": self.hits, "misses": self.misses, "rejected": self.rejected}
+
+
+sessions = SessionStore()
+
+
+def _unix_time(value) -> int:
+    # expires_date is stored as naive UTC
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return int(value.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def create_session(db: AsyncSession, user_id: int) -> tuple[str, int]:
+    """
+    Start a session for a user who just logged in. the caller commits
+
+    Returns:
+        tuple: the access token and the unix time it expires
+    """
+    session_id = secrets.token_urlsafe(12)
+    expires = int(time.time()) + AUTH_TOKEN_TTL_SECONDS
+    db.add(UserSessionModel(session_id=session_id, user_id=user_id,
+                            expires_date=datetime.datetime.fromtimestamp(expires, datetime.timezone.utc).replace(tzinfo=None)))
+    return issue_token(user_id, session_id, expires), expires
+
+
+async def revoke_sessions(db: AsyncSession, user_id: int, session_id: Optional[str] = None) -> list[tuple[str, int]]:
+    """
+    Revoke one of a user's sessions, or all of the ones still running. the caller commits,
+    then passes the result to forget_sessions
+
+    Returns:
+        list: (session_id, expires) of every session revoked
+    """
+    query = select(UserSessionModel.session_id, UserSessionModel.expires_date).filter(and_(
+        UserSessionModel.user_id == user_id,
+        UserSessionModel.revoked_date.is_(None),
+        UserSessionModel.expires_date > datetime.datetime.utcnow()))
+    if session_id is not None:
+        query = query.filter(UserSessionModel.session_id == session_id)
+    revoked = [(row.session_id, _unix_time(row.expires_date)) for row in await db.execute(query)]
+    if revoked:
+        await db.execute(update(UserSessionModel)
+                         .filter(UserSessionModel.session_id.in_([session for session, _ in revoked]))
+                         # the database's clock, the one refresh compares against
+                         .values(revoked_date=func.current_timestamp()))
+    return revoked
+
+
+def forget_sessions(revoked: list[tuple[str, int]]):
+    """
+    Stop accepting revoked sessions on this worker right away, the others catch up on their next refresh
+    """
+    for session_id, expires in revoked:
+        sessions.revoke(session_id, expires)
+
+
+def request_token(request: Request) -> Optional[str]:
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"})
+
+
+async def current_session(request: Request) -> Optional[TokenClaims]:
+    """
+    Dependency: the claims of the request's bearer token, None when it didn't send one
+    (and AUTH_REQUIRED is off). the token is checked in this process, no query
+
+    Raise:
+        HTTPException: 401 if the token is invalid, expired or revoked, or missing while AUTH_REQUIRED is on
+    """
+    token = request_token(request)
+    if token is None:
+        if AUTH_REQUIRED:
+            raise _unauthorized("not authenticated")
+        return None
+    try:
+        return sessions.validate(token)
+    except InvalidToken as e:
+        raise _unauthorized(str(e))
+
+
+async def authorize_user(user_id: int, request: Request) -> Optional[TokenClaims]:
+    """
+    Dependency for routes with a {user_id} path: the token, if any, has to be that user's
+
+    Raise:
+        HTTPException: what current_session raises, or 403 if the token is someone else's
+    """
+    claims = await current_session(request)
+    if claims is not None and claims.user_id != user_id:
+        raise HTTPException(status_code=403, detail="token does not belong to this user")
+    return claims
@@ -0,0 +1,147 @@
+import os
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Optional
+from fastapi import APIRouter
+from . import env  # noqa: F401  loads .env
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+
+
+# cache keys, kept in one place so reads and invalidations can't drift apart
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def pin_key(pin_id: int) -> str:
+    return f"pin:{pin_id}"
+
+
+def user_pins_key(user_id: int) -> str:
+    return f"user_pins:{user_id}"
+
+
+class CacheBackend(ABC):
+    """
+    Interface for the read-through cache. The methods are async so a shared
+    (networked) cache can be dropped in without touching the routes.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        """
+        Returns:
+            the cached value, or None on a miss
+        """
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, *keys: str):
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+
+class LRUCache(CacheBackend):
+    """
+    In-process cache bounded by entry count, least recently used entries go first
+    """
+
+    def __init__(self, ttl_seconds: float = CACHE_TTL_SECONDS, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (expires_at, value)
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl_seconds if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def clear(self):
+        self._entries.clear()
+
+
+class _CacheProxy:
+    """
+    What the routes import. Forwards to the configured backend so it can be
+    swapped at startup with set_cache_backend()
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+cache = _CacheProxy(LRUCache())
+
+
+def set_cache_backend(backend: CacheBackend):
+    """
+    Replace the in-process LRU with another backend, e.g. a shared cache
+    """
+    cache.backend = backend
+
+
+router = APIRouter()
+
+
+@router.get("/cache-stats")
+async def cache_stats():
+    """
+    Hit / miss / eviction counters for tuning CACHE_TTL_SECONDS and CACHE_MAX_ENTRIES
+
+    Return:
+        JSON Object: cache counters
+    """
+    return cache.stats()
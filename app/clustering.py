@@ -0,0 +1,239 @@
+import os
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import PinModel, UserPartnershipModel
+from .spatial import count_covering_cells, covering_cells, encode_geohash
+
+# finest cells we cluster on, ~150m. anything past zoom 15 just uses these
+MAX_CLUSTER_PRECISION = 7
+# how many pin ids a cluster hands back so the client can show a preview
+REPRESENTATIVE_PINS = 5
+
+CLUSTER_TTL_SECONDS = float(os.getenv("PIN_CLUSTER_TTL_SECONDS", "60"))
+MAX_CACHED_USERS = int(os.getenv("PIN_CLUSTER_MAX_USERS", "1024"))
+
+
+def precision_for_zoom(zoom: int) -> int:
+    """
+    Pick a geohash precision whose cells are a small fraction of the screen at a web-map zoom level
+
+    Args:
+        zoom: slippy map zoom level, 0 (whole world) to ~22
+
+    Returns:
+        int: geohash precision between 1 and MAX_CLUSTER_PRECISION
+    """
+    # each precision step shrinks cells by 2.5 zoom levels on average
+    return max(1, min(MAX_CLUSTER_PRECISION, (zoom * 2 + 5) // 5))
+
+
+@dataclass
+class ClusterSummary:
+    count: int = 0
+    sum_lat: float = 0.0
+    sum_lon: float = 0.0
+    min_lat: float = 90.0
+    min_lon: float = 180.0
+    max_lat: float = -90.0
+    max_lon: float = -180.0
+    pin_ids: list[int] = field(default_factory=list)
+
+    def merge(self, other: "ClusterSummary"):
+        self.count += other.count
+        self.sum_lat += other.sum_lat
+        self.sum_lon += other.sum_lon
+        self.min_lat = min(self.min_lat, other.min_lat)
+        self.min_lon = min(self.min_lon, other.min_lon)
+        self.max_lat = max(self.max_lat, other.max_lat)
+        self.max_lon = max(self.max_lon, other.max_lon)
+        if len(self.pin_ids) < REPRESENTATIVE_PINS:
+            self.pin_ids.extend(other.pin_ids[:REPRESENTATIVE_PINS - len(self.pin_ids)])
+
+    def intersects(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> bool:
+        return not (self.max_lat < min_lat or self.min_lat > max_lat or self.max_lon < min_lon or self.min_lon > max_lon)
+
+    def to_dict(self, cell: str) -> dict:
+        return {
+            "cell": cell,
+            "count": self.count,
+            "latitude": self.sum_lat / self.count,
+            "longitude": self.sum_lon / self.count,
+            "bbox": [self.min_lat, self.min_lon, self.max_lat, self.max_lon],
+            "pin_ids": self.pin_ids,
+        }
+
+
+def _single(pin_id: int, latitude: float, longitude: float) -> ClusterSummary:
+    return ClusterSummary(1, latitude, longitude, latitude, longitude, latitude, longitude, [pin_id])
+
+
+class UserClusters:
+    """
+    Cluster summaries for one user's pins at every precision.
+
+    The finest level keeps its member pins, every coarser cell is the merge of its
+    children, so adding or removing a pin only touches the cells on its path.
+    """
+
+    def __init__(self, loaded_at: float):
+        self.loaded_at = loaded_at
+        # pin_id -> (latitude, longitude, finest cell)
+        self.points: dict[int, tuple[float, float, str]] = {}
+        # finest cell -> {pin_id: (latitude, longitude)}
+        self.members: dict[str, dict[int, tuple[float, float]]] = {}
+        # precision -> cell -> summary
+        self.levels: dict[int, dict[str, ClusterSummary]] = {p: {} for p in range(1, MAX_CLUSTER_PRECISION + 1)}
+        # precision -> cell -> child cells one precision down
+        self.children: dict[int, dict[str, set[str]]] = {p: {} for p in range(1, MAX_CLUSTER_PRECISION)}
+
+    def add(self, pin_id: int, latitude: float, longitude: float):
+        if pin_id in self.points:
+            return
+        cell = encode_geohash(latitude, longitude, MAX_CLUSTER_PRECISION)
+        self.points[pin_id] = (latitude, longitude, cell)
+        self.members.setdefault(cell, {})[pin_id] = (latitude, longitude)
+        for precision in range(1, MAX_CLUSTER_PRECISION):
+            self.children[precision].setdefault(cell[:precision], set()).add(cell[:precision + 1])
+        # adding only ever grows a cell, so the finest summary can be updated in place
+        self.levels[MAX_CLUSTER_PRECISION].setdefault(cell, ClusterSummary()).merge(_single(pin_id, latitude, longitude))
+        self._rebuild_ancestors(cell)
+
+    def remove(self, pin_id: int):
+        point = self.points.pop(pin_id, None)
+        if point is None:
+            return
+        cell = point[2]
+        members = self.members[cell]
+        members.pop(pin_id, None)
+        # removing can shrink the bbox or drop a representative, recompute the cell from its members
+        finest = self.levels[MAX_CLUSTER_PRECISION]
+        if members:
+            summary = ClusterSummary()
+            for member_id, (latitude, longitude) in members.items():
+                summary.merge(_single(member_id, latitude, longitude))
+            finest[cell] = summary
+        else:
+            finest.pop(cell, None)
+            self.members.pop(cell, None)
+        self._rebuild_ancestors(cell)
+
+    def _rebuild_ancestors(self, cell: str):
+        for precision in range(MAX_CLUSTER_PRECISION - 1, 0, -1):
+            prefix = cell[:precision]
+            child_level = self.levels[precision + 1]
+            children = self.children[precision].get(prefix, set())
+            summary = ClusterSummary()
+            # biggest children first so the representative pins come from the densest spots
+            for child in sorted(children, key=lambda child: -child_level[child].count if child in child_level else 0):
+                if child in child_level:
+                    summary.merge(child_level[child])
+            children.intersection_update(child_level)
+            if summary.count:
+                self.levels[precision][prefix] = summary
+            else:
+                self.levels[precision].pop(prefix, None)
+                self.children[precision].pop(prefix, None)
+
+    def cells_in(self, precision: int, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> dict[str, ClusterSummary]:
+        level = self.levels[precision]
+        if count_covering_cells(min_lat, min_lon, max_lat, max_lon, precision) < len(level):
+            candidates = ((cell, level.get(cell)) for cell in covering_cells(min_lat, min_lon, max_lat, max_lon, precision))
+        else:
+            candidates = level.items()
+        return {cell: summary for cell, summary in candidates
+                if summary is not None and summary.intersects(min_lat, min_lon, max_lat, max_lon)}
+
+
+class PinClusterIndex:
+    """
+    Per-user cluster summaries, loaded on first request and kept up to date by
+    create_pin / delete_pin. Entries expire after CLUSTER_TTL_SECONDS so writes made
+    by other workers are picked up.
+    """
+
+    def __init__(self, ttl_seconds: float = CLUSTER_TTL_SECONDS, max_users: int = MAX_CACHED_USERS):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self._users: OrderedDict[int, UserClusters] = OrderedDict()
+
+    async def _get_user(self, db: AsyncSession, user_id: int) -> UserClusters:
+        now = time.monotonic()
+        clusters = self._users.get(user_id)
+        if clusters is not None and now - clusters.loaded_at <= self.ttl_seconds:
+            self._users.move_to_end(user_id)
+            return clusters
+
+        clusters = UserClusters(now)
+        result = await db.execute(
+            select(PinModel.pin_id, PinModel.latitude, PinModel.longitude)
+            .filter(and_(PinModel.user_id == user_id, PinModel.removal_date.is_(None)))
+        )
+        for row in result:
+            if row.latitude is not None and row.longitude is not None:
+                clusters.add(row.pin_id, float(row.latitude), float(row.longitude))
+        self._users[user_id] = clusters
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return clusters
+
+    async def query(self, db: AsyncSession, user_ids: list[int], zoom: int,
+                    min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> list[dict]:
+        """
+        Clusters of the given users' pins that overlap a viewport
+
+        Args:
+            db: database session, only used for users that aren't cached
+            user_ids: owners whose pins are clustered together (a user, or a couple)
+            zoom: map zoom level, decides the cluster size
+            min_lat, min_lon, max_lat, max_lon: viewport
+
+        Returns:
+            list[dict]: clusters with count, centroid, bbox and representative pin ids
+        """
+        precision = precision_for_zoom(zoom)
+        merged: dict[str, ClusterSummary] = {}
+        for user_id in user_ids:
+            clusters = await self._get_user(db, user_id)
+            for cell, summary in clusters.cells_in(precision, min_lat, min_lon, max_lat, max_lon).items():
+                merged.setdefault(cell, ClusterSummary()).merge(summary)
+        return [summary.to_dict(cell) for cell, summary in merged.items()]
+
+    def add(self, user_id: Optional[int], pin_id: int, latitude: float, longitude: float):
+        clusters = self._users.get(user_id)
+        if clusters is not None:
+            clusters.add(pin_id, latitude, longitude)
+
+    def remove(self, user_id: Optional[int], pin_id: int):
+        clusters = self._users.get(user_id)
+        if clusters is not None:
+            clusters.remove(pin_id)
+
+    def remove_user(self, user_id: int):
+        self._users.pop(user_id, None)
+
+    def clear(self):
+        self._users.clear()
+
+
+async def get_partner_id(db: AsyncSession, user_id: int) -> Optional[int]:
+    """
+    The other user in user_id's partnership, if they have one
+    """
+    result = await db.execute(
+        select(UserPartnershipModel.user_id_1, UserPartnershipModel.user_id_2).filter(
+            or_(UserPartnershipModel.user_id_1 == user_id, UserPartnershipModel.user_id_2 == user_id)
+        )
+    )
+    row = result.first()
+    if row is None:
+        return None
+    return row.user_id_2 if row.user_id_1 == user_id else row.user_id_1
+
+
+pin_clusters = PinClusterIndex()
@@ -0,0 +1,34 @@
+import hashlib
+
+from fastapi import Request, Response
+
+
+def make_etag(value) -> str:
+    """
+    Weak ETag for a cached value. Computed once when the value is cached, so a
+    revalidation is a cache lookup and a string compare, nothing gets serialized
+
+    Args:
+        value: plain data (dicts, lists, column values) with a stable repr
+
+    Returns:
+        str: W/"<digest>"
+    """
+    return 'W/"' + hashlib.blake2b(repr(value).encode(), digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    If-None-Match check, using the weak comparison RFC 9110 asks for on GET
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
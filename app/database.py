@@ -1,12 +1,14 @@
-from fastapi import APIRouter
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
+from typing import Callable, Optional
+from fastapi import APIRouter, Request
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from dotenv import load_dotenv
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from . import env  # noqa: F401  loads .env
+import datetime
 import os
-
-load_dotenv()
+import time
 
 # Fetch the environment variables
 db_username = os.getenv("DB_USERNAME")
@@ -16,37 +18,243 @@ db_host = os.getenv("DB_HOST")
 db_port = os.getenv("DB_PORT")
 
 # Database connection string
-DATABASE_URL = f"mysql+pymysql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}"
+# DATABASE_URL can be set directly to point at another async driver,
+# e.g. sqlite+aiosqlite:///./luna.db for local development
+DATABASE_URL = os.getenv(
+    "DATABASE_URL",
+    f"mysql+aiomysql://{db_username}:{db_password}@{db_host}:{db_port}/{db_name}"
+)
 Base = declarative_base()
 
-# Create a SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+# Connection pool settings
+# recycle should stay below MySQL's wait_timeout so we never hand out a connection the server already dropped
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# called with the seconds each pool checkout took, see app/metrics.py
+pool_checkout_observers: list[Callable[[float], None]] = []
+# called with the engine once it is created, see observe_engine
+engine_observers: list[Callable[[AsyncEngine], None]] = []
+
+
+class PoolWaitStats:
+    """
+    Running totals of pool checkouts, reported by /check-db
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waited: float, timed_out: bool):
+        self.checkouts += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if timed_out:
+            self.timeouts += 1
+
+
+pool_wait_stats = PoolWaitStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    The default async pool, but it reports how long each checkout waited
+    (including opening a new connection when the pool has room to grow)
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            pool_wait_stats.record(waited, timed_out)
+            for observer in pool_checkout_observers:
+                observer(waited)
+
+
+_engine: Optional[AsyncEngine] = None
+
+
+def make_engine(url: str) -> AsyncEngine:
+    """
+    An engine with this module's pool settings and every engine observer attached,
+    for the primary and for read replicas (see app/replicas.py)
+    """
+    # an in-memory sqlite database only exists on its one connection, so it keeps the dialect's default pool
+    if ":memory:" in url:
+        pool_options = {}
+    else:
+        pool_options = {
+            "poolclass": TimedQueuePool,
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING,
+            "pool_timeout": DB_POOL_TIMEOUT,
+        }
+    engine = create_async_engine(url, **pool_options)
+    for observer in engine_observers:
+        observer(engine)
+    return engine
+
+
+def get_engine() -> AsyncEngine:
+    """
+    The worker's engine, created on first use. The app's lifespan creates it at startup;
+    creating it doesn't connect yet, but it does import the database driver
+
+    Returns:
+        AsyncEngine: the same engine on every call
+    """
+    global _engine
+    if _engine is None:
+        _engine = make_engine(DATABASE_URL)
+    return _engine
+
+
+def observe_engine(observer: Callable[[AsyncEngine], None]):
+    """
+    Call observer with the engine once it exists (right away if it already does), and with
+    every replica engine created later, e.g. to attach instrumentation, see app/main.py
+    """
+    engine_observers.append(observer)
+    if _engine is not None:
+        observer(_engine)
+
+
+async def dispose_engine():
+    """
+    Close pooled connections (they hold driver threads/sockets open) so the worker can exit.
+    the engine itself stays usable and reconnects on its next use
+    """
+    if _engine is not None:
+        await _engine.dispose()
+
+
+def __getattr__(name: str):
+    # `from app.database import engine` still works, it just creates the engine on first access
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class EngineSession(AsyncSession):
+    """
+    AsyncSession that binds to get_engine() when it's opened instead of when SessionLocal is defined
+    """
+
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(bind=bind if bind is not None else get_engine(), **kwargs)
+
 
 # Create a configured "Session" class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit is off so objects can still be read after commit without
+# triggering a lazy (blocking) refresh
+SessionLocal = async_sessionmaker(class_=EngineSession, autoflush=False, expire_on_commit=False)
+
+
+def route_user_ids(request: Request) -> list[int]:
+    """
+    The user ids in the request's path (user_id, user_id_1, user_id_2)
+    """
+    return [int(value) for name, value in request.path_params.items()
+            if name.startswith("user_id") and str(value).isdigit()]
+
+
+async def get_db(request: Request):
+    """
+    Dependency that hands a route its own async database session, on the primary.
+    the session remembers the route's users, so a commit keeps their next reads
+    off the read replicas for a moment (see app/replicas.py)
+
+    Returns:
+        AsyncSession: database session, closed once the request is done
+    """
+    async with SessionLocal() as db:
+        db.info["route_user_ids"] = route_user_ids(request)
+        yield db
+
+
+async def db_now(db: AsyncSession) -> datetime.datetime:
+    """
+    The database's clock, the one timestamps like updated_at and removal_date are set with
+    """
+    now = (await db.execute(select(func.current_timestamp()))).scalar_one()
+    # sqlite hands CURRENT_TIMESTAMP back as text
+    if isinstance(now, str):
+        now = datetime.datetime.fromisoformat(now)
+    return now
 
 
 router = APIRouter()
 
 
+def pool_status() -> dict:
+    """
+    Snapshot of the connection pool, read from the pool's counters without touching the database
+
+    Returns:
+        JSON Object: pool size, connections in use / idle / overflow and checkout wait times
+    """
+    pool = get_engine().sync_engine.pool
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return {"pool": type(pool).__name__}
+
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(0, pool.overflow()),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout_seconds": DB_POOL_TIMEOUT,
+        "recycle_seconds": DB_POOL_RECYCLE,
+        "pre_ping": DB_POOL_PRE_PING,
+        "checkouts": pool_wait_stats.checkouts,
+        "checkout_timeouts": pool_wait_stats.timeouts,
+        "avg_wait_ms": round(pool_wait_stats.total_wait / pool_wait_stats.checkouts * 1000, 3) if pool_wait_stats.checkouts else 0.0,
+        "max_wait_ms": round(pool_wait_stats.max_wait * 1000, 3),
+    }
+
+
 @router.get("/check-db")
 async def check_db_connection():
     """
-    Try to connect to the database 
+    Try to connect to the database, and report how the connection pool is doing
+
+    The probe reuses an idle pooled connection. If every connection is busy and
+    the pool can't grow, we skip the probe instead of queueing behind real traffic:
+    a saturated pool already means the database is answering.
 
     Return:
-        JSON Object: Connection Status
+        JSON Object: Connection Status and pool utilization
     """
+    pool = pool_status()
+    saturated = "idle" in pool and pool["idle"] == 0 and pool["checked_out"] >= pool["size"] + pool["max_overflow"]
+    if saturated:
+        return {"status": "DB Connection successful! (pool saturated, probe skipped)", "pool": pool}
+
     try:
-        with engine.connect() as connection:
+        async with get_engine().connect() as connection:
             # Execute the query using text() to construct the SQL statement
-            result = connection.execute(text("SELECT 1"))
+            result = await connection.execute(text("SELECT 1"))
             # Fetch the result to ensure execution
             _ = result.fetchone()
-        return {"status": "DB Connection successful!"}
+        return {"status": "DB Connection successful!", "pool": pool_status()}
     except OperationalError as e:
         # Error with the Database URL
-        return {"status": "Connection failed", "error": str(e)}
+        return {"status": "Connection failed", "error": str(e), "pool": pool_status()}
     except Exception as e:
         # General Error
-        return {"status": "An error occurred", "error": str(e)}
\ No newline at end of file
+        return {"status": "An error occurred", "error": str(e), "pool": pool_status()}
@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# every module that reads settings imports this first, python only runs it once
+load_dotenv()
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import bcrypt
+
+from concurrent.futures import ThreadPoolExecutor
+from . import env  # noqa: F401  loads .env
+
+# bcrypt work factor, every +1 doubles the cost of a hash
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# threads doing bcrypt at once. bcrypt releases the GIL, so threads run in parallel
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# hashes allowed to wait for a worker before callers have to wait their turn
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+
+def _hash_password(password: str, rounds: int) -> str:
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+
+def _verify_password(password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a small dedicated thread pool so signups and logins don't
+    block the event loop for the ~100-300ms a hash takes.
+    """
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS, max_workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._slots = asyncio.Semaphore(max_workers + max_pending)
+
+    async def _run(self, func, *args):
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password with a fresh salt
+
+        Args:
+            password: plain text password
+
+        Returns:
+            str: bcrypt hash, safe to store in users.hashed_password
+        """
+        return await self._run(_hash_password, password, self.rounds)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        """
+        Check a password against a stored bcrypt hash
+
+        Args:
+            password: plain text password
+            hashed_password: value of users.hashed_password
+
+        Returns:
+            bool: True if they match
+        """
+        return await self._run(_verify_password, password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hasher = PasswordHasher()
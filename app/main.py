@@ -1,13 +1,92 @@
+import time
+
+# everything below, including fastapi and sqlalchemy, counts towards the import phase
+_import_started = time.perf_counter()
+
+import asyncio
+import logging
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.routes import user_routes, pin_routes
+from fastapi.responses import ORJSONResponse
+from app.routes import user_routes, pin_routes, media_routes, auth_routes
+from app import admission
+from app import auth
 from app import database
+from app import replicas
+from app import purge
+from app.user_search import user_search
 from app import s3
+from app import cache
+from app import metrics
+from app import profiling
+from app import media
+from app import pin_bulk
+from app.hashing import password_hasher
+
+
+async def resume_thumbnails():
+    try:
+        await media.thumbnail_workers.resume()
+    except Exception as e:
+        logging.error(f"Error resuming thumbnails: {e}")
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Per-worker startup and shutdown. the engine is created here, once per worker, instead of at
+    import. the S3 client waits for its first use (see app/s3.py)
+    """
+    started = time.perf_counter()
+    database.get_engine()
+    metrics.startup_seconds.set("create_engine", value=time.perf_counter() - started)
+    # in the background so a slow query here doesn't hold up the first request
+    resume = asyncio.create_task(resume_thumbnails())
+    health_checks = asyncio.create_task(replicas.replica_router.run_health_checks()) if replicas.replica_router.replicas else None
+    purging = asyncio.create_task(purge.purger.run_forever()) if purge.PURGE_ENABLED else None
+    # searches go to the database until the index has loaded
+    search_index = asyncio.create_task(user_search.run_forever())
+    revocations = asyncio.create_task(auth.sessions.run_forever())
+    yield
+    revocations.cancel()
+    search_index.cancel()
+    resume.cancel()
+    if purging is not None:
+        purging.cancel()
+    if health_checks is not None:
+        health_checks.cancel()
+    # pins still waiting for their batch get written before the engine goes away
+    await pin_bulk.pin_writes.drain()
+    media.thumbnail_workers.shutdown()
+    password_hasher.shutdown()
+    # pooled connections hold driver threads/sockets open, close them so the worker can exit
+    await database.dispose_engine()
+    await replicas.replica_router.dispose()
+
+
+# orjson renders the validated response content several times faster than json.dumps
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+# middleware added last runs first: metrics sees (and times) requests admission control sheds,
+# and only admitted requests get profiled
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(admission.AdmissionMiddleware, router=app.router)
+app.add_middleware(metrics.MetricsMiddleware)
+# attached whenever the engine / client actually get created
+database.observe_engine(metrics.instrument_engine)
+database.observe_engine(profiling.instrument_engine)
+s3.observe_client(metrics.instrument_s3_client)
+app.include_router(auth_routes.router)
 app.include_router(user_routes.router)
 app.include_router(pin_routes.router)
+app.include_router(media_routes.router)
 app.include_router(database.router)
+app.include_router(replicas.router)
+app.include_router(purge.router)
 app.include_router(s3.router)
+app.include_router(cache.router)
+app.include_router(metrics.router)
+app.include_router(profiling.router)
 
 
 @app.get("/")
@@ -26,3 +105,6 @@ async def root():
         TypeOfException: Why
     """
     return {"message": "Hello World!"}
+
+
+metrics.startup_seconds.set("import_app", value=time.perf_counter() - _import_started)
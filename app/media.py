@@ -0,0 +1,327 @@
+import asyncio
+import io
+import logging
+import math
+import os
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from botocore.exceptions import ClientError
+from sqlalchemy import and_, select, update
+from .database import SessionLocal
+from .models import MediaStatus, PinMediaModel
+from .s3 import get_s3
+
+MEDIA_BUCKET = os.getenv("S3_MEDIA_BUCKET", "luna-pin-media")
+# what we accept, and the extension the object key gets
+MEDIA_CONTENT_TYPES = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(50 * 1024 * 1024)))
+# uploads bigger than this are split into parts the client PUTs separately (and can retry one by one)
+MULTIPART_THRESHOLD_BYTES = int(os.getenv("MEDIA_MULTIPART_THRESHOLD_BYTES", str(16 * 1024 * 1024)))
+# S3 wants every part but the last to be at least 5 MiB
+MULTIPART_PART_BYTES = max(5 * 1024 * 1024, int(os.getenv("MEDIA_MULTIPART_PART_BYTES", str(8 * 1024 * 1024))))
+UPLOAD_URL_EXPIRY_SECONDS = int(os.getenv("MEDIA_UPLOAD_URL_EXPIRY_SECONDS", "900"))
+# uploads still pending after this long are given up on by the purge: multipart uploads
+# are aborted (their parts cost storage until then), the object and the row deleted
+PENDING_UPLOAD_EXPIRY_SECONDS = int(os.getenv("MEDIA_PENDING_UPLOAD_EXPIRY_SECONDS", str(24 * 3600)))
+DOWNLOAD_URL_EXPIRY_SECONDS = int(os.getenv("MEDIA_DOWNLOAD_URL_EXPIRY_SECONDS", "3600"))
+# a cached download URL is reissued once it has less than this left, so clients never get one about to die
+DOWNLOAD_URL_REFRESH_SECONDS = int(os.getenv("MEDIA_DOWNLOAD_URL_REFRESH_SECONDS", "300"))
+DOWNLOAD_URL_CACHE_MAX = int(os.getenv("MEDIA_DOWNLOAD_URL_CACHE_MAX", "10000"))
+THUMBNAIL_MAX_PIXELS = int(os.getenv("MEDIA_THUMBNAIL_MAX_PIXELS", "320"))
+THUMBNAIL_WORKERS = int(os.getenv("MEDIA_THUMBNAIL_WORKERS", "2"))
+# thumbnails queued or running at once. past that media stays "uploaded" until resume() picks it up
+THUMBNAIL_MAX_PENDING = int(os.getenv("MEDIA_THUMBNAIL_MAX_PENDING", "256"))
+
+
+class MediaError(Exception):
+    """
+    The upload can't be started or completed as asked (bad type/size, missing object, bad parts)
+    """
+
+
+def new_object_key(pin_id: int, content_type: str) -> str:
+    # random so keys can't be guessed from ids, and a re-upload never overwrites a cached URL's object
+    return f"pins/{pin_id}/{uuid.uuid4().hex}{MEDIA_CONTENT_TYPES[content_type]}"
+
+
+def thumbnail_key_for(object_key: str) -> str:
+    return f"{os.path.splitext(object_key)[0]}-thumb.jpg"
+
+
+def check_upload(content_type: str, size_bytes: int):
+    """
+    Raises:
+        MediaError: if we won't take an upload of this type / size
+    """
+    if content_type not in MEDIA_CONTENT_TYPES:
+        raise MediaError(f"unsupported content type, expected one of: {', '.join(MEDIA_CONTENT_TYPES)}")
+    if not 0 < size_bytes <= MEDIA_MAX_BYTES:
+        raise MediaError(f"size_bytes must be between 1 and {MEDIA_MAX_BYTES}")
+
+
+async def start_upload(media: PinMediaModel) -> dict:
+    """
+    Presigned URLs the client uploads the bytes to directly, so they never pass through the API.
+    small files get a single PUT, bigger ones a multipart upload with one URL per part
+    (media.upload_id is set in that case)
+
+    Args:
+        media: the pending row, with object_key, content_type and size_bytes set
+
+    Returns:
+        JSON Object: method, url + headers (single PUT) or upload_id, part_size + parts (multipart), expires_in
+    """
+    if media.size_bytes <= MULTIPART_THRESHOLD_BYTES:
+        url = get_s3().generate_presigned_url(
+            "put_object",
+            Params={"Bucket": MEDIA_BUCKET, "Key": media.object_key, "ContentType": media.content_type},
+            ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS,
+        )
+        return {"method": "PUT", "url": url, "headers": {"Content-Type": media.content_type},
+                "expires_in": UPLOAD_URL_EXPIRY_SECONDS}
+
+    # the only call here that goes over the network, boto3 is blocking so keep it off the loop
+    upload = await asyncio.to_thread(get_s3().create_multipart_upload, Bucket=MEDIA_BUCKET, Key=media.object_key,
+                                     ContentType=media.content_type)
+    media.upload_id = upload["UploadId"]
+    # presigning is local (just an HMAC), no round trip per part
+    parts = [{
+        "part_number": part_number,
+        "url": get_s3().generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": MEDIA_BUCKET, "Key": media.object_key, "UploadId": media.upload_id,
+                    "PartNumber": part_number},
+            ExpiresIn=UPLOAD_URL_EXPIRY_SECONDS,
+        ),
+    } for part_number in range(1, math.ceil(media.size_bytes / MULTIPART_PART_BYTES) + 1)]
+    return {"method": "PUT", "upload_id": media.upload_id, "part_size": MULTIPART_PART_BYTES, "parts": parts,
+            "expires_in": UPLOAD_URL_EXPIRY_SECONDS}
+
+
+async def finish_upload(media: PinMediaModel, parts: Optional[list[dict]] = None) -> int:
+    """
+    Make sure the bytes really landed in S3, completing the multipart upload first if there is one
+
+    Args:
+        media: the pending row
+        parts: part_number / etag of every uploaded part, multipart uploads only
+
+    Returns:
+        int: size of the stored object
+
+    Raises:
+        MediaError: if the object isn't there, the parts don't add up, or it's too big
+    """
+    try:
+        if media.upload_id:
+            if not parts:
+                raise MediaError("parts are required to complete a multipart upload")
+            await asyncio.to_thread(
+                get_s3().complete_multipart_upload, Bucket=MEDIA_BUCKET, Key=media.object_key, UploadId=media.upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": part["part_number"], "ETag": part["etag"]}
+                                           for part in sorted(parts, key=lambda part: part["part_number"])]},
+            )
+        head = await asyncio.to_thread(get_s3().head_object, Bucket=MEDIA_BUCKET, Key=media.object_key)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code", "")
+        if code in ("404", "NoSuchKey", "NotFound"):
+            raise MediaError("the object has not been uploaded")
+        raise MediaError(f"could not complete the upload: {code or e}")
+
+    if head["ContentLength"] > MEDIA_MAX_BYTES:
+        await asyncio.to_thread(get_s3().delete_object, Bucket=MEDIA_BUCKET, Key=media.object_key)
+        raise MediaError(f"upload is larger than {MEDIA_MAX_BYTES} bytes")
+    return head["ContentLength"]
+
+
+async def abort_upload(object_key: str, upload_id: Optional[str]) -> bool:
+    """
+    Abort a multipart upload, so S3 drops the parts uploaded so far. nothing to do for
+    single PUT uploads (upload_id None), and an upload that is already gone is fine
+
+    Returns:
+        bool: False if S3 couldn't abort it (logged), the caller can try again later
+    """
+    if not upload_id:
+        return True
+    try:
+        await asyncio.to_thread(get_s3().abort_multipart_upload, Bucket=MEDIA_BUCKET, Key=object_key, UploadId=upload_id)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code", "") == "NoSuchUpload":
+            return True
+        logging.error(f"Error aborting upload {upload_id} of {object_key}: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Error aborting upload {upload_id} of {object_key}: {e}")
+        return False
+    return True
+
+
+async def delete_objects(keys: list[str]):
+    """
+    Delete photos and thumbnails from S3, up to 1000 keys per request. keys that are
+    already gone are fine, so a purge that is retried after a crash can delete them again
+
+    Raises:
+        MediaError: if S3 couldn't delete some of them
+    """
+    for start in range(0, len(keys), 1000):
+        batch = keys[start:start + 1000]
+        response = await asyncio.to_thread(get_s3().delete_objects, Bucket=MEDIA_BUCKET,
+                                           Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+        if response.get("Errors"):
+            raise MediaError(f"could not delete {len(response['Errors'])} objects, e.g. {response['Errors'][0]}")
+
+
+def _make_thumbnail(object_key: str, thumbnail_key: str, max_pixels: int):
+    # only the worker threads need Pillow, keep it out of the API's import time
+    from PIL import Image, ImageOps
+
+    original = get_s3().get_object(Bucket=MEDIA_BUCKET, Key=object_key)["Body"].read()
+    with Image.open(io.BytesIO(original)) as image:
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((max_pixels, max_pixels))
+        output = io.BytesIO()
+        thumbnail.convert("RGB").save(output, "JPEG", quality=80, optimize=True)
+    # keys are never reused, so the thumbnail can be cached forever
+    get_s3().put_object(Bucket=MEDIA_BUCKET, Key=thumbnail_key, Body=output.getvalue(), ContentType="image/jpeg",
+                        CacheControl="max-age=31536000, immutable")
+
+
+class ThumbnailWorkerPool:
+    """
+    Makes thumbnails on a small thread pool after an upload completes, off the request path.
+    Pillow and boto3 both release the GIL for the heavy parts, so threads are enough
+    """
+
+    def __init__(self, max_workers: int = THUMBNAIL_WORKERS, max_pending: int = THUMBNAIL_MAX_PENDING,
+                 max_pixels: int = THUMBNAIL_MAX_PIXELS):
+        self.max_pending = max_pending
+        self.max_pixels = max_pixels
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, media_id: int, object_key: str) -> bool:
+        """
+        Queue a thumbnail. must be called from the event loop
+
+        Returns:
+            bool: False if the queue is full, the media stays "uploaded" for resume() to pick up
+        """
+        if len(self._tasks) >= self.max_pending:
+            return False
+        task = asyncio.get_running_loop().create_task(self._run(media_id, object_key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, media_id: int, object_key: str):
+        thumbnail_key = thumbnail_key_for(object_key)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, _make_thumbnail, object_key, thumbnail_key, self.max_pixels)
+            values = {"status": MediaStatus.ready, "thumbnail_key": thumbnail_key}
+        except Exception as e:
+            logging.error(f"Error making thumbnail for media {media_id}: {e}")
+            values = {"status": MediaStatus.failed}
+        async with SessionLocal() as db:
+            await db.execute(update(PinMediaModel)
+                             .filter(and_(PinMediaModel.media_id == media_id,
+                                          PinMediaModel.status == MediaStatus.uploaded))
+                             .values(**values))
+            await db.commit()
+
+    async def resume(self):
+        """
+        Queue media that was uploaded but never thumbnailed, e.g. because the worker restarted
+        or the queue was full. thumbnails are written to a fixed key, so doing one twice is harmless
+        """
+        async with SessionLocal() as db:
+            rows = (await db.execute(
+                select(PinMediaModel.media_id, PinMediaModel.object_key)
+                .filter(PinMediaModel.status == MediaStatus.uploaded)
+                .order_by(PinMediaModel.media_id)
+                .limit(self.max_pending)
+            )).all()
+        for row in rows:
+            if not self.submit(row.media_id, row.object_key):
+                break
+
+    async def drain(self):
+        """
+        Wait for every queued thumbnail
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._tasks), "max_pending": self.max_pending}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PresignedUrlCache:
+    """
+    Download URLs per object key. a presigned URL is valid for anyone until it expires,
+    so map views asking for the same photos reuse one instead of signing again.
+    callers check access before asking for a URL
+    """
+
+    def __init__(self, expires_in: int = DOWNLOAD_URL_EXPIRY_SECONDS,
+                 refresh_margin: int = DOWNLOAD_URL_REFRESH_SECONDS, max_entries: int = DOWNLOAD_URL_CACHE_MAX):
+        self.expires_in = expires_in
+        self.refresh_margin = refresh_margin
+        self.max_entries = max_entries
+        # object key -> (expires_at, url), expires_at is wall clock because S3 checks it against its own clock
+        self._urls: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def url(self, object_key: str) -> str:
+        now = time.time()
+        entry = self._urls.get(object_key)
+        if entry is not None and entry[0] - now > self.refresh_margin:
+            self._urls.move_to_end(object_key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        url = get_s3().generate_presigned_url("get_object", Params={"Bucket": MEDIA_BUCKET, "Key": object_key},
+                                        ExpiresIn=self.expires_in)
+        self._urls[object_key] = (now + self.expires_in, url)
+        self._urls.move_to_end(object_key)
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+        return url
+
+    def stats(self) -> dict:
+        return {"entries": len(self._urls), "hits": self.hits, "misses": self.misses}
+
+
+def media_to_dict(row, urls: PresignedUrlCache) -> dict:
+    """
+    A pin_media row as clients see it, with download URLs once the bytes are there
+
+    Args:
+        row: selected pin_media columns
+        urls: where the download URLs come from
+    """
+    status = MediaStatus(row.status)
+    return {
+        "media_id": row.media_id,
+        "pin_id": row.pin_id,
+        "status": status.value,
+        "content_type": row.content_type,
+        "size_bytes": row.size_bytes,
+        "url": urls.url(row.object_key) if status in (MediaStatus.uploaded, MediaStatus.ready) else None,
+        "thumbnail_url": urls.url(row.thumbnail_key) if status == MediaStatus.ready else None,
+    }
+
+
+thumbnail_workers = ThumbnailWorkerPool()
+download_urls = PresignedUrlCache()
@@ -0,0 +1,243 @@
+import time
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from .cache import cache
+from .database import pool_checkout_observers
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        self._values[label_values] = value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus-style histogram. Observing is a bisect and two additions,
+    buckets are only made cumulative when /metrics is scraped.
+    """
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+inf last), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, *label_values, value: float):
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+http_requests = Counter("luna_http_requests_total", "HTTP requests handled", ("route", "method", "status"))
+http_latency = Histogram("luna_http_request_duration_seconds", "Time spent handling a request", ("route", "method"))
+http_in_flight = Gauge("luna_http_requests_in_flight", "Requests currently being handled")
+db_statements = Counter("luna_db_statements_total", "SQL statements executed")
+db_statements_per_request = Histogram("luna_db_statements_per_request", "SQL statements executed per request",
+                                      ("route",), buckets=STATEMENT_BUCKETS)
+db_time_per_request = Histogram("luna_db_time_per_request_seconds", "Time spent in SQL statements per request", ("route",))
+db_pool_checkout_wait = Histogram("luna_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection")
+s3_latency = Histogram("luna_s3_call_duration_seconds", "Duration of S3 API calls", ("operation",))
+s3_errors = Counter("luna_s3_call_errors_total", "S3 API calls that returned an error", ("operation",))
+startup_seconds = Gauge("luna_startup_seconds", "Time this worker spent in each startup phase", ("phase",))
+admission_in_flight = Gauge("luna_admission_in_flight", "Requests admitted and running, per route class", ("route_class",))
+admission_queue_depth = Gauge("luna_admission_queue_depth", "Requests waiting to be admitted, per route class", ("route_class",))
+admission_wait = Histogram("luna_admission_wait_seconds", "Time admitted requests spent queued", ("route_class",))
+admission_rejected = Counter("luna_admission_rejected_total", "Requests shed with a 503", ("route_class", "reason"))
+
+REGISTRY = [http_requests, http_latency, http_in_flight, db_statements, db_statements_per_request,
+            db_time_per_request, db_pool_checkout_wait, s3_latency, s3_errors, startup_seconds,
+            admission_in_flight, admission_queue_depth, admission_wait, admission_rejected]
+
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+
+# stats for the request being handled, set by MetricsMiddleware
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("current_request_stats", default=None)
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (cheaper than BaseHTTPMiddleware) that times every request
+    and records how many SQL statements it ran
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec()
+            current_request_stats.reset(token)
+            # the router puts the matched route in the scope, label by its template not the raw path
+            route = scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_requests.inc(route_path, method, status)
+            http_latency.observe(route_path, method, value=elapsed)
+            db_statements_per_request.observe(route_path, value=stats.statements)
+            db_time_per_request.observe(route_path, value=stats.db_seconds)
+
+
+def _observe_pool_wait(waited: float):
+    db_pool_checkout_wait.observe(value=waited)
+
+
+def instrument_engine(engine: AsyncEngine):
+    """
+    Count statements and time spent in them, per request, using engine events
+    """
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # on the execution context, not the connection: a statement that raises never gets
+        # an after_cursor_execute, and a start left on the pooled connection would be
+        # paired with a later statement
+        context.metrics_query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_query_start
+        db_statements.inc()
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += elapsed
+
+    # every pool reports to the same observers, so replica engines mustn't add a second one
+    if _observe_pool_wait not in pool_checkout_observers:
+        pool_checkout_observers.append(_observe_pool_wait)
+
+
+def instrument_s3_client(client):
+    """
+    Time every call made through a boto3 client using botocore's event hooks
+    """
+    def _before_call(model, context, **kwargs):
+        context["luna_start"] = time.perf_counter()
+
+    def _after_call(http_response, parsed, model, context, **kwargs):
+        start = context.get("luna_start")
+        if start is not None:
+            s3_latency.observe(model.name, value=time.perf_counter() - start)
+        if http_response.status_code >= 400:
+            s3_errors.inc(model.name)
+
+    client.meta.events.register("before-call.s3", _before_call)
+    client.meta.events.register("after-call.s3", _after_call)
+
+
+def _cache_lines() -> list[str]:
+    lines = []
+    for name, value in cache.stats().items():
+        if isinstance(value, (int, float)) and name in ("hits", "misses", "evictions", "expirations", "invalidations"):
+            lines.append(f"# TYPE luna_cache_{name}_total counter")
+            lines.append(f"luna_cache_{name}_total {value}")
+        elif name == "entries":
+            lines.append("# TYPE luna_cache_entries gauge")
+            lines.append(f"luna_cache_entries {value}")
+    return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.extend(_cache_lines())
+    return "\n".join(lines) + "\n"
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Everything above in Prometheus text format, meant to be scraped
+
+    Return:
+        text/plain: Prometheus exposition format
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -1,8 +1,8 @@
-import bcrypt
 import enum
 
-from sqlalchemy import TIMESTAMP, Column, Enum, ForeignKey, Integer, String, func, DECIMAL
+from sqlalchemy import TIMESTAMP, Column, Enum, ForeignKey, Index, Integer, String, func, DECIMAL
 from .database import Base
+from .spatial import encode_geohash
 from .schemas.user_schema import UserSchema
 from .schemas.pin_schema import PinSchema
 
@@ -12,18 +12,13 @@ class OwnershipType(enum.Enum):
 
 # sqlalchemy models
 class UserModel(Base):
-    def __init__(self, user: UserSchema):
+    def __init__(self, user: UserSchema, hashed_password: str):
+        # hash the password with app.hashing.password_hasher first, bcrypt is too slow to run here
         self.first_name = user.first_name
         self.last_name = user.last_name
         self.username = user.username
         self.email = user.email
-        self.hashed_password = self._hash_password(user.password)
-    
-    def _hash_password(self, password: str) -> str:
-        # hash the retrieved password
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password.encode("utf-8"), salt)
-        return hashed_password.decode("utf-8")
+        self.hashed_password = hashed_password
 
     __tablename__ = "users"
     user_id = Column(Integer, primary_key=True, nullable=False, index=True)
@@ -34,6 +29,9 @@ class UserModel(Base):
     hashed_password = Column(String, nullable=False)
     creation_date = Column(TIMESTAMP, nullable=True, server_default=func.current_timestamp())
     partnership_id = Column(Integer, ForeignKey("user_partnerships.partnership_id"), nullable=True, index=True)
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    # set by delete_user, the row is hidden and purged in the background (see app/purge.py)
+    removal_date = Column(TIMESTAMP, nullable=True)
 
     def __str__(self):
         return f"""
@@ -65,6 +63,7 @@ class PinModel(Base):
         self.latitude = pin.latitude
         self.longitude = pin.longitude
         self.details = pin.details
+        self.geo_cell = encode_geohash(pin.latitude, pin.longitude)
 
     __tablename__ = "pins"
     pin_id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
@@ -74,6 +73,13 @@ class PinModel(Base):
     longitude = Column(DECIMAL(9, 6), nullable=True, default=None)
     creation_date = Column(TIMESTAMP, server_default=func.current_timestamp(), nullable=True)
     details = Column(String(255), nullable=True, default=None)  # Added field
+    # geohash of (latitude, longitude), prefix lookups give us "pins in this cell"
+    geo_cell = Column(String(12), nullable=True, index=True)
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(),
+                        onupdate=func.current_timestamp(), index=True)
+    # set by delete_pin, the row stays behind as a tombstone so syncing clients see the removal.
+    # app/purge.py deletes it for good once it is older than the retention period
+    removal_date = Column(TIMESTAMP, nullable=True, index=True)
     
     def __str__(self):
         return f"""
@@ -88,9 +94,63 @@ class PinModel(Base):
 
 class UserPinModel(Base):
     __tablename__ = "user_pins"
+    __table_args__ = (
+        # covers the couple feed: find a user's live pins without touching the table rows
+        Index("ix_user_pins_user_ownership_removal_pin", "user_id", "ownership_type", "removal_date", "pin_id"),
+        # changes since a sync token, per user
+        Index("ix_user_pins_user_updated", "user_id", "updated_at"),
+    )
     user_pin_id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=True)
     pin_id = Column(Integer, ForeignKey("pins.pin_id"), nullable=True)
     ownership_type = Column(Enum(OwnershipType), nullable=False)
     creation_date = Column(TIMESTAMP, nullable=True, server_default=func.current_timestamp())
-    removal_date = Column(TIMESTAMP, nullable=True)
\ No newline at end of file
+    removal_date = Column(TIMESTAMP, nullable=True)
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+
+class MediaStatus(enum.Enum):
+    # upload URL handed out, bytes not confirmed yet
+    pending = "pending"
+    # object confirmed in S3, thumbnail not made yet
+    uploaded = "uploaded"
+    ready = "ready"
+    failed = "failed"
+
+# a photo attached to a pin. the bytes live in S3 (see app/media.py), this row tracks where and in what state
+class PinMediaModel(Base):
+    __tablename__ = "pin_media"
+    media_id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    pin_id = Column(Integer, ForeignKey("pins.pin_id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    object_key = Column(String(255), nullable=False, unique=True)
+    thumbnail_key = Column(String(255), nullable=True)
+    content_type = Column(String(100), nullable=False)
+    size_bytes = Column(Integer, nullable=True)
+    # set while a multipart upload is open
+    upload_id = Column(String(255), nullable=True)
+    status = Column(Enum(MediaStatus), nullable=False, default=MediaStatus.pending, index=True)
+    creation_date = Column(TIMESTAMP, nullable=True, server_default=func.current_timestamp())
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+
+# progress of purging a deleted user's rows, so the purge picks up where it left off after a restart (see app/purge.py)
+class UserPurgeModel(Base):
+    __tablename__ = "user_purges"
+    purge_id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    # no FK, the user row is the last thing purged
+    user_id = Column(Integer, nullable=False, index=True)
+    phase = Column(String(32), nullable=False, index=True)
+    rows_purged = Column(Integer, nullable=False, default=0)
+    creation_date = Column(TIMESTAMP, nullable=True, server_default=func.current_timestamp())
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    finished_date = Column(TIMESTAMP, nullable=True)
+
+class UserSessionModel(Base):
+    # one per login, access tokens carry the session_id so logout / delete_user can revoke them (see app/auth.py)
+    __tablename__ = "user_sessions"
+    session_id = Column(String(32), primary_key=True, nullable=False)
+    # no FK, sessions outlive the user row until they expire and get purged
+    user_id = Column(Integer, nullable=False, index=True)
+    creation_date = Column(TIMESTAMP, nullable=True, server_default=func.current_timestamp())
+    # UTC, from the app's clock, the same one the token's expiry is checked against
+    expires_date = Column(TIMESTAMP, nullable=False, index=True)
+    revoked_date = Column(TIMESTAMP, nullable=True, index=True)
@@ -0,0 +1,446 @@
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import os
+
+from typing import AsyncIterator, Optional
+from pydantic import ValidationError
+from sqlalchemy import and_, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .cache import cache, pin_key, user_pins_key
+from .clustering import pin_clusters
+from .database import SessionLocal
+from .models import OwnershipType, PinModel, UserPinModel
+from .pin_index import DUPLICATE_TOLERANCE_METERS, PinPoint, pin_index
+from .schemas.pin_schema import PinSchema
+from .spatial import GEOHASH_PRECISION, covering_cells, distance_meters, encode_geohash, radius_bounds
+
+# rows validated, de-duplicated and inserted per transaction
+BULK_CHUNK_SIZE = int(os.getenv("PIN_BULK_CHUNK_SIZE", "500"))
+# hard cap on rows per import request
+BULK_MAX_ROWS = int(os.getenv("PIN_BULK_MAX_ROWS", "50000"))
+# create_pin requests arriving close together are written as one batch (see PinWriteBatcher).
+# off by default: a lone request waits up to the window before it is written
+PIN_WRITE_BATCHING = os.getenv("PIN_WRITE_BATCHING", "false").lower() in ("1", "true", "yes")
+# how long the first request of a batch waits for others to join it
+PIN_WRITE_BATCH_WINDOW_MS = float(os.getenv("PIN_WRITE_BATCH_WINDOW_MS", "5"))
+# a batch this big is written right away, without waiting out the window
+PIN_WRITE_BATCH_MAX_ROWS = int(os.getenv("PIN_WRITE_BATCH_MAX_ROWS", "100"))
+
+CSV_COLUMNS = list(PinSchema.model_fields)
+
+
+class BulkImportError(Exception):
+    """
+    The body as a whole can't be read (bad JSON, missing CSV header, too many rows)
+    """
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_records(content_type: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[object]:
+    """
+    Read pin records out of a request body as they arrive
+
+    Args:
+        content_type: application/json (an array), application/x-ndjson, or text/csv with a header row.
+            CSV and NDJSON are read line by line, so a record can't span lines
+        chunks: the raw body, e.g. request.stream()
+
+    Returns:
+        AsyncIterator: one raw record per row (a dict, or whatever the line held)
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        async for line in _iter_lines(chunks):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield BulkImportError(f"invalid JSON: {e}")
+    elif media_type == "text/csv":
+        header = None
+        async for line in _iter_lines(chunks):
+            if not line.strip():
+                continue
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [value.strip() for value in values]
+                missing = set(CSV_COLUMNS) - set(header)
+                if missing:
+                    raise BulkImportError(f"CSV header is missing columns: {', '.join(sorted(missing))}")
+                continue
+            yield dict(zip(header, values))
+    else:
+        # a JSON array can't be parsed until it's all here
+        body = b"".join([chunk async for chunk in chunks])
+        try:
+            records = json.loads(body or b"[]")
+        except json.JSONDecodeError as e:
+            raise BulkImportError(f"invalid JSON: {e}")
+        if not isinstance(records, list):
+            raise BulkImportError("expected a JSON array of pins")
+        for record in records:
+            yield record
+
+
+class _SeenLocations:
+    """
+    Locations accepted so far in this import, bucketed by geohash cell for the tolerance check
+    """
+
+    def __init__(self):
+        self._cells: dict[str, list[tuple[float, float]]] = {}
+
+    def is_near(self, latitude: float, longitude: float, cells: list[str]) -> bool:
+        for cell in cells:
+            for seen_lat, seen_lon in self._cells.get(cell, ()):
+                if distance_meters(latitude, longitude, seen_lat, seen_lon) <= DUPLICATE_TOLERANCE_METERS:
+                    return True
+        return False
+
+    def add(self, latitude: float, longitude: float):
+        self._cells.setdefault(encode_geohash(latitude, longitude), []).append((latitude, longitude))
+
+
+def _neighbor_cells(pin: PinSchema) -> list[str]:
+    # every stored cell a pin within the tolerance could be in
+    return covering_cells(*radius_bounds(pin.latitude, pin.longitude, DUPLICATE_TOLERANCE_METERS), GEOHASH_PRECISION)
+
+
+async def _existing_locations(db: AsyncSession, cells: set[str]) -> _SeenLocations:
+    # every live pin stored in cells, one query
+    existing = _SeenLocations()
+    if cells:
+        result = await db.execute(
+            select(PinModel.latitude, PinModel.longitude)
+            .filter(and_(PinModel.geo_cell.in_(cells), PinModel.removal_date.is_(None)))
+        )
+        for row in result:
+            if row.latitude is not None and row.longitude is not None:
+                existing.add(float(row.latitude), float(row.longitude))
+    return existing
+
+
+def _pin_row(pin: PinSchema) -> dict:
+    return {
+        "user_id": pin.user_id,
+        "title": pin.title,
+        "latitude": pin.latitude,
+        "longitude": pin.longitude,
+        "details": pin.details,
+        "geo_cell": encode_geohash(pin.latitude, pin.longitude),
+    }
+
+
+async def _insert_pins(db: AsyncSession, rows: list[dict]) -> list[int]:
+    """
+    One multi-row INSERT for the chunk, returns the new pin ids in row order
+    """
+    if db.get_bind().dialect.insert_returning:
+        result = await db.execute(insert(PinModel).returning(PinModel.pin_id, sort_by_parameter_order=True), rows)
+        return list(result.scalars())
+    # MySQL has no RETURNING, and the ids of a multi-row INSERT aren't LAST_INSERT_ID() + i:
+    # with innodb_autoinc_lock_mode=2 (the MySQL 8 default) other inserts can take ids in
+    # between, and auto_increment_increment can space them out. they do go up in row order
+    # from LAST_INSERT_ID(), so read them back and match them to the rows
+    result = await db.execute(insert(PinModel).values(rows))
+    return await _inserted_pin_ids(db, rows, result.lastrowid)
+
+
+async def _inserted_pin_ids(db: AsyncSession, rows: list[dict], first_id: int) -> list[int]:
+    inserted = (await db.execute(
+        select(PinModel.pin_id, PinModel.user_id, PinModel.geo_cell, PinModel.title, PinModel.latitude, PinModel.longitude)
+        .filter(and_(PinModel.pin_id >= first_id,
+                     PinModel.user_id.in_({row["user_id"] for row in rows}),
+                     PinModel.geo_cell.in_({row["geo_cell"] for row in rows}),
+                     PinModel.removal_date.is_(None)))
+        .order_by(PinModel.pin_id)
+    )).all()
+    # (user_id, geo_cell, title) -> matching pins, lowest id first
+    candidates: dict[tuple, list] = {}
+    for pin in inserted:
+        candidates.setdefault((pin.user_id, pin.geo_cell, pin.title), []).append(pin)
+
+    pin_ids = []
+    for row in rows:
+        matches = candidates.get((row["user_id"], row["geo_cell"], row["title"]), [])
+        # latitude / longitude are stored with 6 decimals
+        match = next((pin for pin in matches
+                      if abs(float(pin.latitude) - row["latitude"]) <= 1e-6
+                      and abs(float(pin.longitude) - row["longitude"]) <= 1e-6), None)
+        if match is None:
+            # the caller rolls the chunk back rather than hand out a wrong id
+            raise RuntimeError("could not read back the ids of the inserted pins")
+        matches.remove(match)
+        pin_ids.append(match.pin_id)
+    return pin_ids
+
+
+async def _insert_user_pins(db: AsyncSession, owners: list[tuple[int, int]]):
+    # (user_id, pin_id) pairs. the after_pin_create trigger fills user_pins on MySQL, only add the rows it didn't
+    existing = set((await db.execute(
+        select(UserPinModel.pin_id).filter(UserPinModel.pin_id.in_([pin_id for _, pin_id in owners]))
+    )).scalars())
+    rows = [{"user_id": user_id, "pin_id": pin_id, "ownership_type": OwnershipType.primary}
+            for user_id, pin_id in owners if pin_id not in existing]
+    if rows:
+        await db.execute(insert(UserPinModel), rows)
+
+
+async def _import_chunk(db: AsyncSession, user_id: int, chunk: list[tuple[int, object]],
+                        seen: _SeenLocations, results: list[dict]):
+    candidates = []
+    for index, record in chunk:
+        if isinstance(record, BulkImportError):
+            results.append({"index": index, "status": "invalid", "error": str(record)})
+            continue
+        try:
+            pin = PinSchema.model_validate(record)
+        except ValidationError as e:
+            results.append({"index": index, "status": "invalid", "error": e.errors(include_url=False, include_context=False)})
+            continue
+        if pin.user_id != user_id:
+            results.append({"index": index, "status": "invalid", "error": "user_id does not match the route"})
+            continue
+        if not (-90 <= pin.latitude <= 90 and -180 <= pin.longitude <= 180):
+            results.append({"index": index, "status": "invalid", "error": "coordinates out of range"})
+            continue
+        candidates.append((index, pin, _neighbor_cells(pin)))
+
+    # one query for every existing pin near anything in the chunk
+    existing = await _existing_locations(db, {cell for _, _, cells in candidates for cell in cells})
+
+    accepted = []
+    for index, pin, cells in candidates:
+        if existing.is_near(pin.latitude, pin.longitude, cells):
+            results.append({"index": index, "status": "duplicate", "error": "Pin location already exist"})
+        elif seen.is_near(pin.latitude, pin.longitude, cells):
+            results.append({"index": index, "status": "duplicate", "error": "duplicate of an earlier row"})
+        else:
+            seen.add(pin.latitude, pin.longitude)
+            accepted.append((index, pin))
+
+    if not accepted:
+        return
+
+    rows = [_pin_row(pin) for _, pin in accepted]
+    try:
+        pin_ids = await _insert_pins(db, rows)
+        await _insert_user_pins(db, [(user_id, pin_id) for pin_id in pin_ids])
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        for index, _ in accepted:
+            results.append({"index": index, "status": "error", "error": f"Error creating pin: {e}"})
+        return
+
+    for (index, pin), pin_id in zip(accepted, pin_ids):
+        pin_index.add(PinPoint(pin_id, pin.user_id, pin.title, pin.latitude, pin.longitude))
+        pin_clusters.add(pin.user_id, pin_id, pin.latitude, pin.longitude)
+        results.append({"index": index, "status": "created", "pin_id": pin_id})
+
+
+async def import_pins(db: AsyncSession, user_id: int, records: AsyncIterator[object],
+                      chunk_size: int = BULK_CHUNK_SIZE) -> dict:
+    """
+    Create many pins for a user. Rows are processed in chunks: each chunk gets one
+    duplicate-check query, one multi-row insert for pins and one for user_pins, and
+    its own transaction, so a bad chunk doesn't undo the ones before it.
+
+    Args:
+        db: database session
+        user_id: owner of every pin in the import
+        records: raw rows, see iter_records
+        chunk_size: rows per transaction
+
+    Returns:
+        JSON Object: totals per status and a result per row, in input order
+    """
+    results: list[dict] = []
+    seen = _SeenLocations()
+    chunk: list[tuple[int, object]] = []
+    index = 0
+    async for record in records:
+        if index >= BULK_MAX_ROWS:
+            raise BulkImportError(f"too many rows, the limit is {BULK_MAX_ROWS}")
+        chunk.append((index, record))
+        index += 1
+        if len(chunk) >= chunk_size:
+            await _import_chunk(db, user_id, chunk, seen, results)
+            chunk = []
+    if chunk:
+        await _import_chunk(db, user_id, chunk, seen, results)
+
+    # the list changed. the new ids are dropped too, like create_pin does: get_pin only caches
+    # pins it read whole, but one that raced a chunk's commit isn't worth trusting
+    await cache.delete(user_pins_key(user_id),
+                       *(pin_key(result["pin_id"]) for result in results if result["status"] == "created"))
+    results.sort(key=lambda result: result["index"])
+    totals: dict[str, int] = {}
+    for result in results:
+        totals[result["status"]] = totals.get(result["status"], 0) + 1
+    return {"totals": totals, "results": results}
+
+
+class DuplicatePin(Exception):
+    """
+    There already is a pin within DUPLICATE_TOLERANCE_METERS of the new one
+    """
+
+
+class PinWriteBatcher:
+    """
+    Coalesces concurrent create_pin requests. the first request to arrive opens a batch
+    and waits up to window_ms for others to join (or until max_rows are in), then the
+    whole batch is written in one transaction: one duplicate-check query for every
+    location in it, one multi-row INSERT for pins and one for user_pins, one commit.
+    each request gets its own result back, its pin id or its own error.
+
+    Pins in the same batch are checked against each other too, in arrival order, so the
+    outcome is the one running the requests one after another would have given. a batch
+    that fails to write fails every request in it
+    """
+
+    def __init__(self, window_ms: float = PIN_WRITE_BATCH_WINDOW_MS, max_rows: int = PIN_WRITE_BATCH_MAX_ROWS):
+        self.window = window_ms / 1000
+        self.max_rows = max_rows
+        # (route user id, pin, future) of the batch that is still open
+        self._pending: list[tuple[int, PinSchema, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: set[asyncio.Task] = set()
+        self.batches = 0
+        self.rows = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+
+    async def submit(self, user_id: int, pin: PinSchema) -> int:
+        """
+        Queue a pin for the next batch and wait for it to be written
+
+        Args:
+            user_id: user id in the route's path, their reads stay on the primary after the write
+            pin: the new pin
+
+        Returns:
+            int: the new pin's id
+
+        Raises:
+            DuplicatePin: if a pin already exists at (about) the same location
+            Exception: whatever made the batch's transaction fail
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, pin, future))
+        if len(self._pending) >= self.max_rows:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        Close the open batch and start writing it
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            # the loop only keeps weak references to tasks
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def drain(self):
+        """
+        Write whatever is queued and wait for every batch in flight, see the app's lifespan
+        """
+        self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    async def _write(self, batch: list[tuple[int, PinSchema, asyncio.Future]]):
+        self.batches += 1
+        self.rows += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        accepted = []
+        try:
+            async with SessionLocal() as db:
+                # like get_db does for a single request (see app/replicas.py)
+                db.info["route_user_ids"] = sorted({user_id for user_id, _, _ in batch})
+                candidates = [(pin, future, _neighbor_cells(pin)) for _, pin, future in batch]
+                existing = await _existing_locations(db, {cell for _, _, cells in candidates for cell in cells})
+                seen = _SeenLocations()
+                for pin, future, cells in candidates:
+                    if existing.is_near(pin.latitude, pin.longitude, cells) or seen.is_near(pin.latitude, pin.longitude, cells):
+                        if not future.done():
+                            future.set_exception(DuplicatePin("Pin location already exist"))
+                    else:
+                        seen.add(pin.latitude, pin.longitude)
+                        accepted.append((pin, future))
+                if not accepted:
+                    return
+                pin_ids = await _insert_pins(db, [_pin_row(pin) for pin, _ in accepted])
+                await _insert_user_pins(db, [(pin.user_id, pin_id) for (pin, _), pin_id in zip(accepted, pin_ids)])
+                await db.commit()
+        except Exception as e:
+            self.failed_batches += 1
+            logging.error(f"Error writing a batch of {len(batch)} pins: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        await cache.delete(*{user_pins_key(pin.user_id) for pin, _ in accepted}, *(pin_key(pin_id) for pin_id in pin_ids))
+        for (pin, future), pin_id in zip(accepted, pin_ids):
+            pin_index.add(PinPoint(pin_id, pin.user_id, pin.title, pin.latitude, pin.longitude))
+            pin_clusters.add(pin.user_id, pin_id, pin.latitude, pin.longitude)
+            # the client may have gone away meanwhile, the pin is written either way
+            if not future.done():
+                future.set_result(pin_id)
+
+    def stats(self) -> dict:
+        return {"enabled": PIN_WRITE_BATCHING, "window_ms": self.window * 1000, "max_rows": self.max_rows,
+                "batches": self.batches, "rows": self.rows, "largest_batch": self.largest_batch,
+                "avg_batch": round(self.rows / self.batches, 2) if self.batches else 0.0,
+                "failed_batches": self.failed_batches}
+
+
+pin_writes = PinWriteBatcher()
+
+
+def export_row_csv(row) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(
+        ["" if value is None else value for value in (row._mapping[column] for column in CSV_COLUMNS)]
+    )
+    return buffer.getvalue()
+
+
+def csv_header() -> str:
+    return ",".join(CSV_COLUMNS) + "\n"
+
+
+def export_format(requested: Optional[str], accept: str) -> str:
+    """
+    Pick ndjson or csv from ?format= or the Accept header, ndjson by default
+    """
+    if requested:
+        return requested
+    return "csv" if "text/csv" in accept else "ndjson"
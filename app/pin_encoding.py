@@ -0,0 +1,170 @@
+import datetime
+import decimal
+
+from typing import Any, Iterable, Optional, Sequence
+from fastapi import Request, Response
+import msgpack
+
+# what clients put in Accept to get MessagePack instead of JSON. the response is always MSGPACK_MEDIA_TYPE
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/vnd.msgpack", "application/x-msgpack")
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+FORMAT_VERSION = 1
+
+# latitude / longitude are DECIMAL(9, 6), as integers of millionths of a degree they're exact
+COORDINATE_SCALE = 1_000_000
+# distances (get_pins_near) are sent in centimeters
+DISTANCE_SCALE = 100
+
+# how each pin column is encoded, columns not listed are sent as they are
+COLUMN_ENCODINGS = {
+    "pin_id": ("delta", 1),
+    "latitude": ("delta", COORDINATE_SCALE),
+    "longitude": ("delta", COORDINATE_SCALE),
+    "creation_date": ("epoch_delta", 1),
+    "updated_at": ("epoch_delta", 1),
+    "distance": ("plain", DISTANCE_SCALE),
+}
+
+
+def wants_msgpack(request: Request) -> bool:
+    """
+    Whether the client asked for MessagePack in its Accept header. JSON stays the default
+    """
+    for media_range in request.headers.get("accept", "").split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        if media_type.lower() in MSGPACK_MEDIA_TYPES and _quality(params) > 0:
+            return True
+    return False
+
+
+def _quality(params: list[str]) -> float:
+    # a media range's q parameter, 1 when it has none. a malformed one counts as 0 (not acceptable)
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_SECOND = datetime.timedelta(seconds=1)
+
+
+def _epoch(value) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    # naive database timestamps, counted as if they were UTC so clients get back the same wall clock
+    return (value - EPOCH) // ONE_SECOND
+
+
+def _deltas(values: list[Optional[int]]) -> list[Optional[int]]:
+    # differences to the previous value. nulls stay null and don't move the running value
+    deltas = []
+    previous = 0
+    for value in values:
+        if value is None:
+            deltas.append(None)
+        else:
+            deltas.append(value - previous)
+            previous = value
+    return deltas
+
+
+def _pack(columns: Sequence[str], data: list[list], extra: dict) -> bytes:
+    header = []
+    for index, name in enumerate(columns):
+        encoding, scale = COLUMN_ENCODINGS.get(name, ("plain", 1))
+        values = data[index]
+        if encoding == "epoch_delta":
+            values = _deltas([_epoch(value) for value in values])
+        elif scale != 1:
+            # round() works for floats and Decimals alike and always gives back an int
+            values = [round(value * scale) if value is not None else None for value in values]
+        elif values and isinstance(values[0], decimal.Decimal):
+            values = [float(value) if value is not None else None for value in values]
+        if encoding == "delta":
+            values = _deltas(values)
+        data[index] = values
+        header.append({"name": name, "encoding": encoding, "scale": scale})
+    count = len(data[0]) if data else 0
+    return msgpack.packb({"v": FORMAT_VERSION, "count": count, "columns": header, "data": data, **extra},
+                         use_bin_type=True, datetime=False)
+
+
+def encode_columns(columns: Sequence[str], rows: Iterable[Sequence[Any]], **extra) -> bytes:
+    """
+    Pins as one MessagePack map, column by column instead of row by row:
+
+        {"v": 1, "count": n, "columns": [{"name", "encoding", "scale"}, ...], "data": [[...], ...], **extra}
+
+    data holds one list per column, in the order of columns. the encodings are
+      plain        the values, as integers of value * scale when scale isn't 1 (e.g. distance in centimeters)
+      delta        integers: value * scale, each one minus the one before (the first minus 0).
+                   sorted ids and nearby coordinates turn into small numbers, which MessagePack
+                   stores in 1-3 bytes instead of 5-9
+      epoch_delta  timestamps as seconds since 1970 (the database's wall clock), delta encoded
+    nulls are sent as nil in every encoding. decode_columns is the reference decoder
+
+    Args:
+        columns: names of the values in each row
+        rows: tuples (or Row objects) of plain values, no ORM instances
+        extra: more top level keys, e.g. next_cursor for a page
+
+    Returns:
+        bytes: the MessagePack payload
+    """
+    data = [list(values) for values in zip(*rows)] or [[] for _ in columns]
+    return _pack(columns, data, extra)
+
+
+def encode_dicts(items: list[dict], columns: Sequence[str], **extra) -> bytes:
+    """
+    encode_columns for rows that are already dicts, e.g. cached listings
+    """
+    return _pack(columns, [[item.get(name) for item in items] for name in columns], extra)
+
+
+def decode_columns(payload: bytes) -> list[dict]:
+    """
+    Turn an encode_columns payload back into one dict per pin, what clients have to do
+    """
+    message = msgpack.unpackb(payload, raw=False)
+    columns = []
+    for spec, values in zip(message["columns"], message["data"]):
+        scale = spec["scale"]
+        if spec["encoding"] in ("delta", "epoch_delta"):
+            running = 0
+            decoded = []
+            for value in values:
+                if value is None:
+                    decoded.append(None)
+                else:
+                    running += value
+                    decoded.append(running)
+            values = decoded
+        if spec["encoding"] == "epoch_delta":
+            values = [datetime.datetime.utcfromtimestamp(value) if value is not None else None for value in values]
+        elif scale != 1:
+            values = [value / scale if value is not None else None for value in values]
+        columns.append((spec["name"], values))
+    return [{name: values[index] for name, values in columns} for index in range(message["count"])]
+
+
+def msgpack_etag(etag: str) -> str:
+    """
+    The ETag of the MessagePack version of a listing whose JSON ETag is etag. it has to differ,
+    caches keep one representation per ETag
+    """
+    return etag[:-1] + '-msgpack"'
+
+
+def msgpack_response(payload: bytes, etag: Optional[str] = None) -> Response:
+    headers = {"Vary": "Accept"}
+    if etag is not None:
+        headers["ETag"] = etag
+    return Response(content=payload, media_type=MSGPACK_MEDIA_TYPE, headers=headers)
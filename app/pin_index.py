@@ -0,0 +1,186 @@
+import os
+import time
+
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import PinModel
+from .spatial import count_covering_cells, covering_cells, distance_meters, encode_geohash, radius_bounds
+
+# cells kept in memory are geohash prefixes of this length, roughly 5km x 5km
+INDEX_PRECISION = 5
+# a viewport that needs more cells than this is answered straight from the database
+MAX_VIEWPORT_CELLS = 64
+
+CELL_TTL_SECONDS = float(os.getenv("PIN_CELL_TTL_SECONDS", "30"))
+MAX_CACHED_CELLS = int(os.getenv("PIN_MAX_CACHED_CELLS", "4096"))
+DUPLICATE_TOLERANCE_METERS = float(os.getenv("PIN_DUPLICATE_TOLERANCE_METERS", "1.0"))
+
+
+class PinPoint(NamedTuple):
+    pin_id: int
+    user_id: Optional[int]
+    title: Optional[str]
+    latitude: float
+    longitude: float
+
+
+def _point_from_row(row) -> PinPoint:
+    return PinPoint(row.pin_id, row.user_id, row.title, float(row.latitude), float(row.longitude))
+
+
+def _cell_of(point: PinPoint) -> str:
+    return encode_geohash(point.latitude, point.longitude, INDEX_PRECISION)
+
+
+def _in_bounds(point: PinPoint, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> bool:
+    return min_lat <= point.latitude <= max_lat and min_lon <= point.longitude <= max_lon
+
+
+class PinCellIndex:
+    """
+    In-process index of pins grouped by geohash cell.
+
+    Cells are loaded from the database on first use (a prefix scan on the indexed
+    pins.geo_cell column) and kept for CELL_TTL_SECONDS, so other workers' writes
+    show up once a cell expires. Writes made by this worker are applied right away.
+    """
+
+    def __init__(self, ttl_seconds: float = CELL_TTL_SECONDS, max_cells: int = MAX_CACHED_CELLS):
+        self.ttl_seconds = ttl_seconds
+        self.max_cells = max_cells
+        # cell -> (loaded_at, {pin_id: PinPoint})
+        self._cells: OrderedDict[str, tuple[float, dict[int, PinPoint]]] = OrderedDict()
+
+    def _fresh_cell(self, cell: str, now: float) -> Optional[dict[int, PinPoint]]:
+        entry = self._cells.get(cell)
+        if entry is None or now - entry[0] > self.ttl_seconds:
+            return None
+        self._cells.move_to_end(cell)
+        return entry[1]
+
+    async def _query_cells(self, db: AsyncSession, cells: list[str]) -> list[PinPoint]:
+        # LIKE 'prefix%' on an indexed column is a range scan, not a full table scan
+        result = await db.execute(
+            select(PinModel.pin_id, PinModel.user_id, PinModel.title, PinModel.latitude, PinModel.longitude)
+            .filter(and_(or_(*(PinModel.geo_cell.like(f"{cell}%") for cell in cells)),
+                         PinModel.removal_date.is_(None)))
+        )
+        return [_point_from_row(row) for row in result if row.latitude is not None and row.longitude is not None]
+
+    async def _load_cells(self, db: AsyncSession, cells: list[str], fresh: bool) -> list[dict[int, PinPoint]]:
+        now = time.monotonic()
+        loaded = {}
+        missing = []
+        for cell in cells:
+            points = None if fresh else self._fresh_cell(cell, now)
+            if points is None:
+                missing.append(cell)
+            else:
+                loaded[cell] = points
+
+        if missing:
+            fetched = {cell: {} for cell in missing}
+            for point in await self._query_cells(db, missing):
+                points = fetched.get(_cell_of(point))
+                if points is not None:
+                    points[point.pin_id] = point
+            for cell, points in fetched.items():
+                self._cells[cell] = (now, points)
+                self._cells.move_to_end(cell)
+                loaded[cell] = points
+            while len(self._cells) > self.max_cells:
+                self._cells.popitem(last=False)
+
+        return [loaded[cell] for cell in cells]
+
+    async def query_bbox(self, db: AsyncSession, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                         user_id: Optional[int] = None, fresh: bool = False) -> list[PinPoint]:
+        """
+        Pins inside a bounding box
+
+        Args:
+            db: database session, only used for cells that aren't cached
+            min_lat, min_lon, max_lat, max_lon: bounding box in degrees
+            user_id: only return pins owned by this user
+            fresh: ignore cached cells and reload them from the database
+
+        Returns:
+            list[PinPoint]: pins in the box
+        """
+        if count_covering_cells(min_lat, min_lon, max_lat, max_lon, INDEX_PRECISION) > MAX_VIEWPORT_CELLS:
+            return await self._query_large_bbox(db, min_lat, min_lon, max_lat, max_lon, user_id)
+
+        cells = covering_cells(min_lat, min_lon, max_lat, max_lon, INDEX_PRECISION)
+        points = []
+        for cell_points in await self._load_cells(db, cells, fresh):
+            for point in cell_points.values():
+                if (user_id is None or point.user_id == user_id) and _in_bounds(point, min_lat, min_lon, max_lat, max_lon):
+                    points.append(point)
+        return points
+
+    async def _query_large_bbox(self, db: AsyncSession, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                                user_id: Optional[int]) -> list[PinPoint]:
+        # zoomed far out: use coarser prefixes and let the database filter, skipping the cache
+        precision = INDEX_PRECISION - 1
+        while precision > 1 and count_covering_cells(min_lat, min_lon, max_lat, max_lon, precision) > MAX_VIEWPORT_CELLS:
+            precision -= 1
+        cells = covering_cells(min_lat, min_lon, max_lat, max_lon, precision)
+        query = select(PinModel.pin_id, PinModel.user_id, PinModel.title, PinModel.latitude, PinModel.longitude).filter(
+            and_(or_(*(PinModel.geo_cell.like(f"{cell}%") for cell in cells)),
+                 PinModel.latitude.between(min_lat, max_lat),
+                 PinModel.longitude.between(min_lon, max_lon),
+                 PinModel.removal_date.is_(None))
+        )
+        if user_id is not None:
+            query = query.filter(PinModel.user_id == user_id)
+        return [_point_from_row(row) for row in await db.execute(query)]
+
+    async def query_radius(self, db: AsyncSession, latitude: float, longitude: float, meters: float,
+                           user_id: Optional[int] = None, fresh: bool = False) -> list[tuple[PinPoint, float]]:
+        """
+        Pins within a distance of a point, closest first
+
+        Returns:
+            list[tuple[PinPoint, float]]: pins and their distance in meters
+        """
+        candidates = await self.query_bbox(db, *radius_bounds(latitude, longitude, meters), user_id=user_id, fresh=fresh)
+        matches = []
+        for point in candidates:
+            distance = distance_meters(latitude, longitude, point.latitude, point.longitude)
+            if distance <= meters:
+                matches.append((point, distance))
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    def add(self, point: PinPoint):
+        """
+        Record a pin this worker just created. Cells that aren't loaded are left alone,
+        they will pick the pin up from the database when they are.
+        """
+        entry = self._cells.get(_cell_of(point))
+        if entry is not None:
+            entry[1][point.pin_id] = point
+
+    def remove(self, pin_id: int):
+        """
+        Forget a pin this worker just deleted
+        """
+        for _, points in self._cells.values():
+            if points.pop(pin_id, None) is not None:
+                return
+
+    def remove_user(self, user_id: int):
+        """
+        Forget every cached pin owned by a deleted user
+        """
+        for _, points in self._cells.values():
+            for pin_id in [pin_id for pin_id, point in points.items() if point.user_id == user_id]:
+                del points[pin_id]
+
+    def clear(self):
+        self._cells.clear()
+
+
+pin_index = PinCellIndex()
@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import cProfile
+import datetime
+import logging
+import os
+import random
+import re
+import time
+
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+from fastapi import APIRouter
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from . import env  # noqa: F401  loads .env
+
+# statements slower than this are logged and kept for /slow-queries
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# how many slow statements /slow-queries keeps, oldest go first
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+# statements slower than this also get their plan captured with EXPLAIN, on a separate connection
+SLOW_QUERY_EXPLAIN_MS = float(os.getenv("SLOW_QUERY_EXPLAIN_MS", "500"))
+# the same statement is explained at most once per interval, and no more than
+# SLOW_QUERY_EXPLAIN_PER_MINUTE plans are captured per minute overall, so a slow database isn't made slower
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS", "300"))
+SLOW_QUERY_EXPLAIN_PER_MINUTE = int(os.getenv("SLOW_QUERY_EXPLAIN_PER_MINUTE", "6"))
+# stored statements are cut to this many characters (bulk inserts can be huge)
+SLOW_QUERY_MAX_STATEMENT_CHARS = 2000
+
+# where request profiles are written, one cProfile file per profiled request (open with pstats or snakeviz)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# requests sending "X-Profile: <PROFILE_TOKEN>" are profiled. empty turns the header off
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# fraction of requests profiled at random, e.g. 0.001
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# profile files kept in PROFILE_DIR, the oldest are deleted
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+EXPLAINABLE = ("select", "update", "delete", "with")
+
+# the ASGI scope of the request being handled, set by ProfilingMiddleware. the router
+# puts the matched route in it, that's how a statement knows which route ran it
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+
+
+def _route_of(scope: Optional[dict]) -> Optional[str]:
+    if scope is None:
+        return None
+    route = scope.get("route")
+    return route.path if route is not None else scope.get("path")
+
+
+def parameter_shape(parameters, executemany: bool):
+    """
+    What the parameters of a statement looked like, without their values (they can
+    be passwords or emails): type names, and for executemany how many rows there were
+    """
+    if executemany:
+        rows = list(parameters or ())
+        return {"rows": len(rows), "row": parameter_shape(rows[0], False) if rows else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__ if parameters is not None else None
+
+
+class SlowQueryLog:
+    """
+    The last SLOW_QUERY_LOG_SIZE statements that took longer than SLOW_QUERY_MS, with
+    the route that ran them, and a plan for the slowest ones (see instrument_engine)
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, explain_ms: float = SLOW_QUERY_EXPLAIN_MS,
+                 size: int = SLOW_QUERY_LOG_SIZE):
+        self.threshold = threshold_ms / 1000
+        self.explain_threshold = explain_ms / 1000
+        self.entries: deque[dict] = deque(maxlen=size)
+        # statement -> when it was last explained
+        self._explained: dict[str, float] = {}
+        # when the plans of the last minute were captured
+        self._recent_explains: deque[float] = deque()
+        self._explaining: set[asyncio.Task] = set()
+        self.slow_statements = 0
+        self.explains = 0
+        self.explains_skipped = 0
+
+    def record(self, engine: AsyncEngine, statement: str, parameters, executemany: bool, elapsed: float):
+        route = _route_of(current_scope.get())
+        entry = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "route": route,
+            "duration_ms": round(elapsed * 1000, 2),
+            "statement": " ".join(statement.split())[:SLOW_QUERY_MAX_STATEMENT_CHARS],
+            "parameters": parameter_shape(parameters, executemany),
+            "plan": None,
+        }
+        self.entries.append(entry)
+        self.slow_statements += 1
+        logging.warning(f"slow query ({entry['duration_ms']} ms, {route}): {entry['statement'][:300]}")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # a plain synchronous engine, nothing to run the EXPLAIN on
+            return
+        if elapsed >= self.explain_threshold and not executemany and self._may_explain(entry["statement"]):
+            # a new context, or the EXPLAIN would be counted towards the request that ran the statement
+            task = loop.create_task(self._explain(engine, statement, parameters, entry), context=contextvars.Context())
+            self._explaining.add(task)
+            task.add_done_callback(self._explaining.discard)
+
+    def _may_explain(self, statement: str) -> bool:
+        if not statement.lower().startswith(EXPLAINABLE):
+            return False
+        now = time.monotonic()
+        while self._recent_explains and now - self._recent_explains[0] > 60:
+            self._recent_explains.popleft()
+        last = self._explained.get(statement)
+        if (last is not None and now - last < SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS) \
+                or len(self._recent_explains) >= SLOW_QUERY_EXPLAIN_PER_MINUTE:
+            self.explains_skipped += 1
+            return False
+        if len(self._explained) >= 1000:
+            self._explained = {key: at for key, at in self._explained.items() if now - at < SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS}
+        self._explained[statement] = now
+        self._recent_explains.append(now)
+        return True
+
+    async def _explain(self, engine: AsyncEngine, statement: str, parameters, entry: dict):
+        # sqlite only explains plans with EXPLAIN QUERY PLAN, plain EXPLAIN lists its bytecode
+        prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+        try:
+            async with engine.connect() as connection:
+                result = await connection.exec_driver_sql(prefix + statement, parameters)
+                entry["plan"] = [dict(row._mapping) for row in result]
+            self.explains += 1
+            logging.warning(f"plan for slow query ({entry['route']}): {entry['plan']}")
+        except Exception as e:
+            entry["plan"] = f"EXPLAIN failed: {e}"
+
+    def stats(self) -> dict:
+        return {"threshold_ms": self.threshold * 1000, "explain_threshold_ms": self.explain_threshold * 1000,
+                "slow_statements": self.slow_statements, "explains": self.explains,
+                "explains_skipped": self.explains_skipped}
+
+
+slow_queries = SlowQueryLog()
+
+
+def instrument_engine(engine: AsyncEngine):
+    """
+    Time every statement with engine events and hand the slow ones to slow_queries
+    """
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # on the execution context like app/metrics.py, a statement that raises leaves nothing behind
+        context.slow_query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.slow_query_start
+        if elapsed >= slow_queries.threshold and not statement.startswith("EXPLAIN"):
+            slow_queries.record(engine, statement, parameters, executemany, elapsed)
+
+
+class RequestProfiler:
+    """
+    Profiles whole requests with cProfile and writes each one to PROFILE_DIR, for when
+    the slow part of a route isn't a statement. a request is profiled when it sends
+    X-Profile with PROFILE_TOKEN, or at random with PROFILE_SAMPLE_RATE.
+
+    cProfile sees everything running on the event loop thread, so a profile also holds
+    whatever other requests did while this one was awaiting. one request is profiled
+    at a time, the others run normally
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, token: str = PROFILE_TOKEN,
+                 sample_rate: float = PROFILE_SAMPLE_RATE, max_files: int = PROFILE_MAX_FILES):
+        self.directory = directory
+        self.token = token
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.active = False
+        self.profiled = 0
+        self.skipped = 0
+
+    def wanted(self, scope: dict) -> bool:
+        if self.token:
+            for name, value in scope.get("headers", ()):
+                if name == b"x-profile":
+                    return value.decode("latin-1") == self.token
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _write(self, profile: cProfile.Profile, path: str):
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(path)
+        files = sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".prof"))
+        for old in files[:max(0, len(files) - self.max_files)]:
+            os.remove(old)
+
+    async def save(self, profile: cProfile.Profile, scope: dict, elapsed: float) -> str:
+        """
+        Write a request's profile to disk, named so the files sort by time
+
+        Returns:
+            str: the file's path
+        """
+        route = re.sub(r"[^A-Za-z0-9]+", "_", _route_of(scope) or "unmatched").strip("_") or "root"
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 10**9:09d}-{scope['method']}-{route}-{round(elapsed * 1000)}ms.prof"
+        path = os.path.join(self.directory, name)
+        # pstats writes with plain blocking file IO
+        await asyncio.to_thread(self._write, profile, path)
+        self.profiled += 1
+        return path
+
+    def stats(self) -> dict:
+        return {"directory": self.directory, "header_enabled": bool(self.token), "sample_rate": self.sample_rate,
+                "profiled": self.profiled, "skipped": self.skipped}
+
+
+request_profiler = RequestProfiler()
+
+
+class ProfilingMiddleware:
+    """
+    Plain ASGI middleware: remembers each request's scope for the slow query log and
+    profiles the requests request_profiler picks
+    """
+
+    def __init__(self, app, profiler: RequestProfiler = request_profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = current_scope.set(scope)
+        try:
+            if not self.profiler.wanted(scope):
+                await self.app(scope, receive, send)
+                return
+            if self.profiler.active:
+                self.profiler.skipped += 1
+                await self.app(scope, receive, send)
+                return
+
+            self.profiler.active = True
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                profile.disable()
+                self.profiler.active = False
+                path = await self.profiler.save(profile, scope, time.perf_counter() - start)
+                logging.info(f"profiled {scope['method']} {scope['path']}: {path}")
+        finally:
+            current_scope.reset(token)
+
+
+router = APIRouter()
+
+
+@router.get("/slow-queries")
+async def get_slow_queries(limit: int = 50):
+    """
+    The slowest recent statements this worker ran, newest first
+
+    Args:
+        limit: how many to return
+
+    Return:
+        JSON Object: the log's settings and counters, the profiler's, and the entries
+        (time, route, duration_ms, statement, parameter types and the EXPLAIN plan if one was captured)
+    """
+    entries = list(slow_queries.entries)[-limit:][::-1] if limit > 0 else []
+    return {**slow_queries.stats(), "profiler": request_profiler.stats(), "entries": entries}
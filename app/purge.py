@@ -0,0 +1,340 @@
+import asyncio
+import datetime
+import logging
+import os
+
+from fastapi import APIRouter
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import env  # noqa: F401  loads .env
+from .cache import cache, pin_key, user_pins_key
+from .database import SessionLocal, db_now
+from .media import PENDING_UPLOAD_EXPIRY_SECONDS, MediaError, abort_upload, delete_objects
+from .models import MediaStatus, PinMediaModel, PinModel, UserModel, UserPartnershipModel, UserPinModel, UserPurgeModel, UserSessionModel
+
+# run the purge in this worker. off by default so a fleet of API workers doesn't run one
+# each, turn it on in exactly one process (make run does, it is a single worker)
+PURGE_ENABLED = os.getenv("PURGE_ENABLED", "false").lower() in ("1", "true", "yes")
+# how long tombstoned pins (and their user_pins rows) are kept before they are deleted for good.
+# sync tokens older than this can't be answered with just the changes anymore (see app/sync.py)
+PURGE_RETENTION_SECONDS = int(os.getenv("PURGE_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# rows deleted per transaction, small enough that each one holds its locks only briefly
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+# pause after every batch, leaves room for the request traffic on the same tables
+PURGE_BATCH_PAUSE_SECONDS = float(os.getenv("PURGE_BATCH_PAUSE_SECONDS", "0.1"))
+# how often the purge looks for work when nothing wakes it up
+PURGE_INTERVAL_SECONDS = float(os.getenv("PURGE_INTERVAL_SECONDS", "60"))
+
+# what purging a deleted user goes through, in order. user_purges.phase holds the current one
+USER_PURGE_PHASES = (
+    # tombstone the user's pins and every user_pins row for them, so partners see them go on their next sync
+    "tombstone_pins",
+    # the tombstoned pins are purged like any other once they are past the retention period
+    "wait_for_pins",
+    # what is left: the user's own user_pins rows, their partnership (already dissolved by
+    # delete_user, this catches purges started before it did) and the user row itself
+    "user_pins",
+    "partnerships",
+    "user",
+    "done",
+)
+
+
+async def dissolve_partnership(db: AsyncSession, user_id: int) -> list[int]:
+    """
+    Delete a user's partnership, so their partner is single again right away. the caller commits
+
+    Returns:
+        list: the partners' user ids, their cached user rows are stale once this is committed
+    """
+    partnerships = (await db.execute(
+        select(UserPartnershipModel.partnership_id, UserPartnershipModel.user_id_1, UserPartnershipModel.user_id_2)
+        .filter(or_(UserPartnershipModel.user_id_1 == user_id, UserPartnershipModel.user_id_2 == user_id))
+    )).all()
+    if not partnerships:
+        return []
+    partnership_ids = [partnership.partnership_id for partnership in partnerships]
+    # the partnership trigger does this on MySQL, do it here too so the delete can't trip the FK
+    await db.execute(update(UserModel).filter(UserModel.partnership_id.in_(partnership_ids))
+                     .values(partnership_id=None))
+    await db.execute(delete(UserPartnershipModel).filter(UserPartnershipModel.partnership_id.in_(partnership_ids)))
+    return [partner_id for partnership in partnerships
+            for partner_id in (partnership.user_id_1, partnership.user_id_2)
+            if partner_id is not None and partner_id != user_id]
+
+
+class Purger:
+    """
+    Deletes what delete_user and delete_pin only tombstoned, in bounded batches with a
+    pause in between, so no request waits on a big delete.
+
+    Every batch is its own transaction and the progress lives in the database (the
+    tombstones themselves, and user_purges for users), so after a restart the purge
+    carries on from the last committed batch. running the same batch twice is harmless
+    """
+
+    def __init__(self, retention_seconds: int = PURGE_RETENTION_SECONDS, batch_size: int = PURGE_BATCH_SIZE,
+                 batch_pause: float = PURGE_BATCH_PAUSE_SECONDS, interval: float = PURGE_INTERVAL_SECONDS):
+        self.retention_seconds = retention_seconds
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self._wake = asyncio.Event()
+        self.batches = 0
+        self.rows_purged: dict[str, int] = {}
+        self.users_purged = 0
+        self.last_error = None
+
+    def wake(self):
+        """
+        Start a round now instead of at the next interval, e.g. right after delete_user
+        """
+        self._wake.set()
+
+    async def run_forever(self):
+        """
+        Purge every interval (or when woken) until cancelled, see the app's lifespan
+        """
+        while True:
+            try:
+                await self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logging.error(f"Error purging deleted rows: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def run_once(self):
+        """
+        One round: purge expired pin tombstones, login sessions and abandoned uploads, then move every open user purge as far as it can go
+        """
+        await self.purge_expired_pins()
+        await self.purge_expired_sessions()
+        await self.purge_expired_uploads()
+        async with SessionLocal() as db:
+            user_ids = (await db.execute(
+                select(UserPurgeModel.user_id).filter(UserPurgeModel.phase != "done").order_by(UserPurgeModel.purge_id)
+            )).scalars().all()
+        for user_id in user_ids:
+            await self.purge_user(user_id)
+
+    async def _pause(self):
+        self.batches += 1
+        await asyncio.sleep(self.batch_pause)
+
+    def _count(self, table: str, rows: int):
+        self.rows_purged[table] = self.rows_purged.get(table, 0) + rows
+
+    async def purge_expired_pins(self) -> int:
+        """
+        Delete pins that were tombstoned more than retention_seconds ago, with their
+        user_pins rows, photos (rows and S3 objects)
+
+        Returns:
+            int: pins deleted
+        """
+        purged = 0
+        while True:
+            async with SessionLocal() as db:
+                cutoff = await db_now(db) - datetime.timedelta(seconds=self.retention_seconds)
+                pin_ids = (await db.execute(
+                    select(PinModel.pin_id)
+                    .filter(PinModel.removal_date < cutoff)
+                    .order_by(PinModel.pin_id)
+                    .limit(self.batch_size)
+                )).scalars().all()
+                if not pin_ids:
+                    return purged
+                await self._delete_pins(db, pin_ids)
+                await db.commit()
+            purged += len(pin_ids)
+            await self._pause()
+
+    async def purge_expired_sessions(self) -> int:
+        """
+        Delete login sessions whose tokens have expired, revoked or not
+
+        Returns:
+            int: sessions deleted
+        """
+        purged = 0
+        while True:
+            async with SessionLocal() as db:
+                # expires_date is UTC from the app's clock, see app/auth.py
+                session_ids = (await db.execute(
+                    select(UserSessionModel.session_id)
+                    .filter(UserSessionModel.expires_date < datetime.datetime.utcnow())
+                    .limit(self.batch_size)
+                )).scalars().all()
+                if not session_ids:
+                    return purged
+                rows = (await db.execute(delete(UserSessionModel).filter(UserSessionModel.session_id.in_(session_ids)))).rowcount
+                self._count("user_sessions", rows)
+                await db.commit()
+            purged += len(session_ids)
+            await self._pause()
+
+    async def purge_expired_uploads(self) -> int:
+        """
+        Give up on uploads still pending PENDING_UPLOAD_EXPIRY_SECONDS after create_pin_media:
+        abort their multipart uploads, delete whatever was PUT and the rows
+
+        Returns:
+            int: media rows deleted
+        """
+        purged = 0
+        while True:
+            async with SessionLocal() as db:
+                cutoff = await db_now(db) - datetime.timedelta(seconds=PENDING_UPLOAD_EXPIRY_SECONDS)
+                media = (await db.execute(
+                    select(PinMediaModel.media_id, PinMediaModel.object_key, PinMediaModel.upload_id)
+                    .filter(and_(PinMediaModel.status == MediaStatus.pending, PinMediaModel.creation_date < cutoff))
+                    .order_by(PinMediaModel.media_id)
+                    .limit(self.batch_size)
+                )).all()
+                if not media:
+                    return purged
+                # the ones S3 wouldn't abort stay for the next round
+                aborted = [row for row in media if await abort_upload(row.object_key, row.upload_id)]
+                if not aborted:
+                    return purged
+                await delete_objects([row.object_key for row in aborted])
+                rows = (await db.execute(delete(PinMediaModel).filter(
+                    PinMediaModel.media_id.in_([row.media_id for row in aborted])))).rowcount
+                self._count("pin_media", rows)
+                await db.commit()
+            purged += len(aborted)
+            if len(aborted) < len(media):
+                return purged
+            await self._pause()
+
+    async def _delete_pins(self, db: AsyncSession, pin_ids: list[int]):
+        media = (await db.execute(
+            select(PinMediaModel.object_key, PinMediaModel.thumbnail_key, PinMediaModel.upload_id)
+            .filter(PinMediaModel.pin_id.in_(pin_ids))
+        )).all()
+        for row in media:
+            # before the rows, like the objects below
+            if not await abort_upload(row.object_key, row.upload_id):
+                raise MediaError(f"could not abort the upload of {row.object_key}")
+        keys = [key for row in media for key in (row.object_key, row.thumbnail_key) if key]
+        if keys:
+            # before the rows: if this fails, the rows are still there for the next try
+            await delete_objects(keys)
+        self._count("pin_media", (await db.execute(delete(PinMediaModel).filter(PinMediaModel.pin_id.in_(pin_ids)))).rowcount)
+        self._count("user_pins", (await db.execute(delete(UserPinModel).filter(UserPinModel.pin_id.in_(pin_ids)))).rowcount)
+        self._count("pins", (await db.execute(delete(PinModel).filter(PinModel.pin_id.in_(pin_ids)))).rowcount)
+
+    async def purge_user(self, user_id: int):
+        """
+        Run a deleted user's purge from its current phase, as far as it can go this round
+        """
+        while True:
+            async with SessionLocal() as db:
+                purge = (await db.execute(
+                    select(UserPurgeModel).filter(and_(UserPurgeModel.user_id == user_id, UserPurgeModel.phase != "done"))
+                )).scalars().first()
+                if purge is None:
+                    return
+                rows, finished, stale_keys = await self._user_batch(db, user_id, purge.phase)
+                purge.rows_purged += rows
+                if finished:
+                    purge.phase = USER_PURGE_PHASES[USER_PURGE_PHASES.index(purge.phase) + 1]
+                    if purge.phase == "done":
+                        purge.finished_date = func.current_timestamp()
+                # the progress is committed with the batch it describes
+                await db.commit()
+                phase = purge.phase
+            if stale_keys:
+                await cache.delete(*stale_keys)
+            if phase == "done":
+                self.users_purged += 1
+                logging.info(f"purged user {user_id}")
+                return
+            if phase == "wait_for_pins" and not finished and rows == 0:
+                # the pins are still there, nothing to do until they are past the retention period
+                return
+            if rows:
+                await self._pause()
+
+    async def _user_batch(self, db: AsyncSession, user_id: int, phase: str) -> tuple[int, bool, list[str]]:
+        # one batch of phase. returns the rows it touched, whether the phase is done
+        # and the cache keys to drop once the batch is committed
+        if phase == "tombstone_pins":
+            pin_ids = (await db.execute(
+                select(PinModel.pin_id)
+                .filter(and_(PinModel.user_id == user_id, PinModel.removal_date.is_(None)))
+                .limit(self.batch_size)
+            )).scalars().all()
+            if not pin_ids:
+                return 0, True, []
+            await db.execute(update(PinModel).filter(PinModel.pin_id.in_(pin_ids))
+                             .values(removal_date=func.current_timestamp()))
+            await db.execute(update(UserPinModel)
+                             .filter(and_(UserPinModel.pin_id.in_(pin_ids), UserPinModel.removal_date.is_(None)))
+                             .values(removal_date=func.current_timestamp()))
+            return len(pin_ids), False, [user_pins_key(user_id), *(pin_key(pin_id) for pin_id in pin_ids)]
+
+        if phase == "wait_for_pins":
+            # pins created by requests that raced delete_user get tombstoned too, or we'd wait on them forever
+            rows, tombstoned_all, stale_keys = await self._user_batch(db, user_id, "tombstone_pins")
+            if not tombstoned_all:
+                return rows, False, stale_keys
+            pin_left = (await db.execute(select(PinModel.pin_id).filter(PinModel.user_id == user_id).limit(1))).first()
+            return 0, pin_left is None, []
+
+        if phase == "user_pins":
+            ids = (await db.execute(
+                select(UserPinModel.user_pin_id).filter(UserPinModel.user_id == user_id).limit(self.batch_size)
+            )).scalars().all()
+            if not ids:
+                return 0, True, []
+            rows = (await db.execute(delete(UserPinModel).filter(UserPinModel.user_pin_id.in_(ids)))).rowcount
+            self._count("user_pins", rows)
+            return rows, False, []
+
+        if phase == "partnerships":
+            rows = len(await dissolve_partnership(db, user_id))
+            self._count("user_partnerships", rows)
+            return rows, True, []
+
+        if phase == "user":
+            rows = (await db.execute(delete(UserModel).filter(UserModel.user_id == user_id))).rowcount
+            self._count("users", rows)
+            return rows, True, []
+
+        raise ValueError(f"unknown purge phase: {phase}")
+
+    def stats(self) -> dict:
+        return {"enabled": PURGE_ENABLED, "retention_seconds": self.retention_seconds, "batch_size": self.batch_size,
+                "batches": self.batches, "rows_purged": self.rows_purged, "users_purged": self.users_purged,
+                "last_error": self.last_error}
+
+
+purger = Purger()
+
+
+router = APIRouter()
+
+
+@router.get("/purge-status")
+async def purge_status():
+    """
+    How the background purge is doing
+
+    Return:
+        JSON Object: this worker's purge counters, plus every user purge that hasn't finished and its phase
+    """
+    async with SessionLocal() as db:
+        open_purges = (await db.execute(
+            select(UserPurgeModel.user_id, UserPurgeModel.phase, UserPurgeModel.rows_purged,
+                   UserPurgeModel.creation_date, UserPurgeModel.updated_at)
+            .filter(UserPurgeModel.phase != "done")
+            .order_by(UserPurgeModel.purge_id)
+            .limit(100)
+        )).all()
+    return {**purger.stats(), "open_user_purges": [dict(row._mapping) for row in open_purges]}
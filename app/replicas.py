@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+from collections import OrderedDict
+from typing import Iterable, Optional
+from fastapi import APIRouter, Request
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+from . import env  # noqa: F401  loads .env
+from .database import SessionLocal, get_engine, make_engine, route_user_ids
+
+# comma separated read replica URLs, same driver as DATABASE_URL. empty: every read goes to the primary
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# how often each replica is probed with SELECT 1, and how long a probe may take
+REPLICA_CHECK_INTERVAL_SECONDS = float(os.getenv("REPLICA_CHECK_INTERVAL_SECONDS", "5"))
+REPLICA_CHECK_TIMEOUT_SECONDS = float(os.getenv("REPLICA_CHECK_TIMEOUT_SECONDS", "2"))
+# after a write, reads for the users in its path stay on the primary this long.
+# keep it above the replicas' usual lag
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+READ_YOUR_WRITES_MAX_USERS = int(os.getenv("READ_YOUR_WRITES_MAX_USERS", "100000"))
+
+
+class Replica:
+    """
+    One read replica and what the last health check found
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.reads = 0
+        self._engine: Optional[AsyncEngine] = None
+
+    @property
+    def engine(self) -> AsyncEngine:
+        # created on first use, like the primary's
+        if self._engine is None:
+            self._engine = make_engine(self.url)
+        return self._engine
+
+    async def _probe(self):
+        async with self.engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    async def check(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._probe(), timeout)
+        except Exception as e:
+            if self.healthy:
+                logging.warning(f"read replica {self.name} is down, reads fall back: {e}")
+            self.healthy = False
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            return
+        if not self.healthy:
+            logging.info(f"read replica {self.name} is back")
+        self.healthy = True
+        self.last_error = None
+
+    @property
+    def name(self) -> str:
+        # the URL without its credentials, for logs and /check-replicas
+        return self.engine.url.render_as_string(hide_password=True)
+
+    async def dispose(self):
+        if self._engine is not None:
+            await self._engine.dispose()
+
+
+class ReplicaRouter:
+    """
+    Picks the engine a read-only request runs on: the healthy replicas in turn, or the
+    primary when there are none, when all of them failed their last check, or when one
+    of the request's users wrote something in the last READ_YOUR_WRITES_SECONDS.
+
+    Writes are remembered per worker, like the cache, so with several workers a read
+    right after a write can still land on a replica through another worker.
+    """
+
+    def __init__(self, urls: Iterable[str] = DATABASE_REPLICA_URLS, sticky_seconds: float = READ_YOUR_WRITES_SECONDS,
+                 max_sticky_users: int = READ_YOUR_WRITES_MAX_USERS):
+        self.replicas = [Replica(url) for url in urls]
+        self.sticky_seconds = sticky_seconds
+        self.max_sticky_users = max_sticky_users
+        # user id -> monotonic time their reads may go back to the replicas. every write pushes the
+        # user to the end, so the entries are ordered by expiry and the oldest are always in front
+        self._recent_writers: OrderedDict[int, float] = OrderedDict()
+        self._next = itertools.count()
+        self.primary_reads = 0
+        self.sticky_reads = 0
+
+    def mark_write(self, user_ids: Iterable[int]):
+        """
+        Keep reads for these users on the primary for the next sticky_seconds
+        """
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        for user_id in user_ids:
+            self._recent_writers[user_id] = now + self.sticky_seconds
+            self._recent_writers.move_to_end(user_id)
+        while self._recent_writers:
+            user_id, until = next(iter(self._recent_writers.items()))
+            if until > now and len(self._recent_writers) <= self.max_sticky_users:
+                break
+            del self._recent_writers[user_id]
+
+    def is_sticky(self, user_ids: Iterable[int]) -> bool:
+        now = time.monotonic()
+        return any(self._recent_writers.get(user_id, 0.0) > now for user_id in user_ids)
+
+    def engine_for_read(self, user_ids: Iterable[int] = ()) -> AsyncEngine:
+        """
+        Args:
+            user_ids: users whose data the read is about, usually route_user_ids(request)
+
+        Returns:
+            AsyncEngine: a replica's, or the primary's
+        """
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            self.primary_reads += 1
+            return get_engine()
+        if self.is_sticky(user_ids):
+            self.sticky_reads += 1
+            return get_engine()
+        replica = healthy[next(self._next) % len(healthy)]
+        replica.reads += 1
+        return replica.engine
+
+    async def check(self):
+        await asyncio.gather(*(replica.check(REPLICA_CHECK_TIMEOUT_SECONDS) for replica in self.replicas))
+
+    async def run_health_checks(self, interval: float = REPLICA_CHECK_INTERVAL_SECONDS):
+        """
+        Probe every replica each interval until cancelled, see the app's lifespan
+        """
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.dispose()
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [{"url": replica.name, "healthy": replica.healthy, "reads": replica.reads,
+                          "failed_checks": replica.failures, "last_error": replica.last_error}
+                         for replica in self.replicas],
+            "primary_reads": self.primary_reads,
+            "sticky_reads": self.sticky_reads,
+            "sticky_users": len(self._recent_writers),
+            "read_your_writes_seconds": self.sticky_seconds,
+        }
+
+
+replica_router = ReplicaRouter()
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_writers(session: Session):
+    # get_db tags its sessions with the user ids in the route's path; a commit means they wrote
+    user_ids = session.info.get("route_user_ids")
+    if user_ids:
+        replica_router.mark_write(user_ids)
+
+
+def read_engine(request: Request) -> AsyncEngine:
+    """
+    The engine a read-only request should use, for code that opens its own session (streaming)
+    """
+    return replica_router.engine_for_read(route_user_ids(request))
+
+
+def reads_primary(db) -> bool:
+    """
+    Whether db's reads come from the primary. a replica can lag behind a delete or an
+    update, so only these reads may fill the shared cache
+    """
+    return db.bind is get_engine()
+
+
+async def get_read_db(request: Request):
+    """
+    Dependency like get_db for routes that only read: the session is on a replica
+    when one is healthy and the route's users haven't just written
+
+    Returns:
+        AsyncSession: database session, closed once the request is done
+    """
+    async with SessionLocal(bind=read_engine(request)) as db:
+        yield db
+
+
+router = APIRouter()
+
+
+@router.get("/check-replicas")
+async def check_replicas():
+    """
+    Probe every read replica now and report where reads have been going
+
+    Return:
+        JSON Object: each replica's health and read count, plus reads kept on the primary
+    """
+    await replica_router.check()
+    return replica_router.stats()
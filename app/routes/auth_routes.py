@@ -0,0 +1,82 @@
+import logging
+import time
+
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import TokenClaims, create_session, current_session, forget_sessions, revoke_sessions, sessions
+from app.database import get_db
+from app.hashing import password_hasher
+from app.models import *
+from app.schemas.auth_schema import LoginSchema, TokenSchema
+
+router = APIRouter()
+
+# checked against when the login doesn't exist, so a wrong login takes as long as a wrong password
+_missing_user_hash: Optional[str] = None
+
+
+@router.post("/login", response_model=TokenSchema)
+async def login(credentials: LoginSchema, db: AsyncSession = Depends(get_db)):
+    """
+    log a user in with their username (or email) and password.
+    bcrypt runs on the password hasher's threads, not the event loop
+
+    Args:
+        credentials: login (username or email) and password
+        db: database session
+
+    Return:
+        JSON Object: a short lived access token, send it as "Authorization: Bearer <token>"
+
+    Raise:
+        HTTPException: 401 if the login or password is wrong
+    """
+    global _missing_user_hash
+    user = (await db.execute(
+        select(UserModel.user_id, UserModel.hashed_password)
+        .filter(and_(or_(UserModel.username == credentials.login, UserModel.email == credentials.login),
+                     UserModel.removal_date.is_(None)))
+    )).first()
+    if user is None:
+        if _missing_user_hash is None:
+            _missing_user_hash = await password_hasher.hash("not a password")
+        await password_hasher.verify(credentials.password, _missing_user_hash)
+        raise HTTPException(status_code=401, detail="wrong login or password")
+    if not await password_hasher.verify(credentials.password, user.hashed_password):
+        raise HTTPException(status_code=401, detail="wrong login or password")
+
+    token, expires = create_session(db, user.user_id)
+    await db.commit()
+    return {"access_token": token, "expires_in": expires - int(time.time()), "user_id": user.user_id}
+
+
+@router.post("/logout")
+async def logout(claims: Optional[TokenClaims] = Depends(current_session), db: AsyncSession = Depends(get_db)):
+    """
+    revoke the session of the request's token. this worker stops accepting it right away,
+    the others within AUTH_REVOCATION_REFRESH_SECONDS
+
+    Return:
+        JSON Object: success message
+
+    Raise:
+        HTTPException: 401 without a valid token
+    """
+    if claims is None:
+        raise HTTPException(status_code=401, detail="not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    revoked = await revoke_sessions(db, claims.user_id, claims.session_id)
+    await db.commit()
+    forget_sessions(revoked)
+    logging.info(f"user {claims.user_id} logged out")
+    return JSONResponse(status_code=200, content={"success": "logged out"})
+
+
+@router.get("/auth-stats")
+async def auth_stats():
+    """
+    This worker's token checks: verified tokens cached, revoked sessions known, hits / misses / rejections
+    """
+    return sessions.stats()
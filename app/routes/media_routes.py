@@ -0,0 +1,182 @@
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_db
+from app.replicas import get_read_db
+from app.media import MediaError, abort_upload, check_upload, download_urls, finish_upload, media_to_dict, new_object_key, start_upload, thumbnail_workers
+from app.models import *
+from app.schemas.media_schema import MediaCompleteSchema, MediaUploadSchema, MediaUrlsRequestSchema
+
+router = APIRouter()
+
+MEDIA_COLUMNS = [PinMediaModel.media_id, PinMediaModel.pin_id, PinMediaModel.status, PinMediaModel.content_type,
+                 PinMediaModel.size_bytes, PinMediaModel.object_key, PinMediaModel.thumbnail_key]
+
+
+def _live_user_pins(user_id: int, *conditions):
+    # the user's own, not removed, rows in user_pins
+    return and_(UserPinModel.user_id == user_id, UserPinModel.removal_date.is_(None), *conditions)
+
+
+@router.post("/create_pin_media/{user_id}/{pin_id}")
+async def create_pin_media(user_id: int, pin_id: int, upload: MediaUploadSchema, db: AsyncSession = Depends(get_db)):
+    """
+    start a photo upload for a pin. the client PUTs the bytes straight to S3 with the
+    returned presigned URL(s) and then calls complete_pin_media
+
+    Args:
+        user_id: uploader, has to be a primary owner of the pin
+        pin_id: pin the photo belongs to
+        upload: content type and size in bytes
+        db: database session
+
+    Return:
+        JSON Object: media_id plus a single PUT url, or one url per part for big files
+
+    Raise:
+        HTTPException: if the pin isn't the user's, the upload isn't acceptable, or S3 fails
+    """
+    try:
+        check_upload(upload.content_type, upload.size_bytes)
+    except MediaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    is_owner = (await db.execute(select(UserPinModel.user_pin_id).filter(
+        _live_user_pins(user_id, UserPinModel.pin_id == pin_id, UserPinModel.ownership_type == "primary")
+    ))).first()
+    if not is_owner:
+        raise HTTPException(status_code=400, detail="user is not a primary owner of this pin")
+
+    # end the read transaction, so the pooled connection isn't held while S3 is called
+    await db.commit()
+
+    media = PinMediaModel(pin_id=pin_id, user_id=user_id, object_key=new_object_key(pin_id, upload.content_type),
+                          content_type=upload.content_type, size_bytes=upload.size_bytes, status=MediaStatus.pending)
+    try:
+        instructions = await start_upload(media)
+    except Exception as e:
+        # presigning the parts can fail after the multipart upload was created
+        await abort_upload(media.object_key, media.upload_id)
+        logging.error(f"Error starting upload for pin {pin_id}: {e}")
+        raise HTTPException(status_code=502, detail="could not start the upload")
+    try:
+        db.add(media)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        await abort_upload(media.object_key, media.upload_id)
+        logging.error(f"Error saving upload for pin {pin_id}: {e}")
+        raise HTTPException(status_code=502, detail="could not start the upload")
+    return {"media_id": media.media_id, **instructions}
+
+
+@router.post("/complete_pin_media/{user_id}/{media_id}")
+async def complete_pin_media(user_id: int, media_id: int, completion: MediaCompleteSchema,
+                             db: AsyncSession = Depends(get_db)):
+    """
+    called by the client once the bytes are uploaded. checks the object is really in S3
+    (completing the multipart upload if there is one) and queues its thumbnail
+
+    Args:
+        user_id: the user who started the upload
+        media_id: media_id from create_pin_media
+        completion: uploaded parts (part_number + etag), multipart uploads only
+        db: database session
+
+    Return:
+        JSON Object: the media, status "uploaded" until the thumbnail is made
+
+    Raise:
+        HTTPException: if the media isn't pending for this user, or the upload can't be confirmed
+        (a multipart upload is aborted then, and the media marked failed)
+    """
+    media = (await db.execute(select(PinMediaModel).filter(
+        and_(PinMediaModel.media_id == media_id, PinMediaModel.user_id == user_id)
+    ))).scalars().first()
+    if not media:
+        raise HTTPException(status_code=400, detail=f"media not found: {media_id}")
+    if media.status != MediaStatus.pending:
+        # already completed, e.g. a retried request
+        return media_to_dict(media, download_urls)
+
+    parts = [part.model_dump() for part in completion.parts] if completion.parts else None
+    if media.upload_id and not parts:
+        # a request mistake, not a failed upload: the client can retry with the parts
+        raise HTTPException(status_code=400, detail="parts are required to complete a multipart upload")
+
+    # end the read transaction, so the pooled connection isn't held while S3 is called.
+    # expire_on_commit is off, media stays loaded
+    await db.commit()
+
+    try:
+        media.size_bytes = await finish_upload(media, parts)
+    except MediaError as e:
+        if media.upload_id:
+            # a multipart upload that can't be completed is given up on, or its parts
+            # cost storage forever. the client starts over with create_pin_media
+            await abort_upload(media.object_key, media.upload_id)
+            media.upload_id = None
+            media.status = MediaStatus.failed
+            await db.commit()
+        raise HTTPException(status_code=400, detail=str(e))
+    media.upload_id = None
+    media.status = MediaStatus.uploaded
+    await db.commit()
+
+    thumbnail_workers.submit(media.media_id, media.object_key)
+    return media_to_dict(media, download_urls)
+
+
+@router.get("/get_pin_media/{user_id}/{pin_id}")
+async def get_pin_media(user_id: int, pin_id: int, db: AsyncSession = Depends(get_read_db)):
+    """
+    the photos of a pin the user can see, with download URLs
+
+    Args:
+        user_id: user id to check against user_pins
+        pin_id: pin id
+        db: database session
+
+    Return:
+        list: media ordered by media_id, urls are null until the upload is complete
+    """
+    rows = (await db.execute(
+        select(*MEDIA_COLUMNS)
+        .join(UserPinModel, UserPinModel.pin_id == PinMediaModel.pin_id)
+        .filter(_live_user_pins(user_id, PinMediaModel.pin_id == pin_id))
+        .order_by(PinMediaModel.media_id)
+    )).all()
+    return [media_to_dict(row, download_urls) for row in rows]
+
+
+@router.post("/get_media_urls/{user_id}")
+async def get_media_urls(user_id: int, request: MediaUrlsRequestSchema, db: AsyncSession = Depends(get_read_db)):
+    """
+    download URLs for the photos of many pins in one call, for map views.
+    pins the user can't see are left out. URLs are cached until close to expiring,
+    so asking again for the same photos doesn't sign them again
+
+    Args:
+        user_id: user id to check against user_pins
+        request: pin ids, up to 500
+        db: database session
+
+    Return:
+        JSON Object: pin_id -> list of media that has been uploaded
+    """
+    if not request.pin_ids:
+        return {}
+    rows = (await db.execute(
+        select(*MEDIA_COLUMNS)
+        .join(UserPinModel, UserPinModel.pin_id == PinMediaModel.pin_id)
+        .filter(_live_user_pins(user_id,
+                                PinMediaModel.pin_id.in_(set(request.pin_ids)),
+                                PinMediaModel.status.in_([MediaStatus.uploaded, MediaStatus.ready])))
+        .order_by(PinMediaModel.pin_id, PinMediaModel.media_id)
+    )).all()
+    media = {}
+    for row in rows:
+        media.setdefault(row.pin_id, []).append(media_to_dict(row, download_urls))
+    return media
@@ -1,28 +1,39 @@
 import logging
 
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import JSONResponse
-from pymysql import IntegrityError
-from sqlalchemy import and_, or_
-from sqlalchemy.orm import Session
-from app.database import SessionLocal
+from sqlalchemy import and_, func, literal, select, union_all, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import authorize_user
+from app.cache import cache, pin_key, user_pins_key
+from app.conditional import etag_matches, make_etag, not_modified
+from app.database import get_db
+from app.replicas import get_read_db, read_engine, reads_primary
+from app.clustering import get_partner_id, pin_clusters
 from app.models import *
+from app.pin_encoding import encode_columns, encode_dicts, msgpack_etag, msgpack_response, wants_msgpack
+from app.pin_bulk import PIN_WRITE_BATCHING, BulkImportError, CSV_COLUMNS, DuplicatePin, pin_writes, csv_header, export_format, export_row_csv, import_pins, iter_records
+from app.pin_index import DUPLICATE_TOLERANCE_METERS, PinPoint, pin_index
+from app.schemas.pin_schema import PinDetailResponseSchema, PinPageSchema, PinResponseSchema
 from app.schemas.user_schema import *
+from app.streaming import keyset_page, ndjson_response, stream_rows
+from app.sync import ExpiredSyncToken, InvalidSyncToken, changes_since
 
 router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# geo_cell is internal to the spatial index, leave it out of the paginated / streamed listings.
+# removal_date is always null on the pins those return
+PIN_PUBLIC_COLUMNS = [column for column in PinModel.__table__.c if column.name not in ("geo_cell", "removal_date")]
+PIN_PUBLIC_COLUMN_NAMES = [column.name for column in PIN_PUBLIC_COLUMNS]
 
-@router.get("/get_pin/{user_id}/{pin_id}")
-async def get_pin(user_id: int, pin_id: int, db: Session = Depends(get_db)):
+@router.get("/get_pin/{user_id}/{pin_id}", response_model=PinDetailResponseSchema, dependencies=[Depends(authorize_user)])
+async def get_pin(user_id: int, pin_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_read_db)):
     """
     retrieve a single pin's information given their id.
-    also passing in the user id for double checking to make sure we can return the correct user pin
+    also passing in the user id for double checking to make sure we can return the correct user pin.
+    a bearer token, when sent (always, with AUTH_REQUIRED), has to be that user's (see app/auth.py).
+    sends an ETag, and a 304 when If-None-Match still matches it
 
     Args:
         user_id: user id 
@@ -35,86 +46,412 @@ async def get_pin(user_id: int, pin_id: int, db: Session = Depends(get_db)):
     Raise:
         []
     """
+    # cached per pin: the pin row plus who is allowed to see it
+    cached_pin = await cache.get(pin_key(pin_id))
+    if cached_pin is None:
+        # the pin and its primary owners in one query, a row per owner. no rows if the
+        # pin doesn't exist, an owner of None if nobody owns it
+        rows = (await db.execute(
+            select(*PIN_PUBLIC_COLUMNS, UserPinModel.user_id.label("primary_owner"))
+            .outerjoin(UserPinModel, and_(UserPinModel.pin_id == PinModel.pin_id,
+                                          # third check can probably be removed later.
+                                          UserPinModel.ownership_type == "primary",
+                                          UserPinModel.removal_date.is_(None)))
+            .filter(and_(PinModel.pin_id == pin_id, PinModel.removal_date.is_(None)))
+        )).all()
+        if not rows:
+            # misses aren't cached, a pin created by another path or worker shows up right away
+            raise HTTPException(status_code=400, detail="pin details not accessible")
+        pin = {column: rows[0]._mapping[column] for column in PIN_PUBLIC_COLUMN_NAMES}
+        primary_owners = [row.primary_owner for row in rows if row.primary_owner is not None]
+        cached_pin = {
+            "pin": pin,
+            "primary_owners": primary_owners,
+            "etag": make_etag(pin),
+        }
+        # nor is a pin nobody owns yet, its user_pins row may not be visible to this read,
+        # nor one read from a replica, which may not have seen it deleted yet
+        if primary_owners and reads_primary(db):
+            await cache.set(pin_key(pin_id), cached_pin)
+
     # only return a pin if it belongs to the current user
-    can_get_pin = db.query(UserPinModel).filter(
-        and_(UserPinModel.pin_id == pin_id,
-             UserPinModel.user_id == user_id,
-             # third check can probably be removed later.
-             UserPinModel.ownership_type == "primary"
-            )
-        ).first()
-    
-    if not can_get_pin:
+    if user_id not in cached_pin["primary_owners"]:
         raise HTTPException(status_code=400, detail="pin details not accessible")
-    target_pin = db.query(PinModel).filter(PinModel.pin_id == pin_id).first()
+    if etag_matches(request, cached_pin["etag"]):
+        return not_modified(cached_pin["etag"])
+    response.headers["ETag"] = cached_pin["etag"]
     # clunky, but we need to move fast!
     response = {
-        "pin": target_pin,
-        "ownership_type": can_get_pin.ownership_type
+        "pin": cached_pin["pin"],
+        "ownership_type": OwnershipType.primary.value
     }
     return response
 
 
 
-@router.get("/get_all_pins/{user_id}")
-async def get_all_pins(user_id: int, db: Session = Depends(get_db)):
+@router.get("/get_all_pins/{user_id}", response_model=Union[list[PinResponseSchema], PinPageSchema],
+            dependencies=[Depends(authorize_user)])
+async def get_all_pins(user_id: int,
+                       request: Request,
+                       response: Response,
+                       limit: Optional[int] = Query(default=None, ge=1, le=1000),
+                       after_id: Optional[int] = None,
+                       stream: bool = False,
+                       db: AsyncSession = Depends(get_read_db)):
     """
-    Retrieve all the pins belonging to a user
+    Retrieve all the pins belonging to a user.
+    the full listing sends an ETag, and a 304 when If-None-Match still matches it.
+    clients that keep pins locally should use sync_pins instead.
+    a bearer token, when sent (always, with AUTH_REQUIRED), has to be that user's (see app/auth.py).
+    with Accept: application/msgpack the listing and pages come back columnar (see app/pin_encoding.py)
 
     Args:
         user_id: user id to check against pins
+        limit: page size. when set, returns one page ordered by pin_id
+        after_id: cursor, the next_cursor of the previous page
+        stream: stream every pin (after after_id) as NDJSON instead
+    """
+    if stream or limit is not None:
+        query = (select(*PIN_PUBLIC_COLUMNS)
+                 .filter(and_(PinModel.user_id == user_id, PinModel.removal_date.is_(None)))
+                 .order_by(PinModel.pin_id))
+        if after_id is not None:
+            query = query.filter(PinModel.pin_id > after_id)
+        if stream:
+            # same engine as db, so a user who just wrote still reads from the primary
+            return ndjson_response(query, bind=db.bind)
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        if wants_msgpack(request):
+            next_cursor = rows[limit - 1].pin_id if len(rows) > limit else None
+            return msgpack_response(encode_columns(PIN_PUBLIC_COLUMN_NAMES, rows[:limit], next_cursor=next_cursor))
+        response.headers["Vary"] = "Accept"
+        return keyset_page(rows, "pin_id", limit)
+
+    cached_pins = await cache.get(user_pins_key(user_id))
+    if cached_pins is None:
+        rows = await db.execute(select(*PIN_PUBLIC_COLUMNS).filter(
+            and_(PinModel.user_id == user_id, PinModel.removal_date.is_(None))
+        ))
+        all_pins = [dict(row._mapping) for row in rows]
+        cached_pins = {"pins": all_pins, "etag": make_etag(all_pins)}
+        # a replica may be behind, only the primary's pins are cached
+        if reads_primary(db):
+            await cache.set(user_pins_key(user_id), cached_pins)
+
+    if wants_msgpack(request):
+        etag = msgpack_etag(cached_pins["etag"])
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        payload = cached_pins.get("msgpack")
+        if payload is None:
+            # kept on the cached listing itself, so it goes away with it when the user's pins change.
+            # setting the key again could bring back a listing that was invalidated meanwhile
+            payload = cached_pins["msgpack"] = encode_dicts(cached_pins["pins"], PIN_PUBLIC_COLUMN_NAMES)
+        return msgpack_response(payload, etag)
+
+    if etag_matches(request, cached_pins["etag"]):
+        return not_modified(cached_pins["etag"])
+    response.headers["ETag"] = cached_pins["etag"]
+    response.headers["Vary"] = "Accept"
+    return cached_pins["pins"]
+
+
+@router.get("/sync_pins/{user_id}")
+async def sync_pins(user_id: int, since: Optional[str] = None, db: AsyncSession = Depends(get_db)):
     """
-    all_pins = db.query(PinModel).filter(PinModel.user_id == user_id).all()
-    return all_pins
+    Pins a user can see that changed since their last sync, so clients don't have to
+    re-download everything. the first sync (no since) sends every pin.
+    keep the returned token and pass it as since next time.
+    always reads the primary: a token built from a lagging replica's clock would skip,
+    for good, the writes that hadn't replicated yet
+
+    Args:
+        user_id: user id to sync
+        since: token from the previous sync
+        db: database session
+
+    Return:
+        JSON Object: token, full, upserted (pins with ownership_type) and removed (pin ids)
+
+    Raise:
+        HTTPException: if the token is invalid, or 410 if it is too old and the client has to sync again without since
+    """
+    try:
+        return await changes_since(db, user_id, since)
+    except InvalidSyncToken:
+        raise HTTPException(status_code=400, detail="invalid sync token")
+    except ExpiredSyncToken:
+        raise HTTPException(status_code=410, detail="sync token expired, sync again without since")
+
+
+@router.get("/get_pin_feed/{user_id}")
+async def get_pin_feed(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieve every pin visible to a user and their partner, in one query.
+    visibility comes from user_pins (primary or secondary, not removed), for the user
+    and for whoever they are in a partnership with
+
+    Args:
+        user_id: user id to build the feed for
+        db: database session
+
+    Return:
+        list: pins ordered by pin_id, each with the owners that make it visible
+    """
+    # the user plus their partner, if any. partnerships can store the user on either side
+    visible_users = union_all(
+        select(literal(user_id)),
+        select(UserPartnershipModel.user_id_2).filter(UserPartnershipModel.user_id_1 == user_id),
+        select(UserPartnershipModel.user_id_1).filter(UserPartnershipModel.user_id_2 == user_id),
+    ).scalar_subquery()
+    query = (
+        select(*PIN_PUBLIC_COLUMNS,
+               UserPinModel.user_id.label("owner_user_id"),
+               UserPinModel.ownership_type)
+        .join(PinModel, PinModel.pin_id == UserPinModel.pin_id)
+        .filter(and_(UserPinModel.user_id.in_(visible_users),
+                     UserPinModel.removal_date.is_(None),
+                     PinModel.removal_date.is_(None)))
+        .order_by(UserPinModel.pin_id)
+    )
+
+    # a pin shared within the couple comes back once per owner, fold those together
+    feed = {}
+    for row in await db.execute(query):
+        pin = row._mapping
+        entry = feed.get(pin["pin_id"])
+        if entry is None:
+            entry = feed[pin["pin_id"]] = {column.name: pin[column.name] for column in PIN_PUBLIC_COLUMNS}
+            entry["owners"] = []
+        entry["owners"].append({"user_id": pin["owner_user_id"], "ownership_type": pin["ownership_type"]})
+    return list(feed.values())
+
+
+@router.get("/get_pins_in_bbox/{user_id}")
+async def get_pins_in_bbox(user_id: int,
+                           request: Request,
+                           response: Response,
+                           min_lat: float = Query(ge=-90, le=90),
+                           min_lon: float = Query(ge=-180, le=180),
+                           max_lat: float = Query(ge=-90, le=90),
+                           max_lon: float = Query(ge=-180, le=180),
+                           limit: int = Query(default=1000, ge=1, le=10000),
+                           db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieve a user's pins inside a map viewport.
+    with Accept: application/msgpack the markers come back columnar (see app/pin_encoding.py)
+
+    Args:
+        user_id: user id to check against pins
+        min_lat, min_lon, max_lat, max_lon: corners of the viewport
+        limit: max number of pins to return
+        db: database session
+
+    Return:
+        list: pin markers (pin_id, user_id, title, latitude, longitude)
+
+    Raise:
+        HTTPException: if the box is inverted
+    """
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="min_lat/min_lon must be less than max_lat/max_lon")
+
+    points = await pin_index.query_bbox(db, min_lat, min_lon, max_lat, max_lon, user_id=user_id)
+    if wants_msgpack(request):
+        return msgpack_response(encode_columns(PinPoint._fields, points[:limit]))
+    response.headers["Vary"] = "Accept"
+    return [point._asdict() for point in points[:limit]]
+
+
+@router.get("/get_pins_near/{user_id}")
+async def get_pins_near(user_id: int,
+                        request: Request,
+                        response: Response,
+                        latitude: float = Query(ge=-90, le=90),
+                        longitude: float = Query(ge=-180, le=180),
+                        radius: float = Query(gt=0, le=100_000, description="meters"),
+                        limit: int = Query(default=1000, ge=1, le=10000),
+                        db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieve a user's pins within radius meters of a point, closest first.
+    with Accept: application/msgpack the markers come back columnar (see app/pin_encoding.py)
+
+    Args:
+        user_id: user id to check against pins
+        latitude, longitude: center of the search
+        radius: search radius in meters
+        limit: max number of pins to return
+        db: database session
+
+    Return:
+        list: pin markers with their distance in meters
+    """
+    matches = await pin_index.query_radius(db, latitude, longitude, radius, user_id=user_id)
+    if wants_msgpack(request):
+        return msgpack_response(encode_columns((*PinPoint._fields, "distance"),
+                                               ((*point, distance) for point, distance in matches[:limit])))
+    response.headers["Vary"] = "Accept"
+    return [{**point._asdict(), "distance": distance} for point, distance in matches[:limit]]
+
+
+@router.get("/get_pin_clusters/{user_id}")
+async def get_pin_clusters(user_id: int,
+                           zoom: int = Query(ge=0, le=22),
+                           min_lat: float = Query(default=-90, ge=-90, le=90),
+                           min_lon: float = Query(default=-180, ge=-180, le=180),
+                           max_lat: float = Query(default=90, ge=-90, le=90),
+                           max_lon: float = Query(default=180, ge=-180, le=180),
+                           include_partner: bool = False,
+                           db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieve a user's pins grouped into map clusters for a viewport and zoom level
+
+    Args:
+        user_id: user id to check against pins
+        zoom: map zoom level, higher means smaller clusters
+        min_lat, min_lon, max_lat, max_lon: viewport, defaults to the whole world
+        include_partner: also cluster the pins of the user's partner
+        db: database session
+
+    Return:
+        list: clusters (cell, count, centroid latitude/longitude, bbox, pin_ids)
+
+    Raise:
+        HTTPException: if the box is inverted
+    """
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="min_lat/min_lon must be less than max_lat/max_lon")
+
+    user_ids = [user_id]
+    if include_partner:
+        partner_id = await get_partner_id(db, user_id)
+        if partner_id is not None:
+            user_ids.append(partner_id)
+    return await pin_clusters.query(db, user_ids, zoom, min_lat, min_lon, max_lat, max_lon)
 
 
 @router.post("/create_pin/{user_id}", response_model=PinSchema)
-async def create_pin(user_id: int, pin_info: PinSchema, db: Session = Depends(get_db)) -> PinSchema:
+async def create_pin(user_id: int, pin_info: PinSchema, db: AsyncSession = Depends(get_db)) -> PinSchema:
     """
-    create a new pin. trigger called after_pin_create was created to also add an entry into user_pins
+    create a new pin. trigger called after_pin_create was created to also add an entry into user_pins.
+    with PIN_WRITE_BATCHING on, requests arriving within a few ms are written together (see app/pin_bulk.py)
     """
+    if PIN_WRITE_BATCHING:
+        try:
+            await pin_writes.submit(user_id, pin_info)
+        except DuplicatePin:
+            raise HTTPException(status_code=400, detail="Pin location already exist")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Error creating pin: {e}")
+        return pin_info
 
     # edge cases
     new_pin = PinModel(pin_info)
-    is_pin_duplicate = db.query(PinModel).filter(and_(PinModel.latitude == new_pin.latitude, PinModel.longitude == new_pin.longitude)).first()
+    # any pin within a meter or so counts as the same location. fresh=True so we
+    # always check against the database rather than another worker's stale cache
+    is_pin_duplicate = await pin_index.query_radius(db, pin_info.latitude, pin_info.longitude,
+                                                    DUPLICATE_TOLERANCE_METERS, fresh=True)
     if is_pin_duplicate:
         raise HTTPException(status_code=400, detail="Pin location already exist")
     
     try:
         db.add(new_pin)
-        db.commit()
-        db.refresh(new_pin)
-        logging.info(f"Created new pin: {new_pin}")
+        # pin_id comes back from the insert, no refresh needed
+        await db.commit()
+        await cache.delete(user_pins_key(new_pin.user_id), pin_key(new_pin.pin_id))
+        pin_index.add(PinPoint(new_pin.pin_id, new_pin.user_id, new_pin.title, pin_info.latitude, pin_info.longitude))
+        pin_clusters.add(new_pin.user_id, new_pin.pin_id, pin_info.latitude, pin_info.longitude)
+        # not {new_pin}, its creation_date was never loaded back on MySQL (no RETURNING)
+        logging.info(f"Created new pin {new_pin.pin_id} for user {new_pin.user_id}")
         return pin_info
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logging.error(f"Error creating pin: {e}")
         raise HTTPException(status_code=400, detail=f"Error creating pin: {e}")
 
+@router.post("/bulk_create_pins/{user_id}")
+async def bulk_create_pins(user_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    create many pins at once, e.g. when migrating a couple's history.
+    the body is a JSON array of pins, or NDJSON / CSV (header row required) which are read as they stream in.
+    rows are de-duplicated against each other and against existing pins, then inserted in chunks
+
+    Args:
+        user_id: owner of every pin, each row's user_id must match
+        request: body in the format given by its Content-Type
+        db: database session
+
+    Return:
+        JSON Object: totals per status and one result per row (created with its pin_id, duplicate, invalid, error)
+
+    Raise:
+        HTTPException: if the body can't be read at all
+    """
+    records = iter_records(request.headers.get("content-type", "application/json"), request.stream())
+    try:
+        return await import_pins(db, user_id, records)
+    except BulkImportError as e:
+        raise HTTPException(status_code=400, detail=f"Error importing pins: {e}")
+
+
+@router.get("/export_pins/{user_id}")
+async def export_pins(user_id: int, request: Request,
+                      format: Optional[str] = Query(default=None, pattern="^(ndjson|csv)$")):
+    """
+    stream all of a user's pins in the same format bulk_create_pins accepts
+
+    Args:
+        user_id: user id to check against pins
+        format: ndjson or csv, otherwise picked from the Accept header (ndjson by default)
+
+    Return:
+        StreamingResponse: one pin per line
+    """
+    query = (select(*(getattr(PinModel, column) for column in CSV_COLUMNS))
+             .filter(and_(PinModel.user_id == user_id, PinModel.removal_date.is_(None)))
+             .order_by(PinModel.pin_id))
+    if export_format(format, request.headers.get("accept", "")) == "csv":
+        return stream_rows(query, export_row_csv, "text/csv", header=csv_header(), bind=read_engine(request))
+    return ndjson_response(query, bind=read_engine(request))
+
+
 @router.delete("/delete_pin/{user_id}/{pin_id}")
-async def delete_pin(user_id: int, pin_id: int, db: Session = Depends(get_db)):
+async def delete_pin(user_id: int, pin_id: int, db: AsyncSession = Depends(get_db)):
     """
-    we already added one for deleting off of user_pins table
-    only delete if the user is the primary owner of the pin
-    #TODO: we probably need to add triggers.
+    only delete if the user is the primary owner of the pin.
+    the pin and its user_pins rows get a removal_date instead of being deleted, so
+    sync_pins can tell clients the pin is gone
     """
-    can_delete_pin = db.query(UserPinModel).filter(
+    can_delete_pin = (await db.execute(select(UserPinModel).filter(
         and_(UserPinModel.pin_id == pin_id,
              UserPinModel.user_id == user_id,
-             UserPinModel.ownership_type == "primary"
+             UserPinModel.ownership_type == "primary",
+             UserPinModel.removal_date.is_(None)
             )
-        ).first()
+        ))).scalars().first()
 
     if not can_delete_pin:
         raise HTTPException(status_code=400, detail="user is not a primary owner of this pin, cannot delete. pin does not exist")
 
-    did_delete = db.query(PinModel).filter(PinModel.pin_id == pin_id).delete()
+    did_delete = (await db.execute(
+        update(PinModel)
+        .filter(and_(PinModel.pin_id == pin_id, PinModel.removal_date.is_(None)))
+        .values(removal_date=func.current_timestamp())
+    )).rowcount
     if did_delete:
-        db.commit()
+        await db.execute(
+            update(UserPinModel)
+            .filter(and_(UserPinModel.pin_id == pin_id, UserPinModel.removal_date.is_(None)))
+            .values(removal_date=func.current_timestamp())
+        )
+        await db.commit()
+        await cache.delete(user_pins_key(user_id), pin_key(pin_id))
+        pin_index.remove(pin_id)
+        pin_clusters.remove(user_id, pin_id)
         logging.info(f"deleted pin {pin_id}")
         return JSONResponse(status_code=200, content={"success": f"deleted pin: {pin_id}"})
     else:
-        db.rollback()
+        await db.rollback()
         logging.error(f"Error deleting pin: {pin_id}")
         raise HTTPException(status_code=400, detail=f"Error deleting pin: {pin_id}")
 
@@ -1,29 +1,54 @@
 import logging
+import re
 
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional, Union
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import JSONResponse
-from pymysql import IntegrityError
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
-from app.database import SessionLocal
+from sqlalchemy import and_, delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth import forget_sessions, revoke_sessions
+from app.cache import cache, user_key, user_pins_key
+from app.conditional import etag_matches, make_etag, not_modified
+from app.database import get_db
+from app.replicas import get_read_db, reads_primary
+from app.clustering import pin_clusters
+from app.hashing import password_hasher
 from app.models import *
+from app.pin_index import pin_index
+from app.purge import USER_PURGE_PHASES, dissolve_partnership, purger
+from app.user_search import SearchUser, search_users, user_search
+from app.streaming import keyset_page, ndjson_response
 from app.schemas.user_schema import *
 
 router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# everything but the password hash, used by the paginated / streamed listings.
+# removal_date is always null on the users those return
+USER_PUBLIC_COLUMNS = [column for column in UserModel.__table__.c if column.name not in ("hashed_password", "removal_date")]
+
+# the unique key a duplicate-key error names: "UNIQUE constraint failed: users.email" on
+# sqlite, "Duplicate entry '...' for key 'users.email'" (or 'ix_users_email') on MySQL
+DUPLICATE_KEY = re.compile(r"(?:constraint failed:|for key)\s*'?([\w.]+)")
+
+
+def duplicate_user_detail(error: IntegrityError) -> str:
+    """
+    The 400 detail for a user insert the unique keys rejected, naming the column that clashed
+    """
+    match = DUPLICATE_KEY.search(str(error.orig))
+    key = match.group(1) if match else ""
+    if "email" in key:
+        return "Email already used"
+    if "username" in key:
+        return "Username already used"
+    return "Email / username already used"
+
 
 #TODO: can we write the return types for clarity?
 #TODO: can we think of other read routes for the user?
 #TODO: in create_user:
-#    - there is no distinction when a 400 gets returned for email / username
-#    - user_id duplicate check is horrible code. please refactor 
-#    - by introducing auto incrementing user_ids and UUIDs.
+#    - introduce UUIDs next to the auto incrementing user_ids?
 #    - should user's have a field for partnership_id???
 #TODO: in update_user_basic:
 #    - update this route to return past info and new info. Will need to change the return type
@@ -34,44 +59,96 @@ def get_db():
 #    - overall this route could use the most refactoring
 
 
-@router.get("/get_all_users")
-async def get_all_users(db: Session = Depends(get_db)):
+@router.get("/get_all_users", response_model=Union[list[UserResponseSchema], UserPageSchema])
+async def get_all_users(limit: Optional[int] = Query(default=None, ge=1, le=1000),
+                        after_id: Optional[int] = None,
+                        stream: bool = False,
+                        db: AsyncSession = Depends(get_read_db)):
     """
     Retrieve all users in the database
 
     Args:
+        limit: page size. when set, returns one page ordered by user_id
+        after_id: cursor, the next_cursor of the previous page
+        stream: stream every user (after after_id) as NDJSON instead
         db: database session
 
     Returns:
-        JSON Object: all users
+        JSON Object: all users, a page of users, or an NDJSON stream
     """
-    users = db.query(UserModel).all()
-    return users
-
-@router.get("/get_user/{user_id}")
-async def get_user(user_id: int, db: Session = Depends(get_db)):
+    if stream or limit is not None:
+        query = select(*USER_PUBLIC_COLUMNS).filter(UserModel.removal_date.is_(None)).order_by(UserModel.user_id)
+        if after_id is not None:
+            query = query.filter(UserModel.user_id > after_id)
+        if stream:
+            return ndjson_response(query, bind=db.bind)
+        rows = (await db.execute(query.limit(limit + 1))).all()
+        return keyset_page(rows, "user_id", limit)
+
+    # plain rows, the response schema reads their columns by attribute
+    return (await db.execute(select(*USER_PUBLIC_COLUMNS).filter(UserModel.removal_date.is_(None)))).all()
+
+@router.get("/get_user/{user_id}", response_model=UserResponseSchema)
+async def get_user(user_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_read_db)):
     """
-    Return a user model given their user_id
+    Return a user model given their user_id.
+    sends an ETag, and a 304 when If-None-Match still matches it
 
     Args:
         user_id: unique integer representing a user
         db: database session
     
     Returns:
-        UserModel: user data 
+        UserResponseSchema: user data, without the password hash
     
     Raises:
         HTTPException: if user_id does not exist
     """
-    user = db.query(UserModel).filter(UserModel.user_id == user_id).first()
+    cached_user = await cache.get(user_key(user_id))
+    if cached_user is None:
+        user = (await db.execute(select(*USER_PUBLIC_COLUMNS).filter(
+            and_(UserModel.user_id == user_id, UserModel.removal_date.is_(None))
+        ))).first()
+
+        if not user:
+            raise HTTPException(status_code=400, detail=f"user not found for user_id: {user_id}")
+
+        user_data = dict(user._mapping)
+        cached_user = {"user": user_data, "etag": make_etag(user_data)}
+        # a replica may be behind, only the primary's user is cached
+        if reads_primary(db):
+            await cache.set(user_key(user_id), cached_user)
+
+    if etag_matches(request, cached_user["etag"]):
+        return not_modified(cached_user["etag"])
+    response.headers["ETag"] = cached_user["etag"]
+    return cached_user["user"]
+
+@router.get("/search_users/{user_id}", response_model=UserSearchPageSchema)
+async def search_users_route(user_id: int,
+                             q: str = Query(min_length=1, max_length=100),
+                             limit: int = Query(default=20, ge=1, le=50),
+                             offset: int = Query(default=0, ge=0, le=1000),
+                             db: AsyncSession = Depends(get_read_db)):
+    """
+    Find people by username, first or last name, e.g. to get the user_id for create_partnership.
+    every word of q has to start one of them (case and accents don't matter), best matches first
 
-    if not user:
-        raise HTTPException(status_code=400, detail=f"user not found for user_id: {user_id}")
+    Args:
+        user_id: the user searching, left out of the results
+        q: what to search for, e.g. "ann sm"
+        limit: page size
+        offset: matches to skip, the next_offset of the previous page
+        db: database session, only used while the search index is loading
 
-    return user
+    Return:
+        JSON Object: items (user_id, username, first_name, last_name) and next_offset (None on the last page)
+    """
+    users, has_more = await search_users(db, q, limit, offset, exclude=user_id)
+    return {"items": [user._asdict() for user in users], "next_offset": offset + limit if has_more else None}
 
 @router.post("/create_user", response_model=UserSchema)
-async def create_user(user: UserSchema, db: Session = Depends(get_db)) -> UserSchema:
+async def create_user(user: UserSchema, db: AsyncSession = Depends(get_db)) -> UserSchema:
     """
     Create a user in the database
 
@@ -83,40 +160,34 @@ async def create_user(user: UserSchema, db: Session = Depends(get_db)) -> UserSc
         Response: Letting us know if a user was successfully created
     
     Raises:
-        HTTPException: if an email is already used
+        HTTPException: if the email or username is already used
 
     """
-    db_user = UserModel(user) 
-    is_user_not_unique = db.query(UserModel).filter(
-        or_(UserModel.email == user.email, UserModel.username == user.username)
-    ).first()
-    does_user_id_duplicate = db.query(UserModel).filter(UserModel.user_id == db_user.user_id).first()
-    if is_user_not_unique:
-        # if email / username is already used
-        raise HTTPException(status_code=400, detail="Email / username already used")
-    
-    while does_user_id_duplicate:
-        # generate a new user if user id is duplicated
-        db_user = UserModel(user)
-        does_user_id_duplicate = db.query(UserModel).filter(UserModel.user_id == db_user.user_id).first()
-
+    # no uniqueness queries first, the unique keys on email and username decide in
+    # the same statement that inserts the user (see duplicate_user_detail)
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = UserModel(user, hashed_password)
     try:
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-        logging.info(f"Created user: {db_user}")
-        return user
+        # user_id comes back from the insert, no refresh needed
+        await db.commit()
     except IntegrityError as e:
         # make sure to return the response given from the frontend!
-        db.rollback()
+        await db.rollback()
         logging.error(f"Error creating user: {e}")
-        raise HTTPException(status_code=400, detail=f"Error creating user: {e}")
-    
+        raise HTTPException(status_code=400, detail=duplicate_user_detail(e))
+    user_search.add(SearchUser(db_user.user_id, db_user.username, db_user.first_name, db_user.last_name))
+    logging.info(f"Created user: {db_user}")
+    return user
+
 @router.delete("/delete_user/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(get_db)) -> JSONResponse:
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_db)) -> JSONResponse:
     """
     deletes a user off of the database. 
-    no need to delete from user_pins or user_partnerships
+    the user is only marked removed here, which hides them right away and frees their
+    email and username. their pins, user_pins rows and partnership are purged in the
+    background in small batches (see app/purge.py), so this doesn't hold locks on
+    thousands of rows
 
     Args:
         user_id: the user id to delete 
@@ -129,18 +200,36 @@ async def delete_user(user_id: int, db: Session = Depends(get_db)) -> JSONRespon
         HTTPException: if user id cannot be deleted 
     """
 
-    did_delete = db.query(UserModel).filter(UserModel.user_id == user_id).delete()
+    did_delete = (await db.execute(
+        update(UserModel)
+        .filter(and_(UserModel.user_id == user_id, UserModel.removal_date.is_(None)))
+        # the row stays until the purge is done with it, its email and username are freed
+        # now so they can sign up again. the space keeps them clear of real emails
+        .values(removal_date=func.current_timestamp(),
+                email=f"deleted user {user_id}", username=f"deleted user {user_id}")
+    )).rowcount
     if did_delete:
-        db.commit()
+        # the purge's progress, committed with the tombstone so a restart can't lose it
+        db.add(UserPurgeModel(user_id=user_id, phase=USER_PURGE_PHASES[0]))
+        revoked_sessions = await revoke_sessions(db, user_id)
+        partner_ids = await dissolve_partnership(db, user_id)
+        await db.commit()
+        forget_sessions(revoked_sessions)
+        purger.wake()
+        # the purge drops the user's pins from the cache as it tombstones them
+        await cache.delete(user_key(user_id), user_pins_key(user_id), *(user_key(partner_id) for partner_id in partner_ids))
+        user_search.remove(user_id)
+        pin_index.remove_user(user_id)
+        pin_clusters.remove_user(user_id)
         logging.info(f"deleted user {user_id}")
         return JSONResponse(status_code=200, content={"success": f"deleted user: {user_id}"})
     else:
-        db.rollback()
+        await db.rollback()
         logging.error(f"Error deleting user: {user_id}")
         raise HTTPException(status_code=400, detail=f"Error deleting user: {user_id}")
 
 @router.put("/update_user/{user_id}", response_model=UserUpdateSchema)
-async def update_user_basic(user_id: int, user_update: UserUpdateSchema, db: Session = Depends(get_db)) -> UserUpdateSchema:
+async def update_user_basic(user_id: int, user_update: UserUpdateSchema, db: AsyncSession = Depends(get_db)) -> UserUpdateSchema:
     """
     update a user's basic credentials (last/first/user name)
 
@@ -152,7 +241,9 @@ async def update_user_basic(user_id: int, user_update: UserUpdateSchema, db: Ses
     Return:
         UserUpdateSchema: if update was successful and shows new user information
     """
-    user = db.query(UserModel).filter(UserModel.user_id == user_id).first()
+    user = (await db.execute(select(UserModel).filter(
+        and_(UserModel.user_id == user_id, UserModel.removal_date.is_(None))
+    ))).scalars().first()
     if not user:
         raise HTTPException(status_code=400, detail="User not found")
     
@@ -163,12 +254,14 @@ async def update_user_basic(user_id: int, user_update: UserUpdateSchema, db: Ses
         # user.attribute = new_value
         setattr(user, attribute, new_value)
 
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await cache.delete(user_key(user_id))
+    await db.refresh(user)
+    user_search.add(SearchUser(user.user_id, user.username, user.first_name, user.last_name))
     return user
 
 @router.post("/create_partnership/{user_id_1}/{user_id_2}")
-async def create_partnership(user_id_1: int, user_id_2: int, db: Session = Depends(get_db)):
+async def create_partnership(user_id_1: int, user_id_2: int, db: AsyncSession = Depends(get_db)):
     """
     create a partnership between two users
 
@@ -181,40 +274,43 @@ async def create_partnership(user_id_1: int, user_id_2: int, db: Session = Depen
         []
     
     Raise:
-        []
+        HTTPException: if either user doesn't exist or is already in a relationship
     """
 
     if user_id_1 == user_id_2:
         raise HTTPException(status_code=400, detail="user cannot be in a relationship with self")
 
-    do_users_exist = db.query(UserModel).filter(or_(UserModel.user_id == user_id_1, UserModel.user_id == user_id_2)).first()
-    if not do_users_exist:
+    # both users in one query, locked until the partnership is committed so neither
+    # can be paired off elsewhere in between
+    users = (await db.execute(
+        select(UserModel.user_id, UserModel.partnership_id)
+        .filter(and_(UserModel.user_id.in_([user_id_1, user_id_2]), UserModel.removal_date.is_(None)))
+        .with_for_update()
+    )).all()
+    if len(users) != 2:
         raise HTTPException(status_code=400, detail="user(s) not found")
 
-
-    user_1 = db.query(UserModel).filter(UserModel.user_id == user_id_1).first();
-    user_2 = db.query(UserModel).filter(UserModel.user_id == user_id_2).first();
-
-    if (user_1.partnership_id is not None or user_2.partnership_id is not None):
+    if any(user.partnership_id is not None for user in users):
         raise HTTPException(status_code=400, detail="one or more users are in a relationship")
-    
+
     # create new entity in user_partnerships
     new_partnership = UserPartnershipModel(user_id_1, user_id_2)
     try:
         # we added a trigger to add partnership ids to the users attributes
         db.add(new_partnership)
-        db.commit()
-        db.refresh(new_partnership)
+        await db.commit()
+        # the trigger changed both users' partnership_id
+        await cache.delete(user_key(user_id_1), user_key(user_id_2))
         logging.info(f"Created partnership for users: {new_partnership}")
         return {"success : partnership created"}
     except:
         # make sure to return the response given from the frontend!
-        db.rollback()
+        await db.rollback()
         logging.error(f"Error creating partnership: {new_partnership}")
         raise HTTPException(status_code=400, detail=f"Error creating partnership: {new_partnership}")
 
 @router.delete("/delete_partnership/{partnership_id}")
-async def delete_partnership(partnership_id: int, db: Session = Depends(get_db)):
+async def delete_partnership(partnership_id: int, db: AsyncSession = Depends(get_db)):
     """
     When love fails. Delete the partnership from the table
 
@@ -229,15 +325,24 @@ async def delete_partnership(partnership_id: int, db: Session = Depends(get_db))
         []
     """
 
-    partnership_to_delete = db.query(UserPartnershipModel).filter(UserPartnershipModel.partnership_id == partnership_id).delete()
+    partners = (await db.execute(
+        select(UserPartnershipModel.user_id_1, UserPartnershipModel.user_id_2)
+        .filter(UserPartnershipModel.partnership_id == partnership_id)
+    )).first()
+    if partners:
+        # the path only has the partnership id, keep both partners' next reads on the primary
+        db.info["route_user_ids"] = [partner_id for partner_id in partners if partner_id is not None]
+    partnership_to_delete = (await db.execute(delete(UserPartnershipModel).filter(UserPartnershipModel.partnership_id == partnership_id))).rowcount
 
     if partnership_to_delete:
         # we created a trigger in our database to also delete the partnership ids from user table
-        db.commit()
+        await db.commit()
+        if partners:
+            await cache.delete(*(user_key(partner_id) for partner_id in partners if partner_id is not None))
         logging.info("deleted partnership")
         return JSONResponse(status_code=200, content={"success": "deleted partnership"})
     else:
-        db.rollback()
+        await db.rollback()
         logging.error("Error deleting partnership")
         raise HTTPException(status_code=400, detail="Error deleting partnership")
 
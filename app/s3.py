@@ -1,31 +1,76 @@
-import boto3
+import asyncio
 import os
+import threading
 
-from dotenv import load_dotenv
+from typing import Callable
 from fastapi import APIRouter, Depends, HTTPException
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError, BotoCoreError
+from . import env  # noqa: F401  loads .env
 
 router = APIRouter()
 
-load_dotenv()
-
 # Retrieve AWS credentials from environment variables
 aws_access_key_id = os.getenv('AWS_ACCESS_KEY')
 aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
 aws_region = os.getenv('AWS_REGION')
+# set to talk to a local S3 stand-in instead (MinIO, moto server), e.g. http://localhost:9000
+s3_endpoint_url = os.getenv('S3_ENDPOINT_URL')
+
+# called with the client once it is created, see observe_client
+client_observers: list[Callable] = []
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def observe_client(observer: Callable):
+    """
+    Call observer with the S3 client once it exists (right away if it already does),
+    e.g. to attach instrumentation, see app/main.py
+    """
+    with _client_lock:
+        client_observers.append(observer)
+        client = _client
+    if client is not None:
+        observer(client)
+
+
+def get_s3():
+    """
+    The worker's boto3 S3 client, created on first use. boto3 takes a few hundred ms
+    to import and only the media routes need it, so workers don't pay for it at boot.
+    boto3 clients are thread safe, the lock only stops two threads building one each
+
+    Returns:
+        the same S3 client on every call
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import boto3
+                from botocore.config import Config
+
+                client = boto3.client(
+                    's3',
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                    region_name=aws_region,
+                    endpoint_url=s3_endpoint_url,
+                    # presigned URLs (app/media.py) have to be SigV4, newer regions reject the legacy signature
+                    config=Config(signature_version='s3v4')
+                )
+                for observer in client_observers:
+                    observer(client)
+                _client = client
+    return _client
 
-s3 = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
-)
 
 @router.get("/test-s3") 
 async def test_s3_connection():
     try:
-        # List all buckets to verify the connection
-        response = s3.list_buckets()
+        # List all buckets to verify the connection, boto3 blocks so keep it off the event loop
+        response = await asyncio.to_thread(get_s3().list_buckets)
         
         # Print the list of bucket names
         print("Connected successfully!")
@@ -41,4 +86,4 @@ async def test_s3_connection():
     except Exception as e:
         print("An error occurred:", e)
     
-    return False
\ No newline at end of file
+    return False
@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+# Pydantic schemas 
+# logging in, login is the username or the email
+class LoginSchema(BaseModel):
+    login: str
+    password: str
+
+# what login sends back. send access_token as "Authorization: Bearer <access_token>"
+class TokenSchema(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
+    user_id: int
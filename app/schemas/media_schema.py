@@ -0,0 +1,21 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+# Pydantic schemas 
+# asking for upload URLs for a new pin photo
+class MediaUploadSchema(BaseModel):
+    content_type: str
+    size_bytes: int
+
+# one uploaded part of a multipart upload, etag is the ETag header S3 returned for the part
+class MediaPartSchema(BaseModel):
+    part_number: int = Field(ge=1, le=10000)
+    etag: str
+
+# the client is done uploading. parts only for multipart uploads
+class MediaCompleteSchema(BaseModel):
+    parts: Optional[list[MediaPartSchema]] = None
+
+# download URLs for the photos of many pins at once (map views)
+class MediaUrlsRequestSchema(BaseModel):
+    pin_ids: list[int] = Field(max_length=500)
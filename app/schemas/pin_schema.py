@@ -1,4 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel
+from typing import Optional
 
 # Pydantic schemas 
 class PinSchema(BaseModel):
@@ -6,4 +8,29 @@ class PinSchema(BaseModel):
     longitude: float
     title: str
     details: str
-    user_id: int
\ No newline at end of file
+    user_id: int
+
+# what read routes send back for a pin. built from selected columns (a row mapping or
+# a cached dict), not ORM instances, and never includes geo_cell / removal_date
+class PinResponseSchema(BaseModel):
+    pin_id: int
+    user_id: Optional[int] = None
+    title: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    creation_date: Optional[datetime] = None
+    details: Optional[str] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+# get_pin
+class PinDetailResponseSchema(BaseModel):
+    pin: Optional[PinResponseSchema] = None
+    ownership_type: str
+
+# one page of get_all_pins?limit=
+class PinPageSchema(BaseModel):
+    items: list[PinResponseSchema]
+    next_cursor: Optional[int] = None
@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel
 from typing import Optional
 
@@ -22,3 +23,37 @@ class UserUpdateSchema(BaseModel):
 
     class Config:
         from_attributes = True
+
+# what read routes send back for a user, everything but the password hash
+class UserResponseSchema(BaseModel):
+    user_id: int
+    first_name: str
+    last_name: str
+    username: str
+    email: str
+    creation_date: Optional[datetime] = None
+    partnership_id: Optional[int] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+# one page of get_all_users?limit=
+class UserPageSchema(BaseModel):
+    items: list[UserResponseSchema]
+    next_cursor: Optional[int] = None
+
+# one match of search_users, just enough to pick the right person
+class UserSearchResultSchema(BaseModel):
+    user_id: int
+    username: str
+    first_name: str
+    last_name: str
+
+    class Config:
+        from_attributes = True
+
+# one page of search_users, best matches first. pass next_offset as offset for the next page
+class UserSearchPageSchema(BaseModel):
+    items: list[UserSearchResultSchema]
+    next_offset: Optional[int] = None
@@ -0,0 +1,123 @@
+import math
+
+# geohash precision stored on pins.geo_cell, roughly 150m x 150m cells
+GEOHASH_PRECISION = 7
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_EARTH_RADIUS_METERS = 6371008.8
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """
+    Encode a coordinate into a geohash. Pins that are close together share a prefix,
+    so a prefix match on an indexed column is a cheap "pins in this cell" lookup
+
+    Args:
+        latitude: latitude in degrees
+        longitude: longitude in degrees
+        precision: number of characters in the hash
+
+    Returns:
+        str: geohash of the cell containing the point
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        # bits alternate between longitude and latitude, starting with longitude
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits = bits << 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(geohash)
+
+
+def cell_size(precision: int) -> tuple[float, float]:
+    """
+    Size of a geohash cell in degrees
+
+    Returns:
+        tuple: (latitude degrees, longitude degrees)
+    """
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def covering_cells(min_lat: float, min_lon: float, max_lat: float, max_lon: float, precision: int) -> list[str]:
+    """
+    All geohash cells at a given precision that overlap a bounding box
+
+    Returns:
+        list[str]: geohashes, one per overlapping cell
+    """
+    lat_step, lon_step = cell_size(precision)
+    lat_cells = int(1 << (precision * 5 // 2))
+    lon_cells = int(1 << math.ceil(precision * 5 / 2))
+    lat_start = max(0, int((min_lat + 90.0) // lat_step))
+    lat_end = min(lat_cells - 1, int((max_lat + 90.0) // lat_step))
+    lon_start = max(0, int((min_lon + 180.0) // lon_step))
+    lon_end = min(lon_cells - 1, int((max_lon + 180.0) // lon_step))
+
+    cells = []
+    for lat_index in range(lat_start, lat_end + 1):
+        # encode the center of each cell so we never land on a boundary
+        latitude = -90.0 + (lat_index + 0.5) * lat_step
+        for lon_index in range(lon_start, lon_end + 1):
+            longitude = -180.0 + (lon_index + 0.5) * lon_step
+            cells.append(encode_geohash(latitude, longitude, precision))
+    return cells
+
+
+def count_covering_cells(min_lat: float, min_lon: float, max_lat: float, max_lon: float, precision: int) -> int:
+    """
+    Same as len(covering_cells(...)) without building the list
+    """
+    lat_step, lon_step = cell_size(precision)
+    lat_span = int((max_lat + 90.0) // lat_step) - int((min_lat + 90.0) // lat_step) + 1
+    lon_span = int((max_lon + 180.0) // lon_step) - int((min_lon + 180.0) // lon_step) + 1
+    return lat_span * lon_span
+
+
+def radius_bounds(latitude: float, longitude: float, meters: float) -> tuple[float, float, float, float]:
+    """
+    Bounding box that fully contains a circle around a point
+
+    Returns:
+        tuple: (min_lat, min_lon, max_lat, max_lon)
+    """
+    lat_delta = math.degrees(meters / _EARTH_RADIUS_METERS)
+    # longitude degrees shrink towards the poles
+    cos_lat = math.cos(math.radians(latitude))
+    lon_delta = 180.0 if cos_lat < 1e-12 else min(180.0, lat_delta / cos_lat)
+    return (
+        max(-90.0, latitude - lat_delta),
+        max(-180.0, longitude - lon_delta),
+        min(90.0, latitude + lat_delta),
+        min(180.0, longitude + lon_delta),
+    )
+
+
+def distance_meters(lat_1: float, lon_1: float, lat_2: float, lon_2: float) -> float:
+    """
+    Great-circle (haversine) distance between two points
+    """
+    phi_1 = math.radians(lat_1)
+    phi_2 = math.radians(lat_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(lon_2 - lon_1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    return 2 * _EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
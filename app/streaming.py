@@ -0,0 +1,80 @@
+import decimal
+import orjson
+
+from typing import Callable, Optional
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Row, Select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from .database import SessionLocal
+
+# rows fetched from the server-side cursor per round trip
+STREAM_BATCH_SIZE = 500
+
+
+def _json_default(value):
+    # orjson handles datetimes and enums itself, match what FastAPI's jsonable_encoder does for the rest
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def row_to_json(row) -> str:
+    return orjson.dumps(dict(row._mapping), default=_json_default).decode()
+
+
+def stream_rows(statement: Select, serialize: Callable[[Row], str], media_type: str,
+                header: str = "", batch_size: int = STREAM_BATCH_SIZE,
+                bind: Optional[AsyncEngine] = None) -> StreamingResponse:
+    """
+    Stream the rows of a select, one serialized row after another
+
+    The statement runs on a server-side cursor, so only batch_size rows are held in
+    memory at a time. It opens its own session because dependencies like get_db are
+    already closed by the time the response body is being sent.
+
+    Args:
+        statement: select of plain columns (not ORM entities)
+        serialize: turns one row into its text, including the line ending
+        media_type: content type of the response
+        header: text sent before the first row
+        batch_size: rows per fetch from the cursor
+        bind: engine to read from, e.g. a replica's. default the primary
+
+    Returns:
+        StreamingResponse: the rows as they are read
+    """
+    async def generate_rows():
+        if header:
+            yield header
+        async with SessionLocal(bind=bind) as db:
+            result = await db.stream(statement.execution_options(yield_per=batch_size))
+            async for partition in result.partitions():
+                yield "".join(serialize(row) for row in partition)
+
+    return StreamingResponse(generate_rows(), media_type=media_type)
+
+
+def ndjson_response(statement: Select, batch_size: int = STREAM_BATCH_SIZE,
+                    bind: Optional[AsyncEngine] = None) -> StreamingResponse:
+    """
+    Stream the rows of a select as newline-delimited JSON, see stream_rows
+    """
+    return stream_rows(statement, lambda row: row_to_json(row) + "\n", "application/x-ndjson",
+                       batch_size=batch_size, bind=bind)
+
+
+def keyset_page(rows: list, key: str, limit: int) -> dict:
+    """
+    Build one page of a keyset-paginated listing
+
+    Args:
+        rows: up to limit + 1 rows ordered by key, the extra row only tells us there's more
+        key: column used as the cursor
+        limit: page size
+
+    Returns:
+        JSON Object: items and next_cursor (None on the last page)
+    """
+    items = [dict(row._mapping) for row in rows[:limit]]
+    next_cursor = items[-1][key] if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
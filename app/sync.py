@@ -0,0 +1,101 @@
+import base64
+import binascii
+import datetime
+import os
+
+from typing import Optional
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import PinModel, UserPinModel
+from .purge import PURGE_RETENTION_SECONDS
+
+# how far behind "now" a new token points. updated_at comes from the database clock at
+# statement time, so a transaction that commits late can carry a timestamp a little
+# older than the last sync. re-sending a few seconds of changes is cheaper than losing one
+SYNC_OVERLAP_SECONDS = int(os.getenv("SYNC_OVERLAP_SECONDS", "2"))
+
+# geo_cell is internal to the spatial index, removal_date only matters for tombstones
+SYNC_PIN_COLUMNS = [column for column in PinModel.__table__.c if column.name not in ("geo_cell", "removal_date")]
+
+
+class InvalidSyncToken(Exception):
+    """
+    The token wasn't issued by sync_pins
+    """
+
+
+class ExpiredSyncToken(Exception):
+    """
+    The token is older than the tombstones we keep (see app/purge.py), removals since
+    then may be gone for good. the client has to start over with a full sync
+    """
+
+
+def encode_token(since: datetime.datetime) -> str:
+    return base64.urlsafe_b64encode(since.strftime("%Y-%m-%dT%H:%M:%S").encode()).decode().rstrip("=")
+
+
+def decode_token(token: str) -> datetime.datetime:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        return datetime.datetime.strptime(base64.urlsafe_b64decode(padded).decode(), "%Y-%m-%dT%H:%M:%S")
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidSyncToken(token)
+
+
+async def changes_since(db: AsyncSession, user_id: int, token: Optional[str]) -> dict:
+    """
+    Pins visible to a user (a live user_pins row, primary or secondary) that changed
+    since token, plus the ones that went away. Without a token everything is sent.
+
+    Changes can be sent twice around a token boundary (see SYNC_OVERLAP_SECONDS), so
+    clients should apply upserted and removed idempotently
+
+    Args:
+        db: database session
+        user_id: user to sync
+        token: token from the previous sync, or None for a full sync
+
+    Returns:
+        JSON Object: token for the next sync, full (whether this is a full snapshot),
+            upserted (pins with their ownership_type) and removed (pin ids)
+
+    Raises:
+        InvalidSyncToken: if token can't be decoded
+        ExpiredSyncToken: if token is older than the tombstone retention period
+    """
+    since = decode_token(token) if token else None
+    # read the clock before the changes, so anything written during this sync lands after the next token
+    now = (await db.execute(select(func.current_timestamp()))).scalar_one()
+    if isinstance(now, str):
+        now = datetime.datetime.fromisoformat(now)
+    if since is not None and since < now - datetime.timedelta(seconds=PURGE_RETENTION_SECONDS):
+        raise ExpiredSyncToken(token)
+
+    query = (
+        select(*SYNC_PIN_COLUMNS, UserPinModel.ownership_type)
+        .join(PinModel, PinModel.pin_id == UserPinModel.pin_id)
+        .filter(and_(UserPinModel.user_id == user_id,
+                     UserPinModel.removal_date.is_(None),
+                     PinModel.removal_date.is_(None)))
+        .order_by(UserPinModel.pin_id)
+    )
+    removed = []
+    if since is not None:
+        query = query.filter(or_(PinModel.updated_at >= since, UserPinModel.updated_at >= since))
+        # removal_date is a tombstone: removing a pin updates the row instead of deleting it
+        removed = list((await db.execute(
+            select(UserPinModel.pin_id)
+            .filter(and_(UserPinModel.user_id == user_id,
+                         UserPinModel.updated_at >= since,
+                         UserPinModel.removal_date.is_not(None)))
+            .order_by(UserPinModel.pin_id)
+        )).scalars())
+
+    upserted = [dict(row._mapping) for row in await db.execute(query)]
+    return {
+        "token": encode_token(now - datetime.timedelta(seconds=SYNC_OVERLAP_SECONDS)),
+        "full": since is None,
+        "upserted": upserted,
+        "removed": removed,
+    }
@@ -0,0 +1,371 @@
+import asyncio
+import datetime
+import logging
+import os
+import sys
+import time
+import unicodedata
+
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from typing import Iterator, NamedTuple, Optional
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import env  # noqa: F401  loads .env
+from .database import SessionLocal, db_now
+from .models import UserModel
+from .sync import SYNC_OVERLAP_SECONDS
+
+# how often the index picks up users changed by other workers (users.updated_at)
+USER_SEARCH_REFRESH_SECONDS = float(os.getenv("USER_SEARCH_REFRESH_SECONDS", "30"))
+# users read per query while the index loads
+USER_SEARCH_LOAD_BATCH = int(os.getenv("USER_SEARCH_LOAD_BATCH", "10000"))
+# users looked at per search. a common first word like "j" with a rare second one
+# could otherwise walk most of the index before it fills a page
+USER_SEARCH_MAX_CANDIDATES = int(os.getenv("USER_SEARCH_MAX_CANDIDATES", "5000"))
+# words per query that count, the rest are ignored
+USER_SEARCH_MAX_WORDS = 4
+
+class SearchUser(NamedTuple):
+    user_id: int
+    username: str
+    first_name: str
+    last_name: str
+
+
+def normalize(text: str) -> str:
+    """
+    What the index compares: case folded, accents dropped ("José" finds "jose")
+    """
+    folded = text.casefold()
+    if folded.isascii():
+        return folded.strip()
+    decomposed = unicodedata.normalize("NFKD", folded)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).strip()
+
+
+@lru_cache(maxsize=65536)
+def _name_words(name: str) -> tuple[str, ...]:
+    # names repeat a lot across users: normalize each one once, and intern the words so they're stored once
+    return tuple(sys.intern(word) for word in normalize(name).split())
+
+
+def query_words(query: str) -> list[str]:
+    return [word for word in normalize(query).split() if word][:USER_SEARCH_MAX_WORDS]
+
+
+class _IndexedUser(NamedTuple):
+    user: SearchUser
+    # normalized, what the index entries are made of
+    username: str
+    names: tuple[str, ...]
+
+
+def _indexed(user: SearchUser) -> _IndexedUser:
+    # first and last names can have several words, each one is searchable on its own
+    user = SearchUser(user.user_id, user.username, sys.intern(user.first_name), sys.intern(user.last_name))
+    username = normalize(user.username)
+    if username == user.username:
+        # most usernames are already lowercase ascii, don't keep a second copy
+        username = user.username
+    return _IndexedUser(user, username, _name_words(user.first_name) + _name_words(user.last_name))
+
+
+def _matches(word: str, indexed: _IndexedUser) -> bool:
+    return indexed.username.startswith(word) or any(name.startswith(word) for name in indexed.names)
+
+
+class _TermList:
+    """
+    (term, user_id) pairs in sorted order, split into blocks of up to 2 * BLOCK_SIZE.
+    finding a prefix is two binary searches, and an insert or delete only shifts one
+    block instead of the millions of entries behind it in a single list.
+    within a block the terms are a list and the ids an array, about half the memory of tuples
+    """
+
+    BLOCK_SIZE = 1000
+
+    def __init__(self, entries: list[tuple[str, int]] = ()):
+        self._terms: list[list[str]] = []
+        self._ids: list[array] = []
+        # first (term, user_id) of every block, to find the block a key belongs in
+        self._firsts: list[tuple[str, int]] = []
+        for start in range(0, len(entries), self.BLOCK_SIZE):
+            block = entries[start:start + self.BLOCK_SIZE]
+            self._terms.append([term for term, _ in block])
+            self._ids.append(array("q", (user_id for _, user_id in block)))
+            self._firsts.append(block[0])
+
+    def __len__(self) -> int:
+        return sum(len(terms) for terms in self._terms)
+
+    def _block_of(self, key: tuple[str, int]) -> int:
+        return max(0, bisect_right(self._firsts, key) - 1)
+
+    def _position(self, block: int, term: str, user_id: int) -> int:
+        terms = self._terms[block]
+        lo = bisect_left(terms, term)
+        hi = bisect_right(terms, term, lo)
+        return bisect_left(self._ids[block], user_id, lo, hi)
+
+    def insert(self, term: str, user_id: int):
+        if not self._terms:
+            self._terms.append([term])
+            self._ids.append(array("q", [user_id]))
+            self._firsts.append((term, user_id))
+            return
+        block = self._block_of((term, user_id))
+        position = self._position(block, term, user_id)
+        terms, ids = self._terms[block], self._ids[block]
+        terms.insert(position, term)
+        ids.insert(position, user_id)
+        if position == 0:
+            self._firsts[block] = (term, user_id)
+        if len(terms) > 2 * self.BLOCK_SIZE:
+            half = len(terms) // 2
+            self._terms[block + 1:block + 1] = [terms[half:]]
+            self._ids[block + 1:block + 1] = [ids[half:]]
+            self._firsts.insert(block + 1, (terms[half], ids[half]))
+            del terms[half:]
+            del ids[half:]
+
+    def delete(self, term: str, user_id: int):
+        if not self._terms:
+            return
+        block = self._block_of((term, user_id))
+        position = self._position(block, term, user_id)
+        terms, ids = self._terms[block], self._ids[block]
+        if position == len(terms) or terms[position] != term or ids[position] != user_id:
+            return
+        del terms[position]
+        del ids[position]
+        if not terms:
+            del self._terms[block], self._ids[block], self._firsts[block]
+        elif position == 0:
+            self._firsts[block] = (terms[0], ids[0])
+
+    def walk(self, prefix: str, start: str) -> Iterator[tuple[str, int]]:
+        """
+        Entries whose term starts with prefix and is >= start, in order
+        """
+        if not self._terms:
+            return
+        block = self._block_of((start, -1))
+        position = bisect_left(self._terms[block], start)
+        while block < len(self._terms):
+            terms, ids = self._terms[block], self._ids[block]
+            for index in range(position, len(terms)):
+                if not terms[index].startswith(prefix):
+                    return
+                yield terms[index], ids[index]
+            block += 1
+            position = 0
+
+
+class UserSearchIndex:
+    """
+    In-process prefix index over usernames and first/last names.
+
+    Usernames and name words are kept in two sorted _TermLists, so the users whose
+    username or name starts with a prefix are one contiguous run in each, found with
+    binary searches. that also gives the ranking for free, walking the runs in order:
+    whole username, whole first/last name, start of a username, start of a name, each
+    in term order. name words are interned: common first names are stored once.
+
+    Writes made by this worker are applied right away (add / remove from the user
+    routes), other workers' show up within USER_SEARCH_REFRESH_SECONDS. until the
+    first load finishes, search_users() asks the database instead
+    """
+
+    def __init__(self, max_candidates: int = USER_SEARCH_MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self._usernames = _TermList()
+        self._names = _TermList()
+        self._users: dict[int, _IndexedUser] = {}
+        self.loaded = False
+        # database time of the last load / refresh, next refresh asks for changes since then
+        self._synced_at: Optional[datetime.datetime] = None
+        self.lookups = 0
+        self.lookup_seconds = 0.0
+
+    def add(self, user: SearchUser):
+        """
+        Add a user, or update one that is already in the index
+        """
+        self.remove(user.user_id)
+        indexed = _indexed(user)
+        if indexed.username:
+            self._usernames.insert(indexed.username, user.user_id)
+        for name in set(indexed.names):
+            self._names.insert(name, user.user_id)
+        self._users[user.user_id] = indexed
+
+    def remove(self, user_id: int):
+        indexed = self._users.pop(user_id, None)
+        if indexed is not None:
+            self._usernames.delete(indexed.username, user_id)
+            for name in set(indexed.names):
+                self._names.delete(name, user_id)
+
+    def load(self, users: list[SearchUser]):
+        """
+        Replace the whole index, sorting once instead of inserting one by one
+        """
+        usernames, names = [], []
+        users_by_id = {}
+        for user in users:
+            indexed = _indexed(user)
+            users_by_id[user.user_id] = indexed
+            if indexed.username:
+                usernames.append((indexed.username, user.user_id))
+            names.extend((name, user.user_id) for name in set(indexed.names))
+        usernames.sort()
+        names.sort()
+        # swapped in at the end, searches keep using the old index until then
+        self._usernames, self._names, self._users = _TermList(usernames), _TermList(names), users_by_id
+
+    def _ranked(self, word: str) -> Iterator[int]:
+        # user ids in rank order, a user can come up more than once
+        for terms, exact in ((self._usernames, True), (self._names, True), (self._usernames, False), (self._names, False)):
+            if exact:
+                for term, user_id in terms.walk(word, word):
+                    if term != word:
+                        break
+                    yield user_id
+            else:
+                # everything after the exact matches: the smallest string bigger than word
+                for _, user_id in terms.walk(word, word + "\0"):
+                    yield user_id
+
+    def search(self, query: str, limit: int, offset: int = 0, exclude: Optional[int] = None) -> tuple[list[SearchUser], bool]:
+        """
+        Users matching every word of query, best first (see the class docstring).
+        with several words the longest one decides the order and the others have to
+        start the username or a name too. at most max_candidates users are looked at
+
+        Returns:
+            tuple: the page of users, and whether there are more after it
+        """
+        started = time.perf_counter()
+        words = query_words(query)
+        if not words:
+            return [], False
+        lead = max(words, key=len)
+        others = [word for word in words if word != lead]
+
+        seen = set() if exclude is None else {exclude}
+        page = []
+        skipped = 0
+        for user_id in self._ranked(lead):
+            if user_id in seen:
+                continue
+            seen.add(user_id)
+            if len(seen) > self.max_candidates:
+                break
+            indexed = self._users[user_id]
+            if not all(_matches(word, indexed) for word in others):
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            page.append(indexed.user)
+            if len(page) > limit:
+                break
+
+        self.lookups += 1
+        self.lookup_seconds += time.perf_counter() - started
+        return page[:limit], len(page) > limit
+
+    async def refresh(self, db: AsyncSession):
+        """
+        Load every user the first time, afterwards apply the users changed since the last refresh
+        """
+        # read the clock first, anything written while we read is picked up by the next refresh
+        now = await db_now(db)
+        if not self.loaded:
+            users = []
+            last_id = None
+            while True:
+                query = (select(UserModel.user_id, UserModel.username, UserModel.first_name, UserModel.last_name)
+                         .filter(UserModel.removal_date.is_(None))
+                         .order_by(UserModel.user_id)
+                         .limit(USER_SEARCH_LOAD_BATCH))
+                if last_id is not None:
+                    query = query.filter(UserModel.user_id > last_id)
+                rows = (await db.execute(query)).all()
+                users.extend(SearchUser(*row) for row in rows)
+                if len(rows) < USER_SEARCH_LOAD_BATCH:
+                    break
+                last_id = rows[-1].user_id
+            # sorting millions of entries takes seconds, keep it off the event loop
+            await asyncio.to_thread(self.load, users)
+            self.loaded = True
+        else:
+            rows = await db.execute(
+                select(UserModel.user_id, UserModel.username, UserModel.first_name, UserModel.last_name,
+                       UserModel.removal_date)
+                .filter(UserModel.updated_at >= self._synced_at - datetime.timedelta(seconds=SYNC_OVERLAP_SECONDS))
+            )
+            for row in rows:
+                if row.removal_date is None:
+                    self.add(SearchUser(row.user_id, row.username, row.first_name, row.last_name))
+                else:
+                    self.remove(row.user_id)
+        self._synced_at = now
+
+    async def run_forever(self, interval: float = USER_SEARCH_REFRESH_SECONDS):
+        """
+        Load the index, then keep refreshing it every interval until cancelled, see the app's lifespan
+        """
+        while True:
+            try:
+                async with SessionLocal() as db:
+                    await self.refresh(db)
+            except Exception as e:
+                logging.error(f"Error refreshing the user search index: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {"loaded": self.loaded, "users": len(self._users), "entries": len(self._usernames) + len(self._names), "lookups": self.lookups,
+                "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000, 4) if self.lookups else 0.0}
+
+
+user_search = UserSearchIndex()
+
+
+async def search_users(db: AsyncSession, query: str, limit: int, offset: int = 0,
+                       exclude: Optional[int] = None) -> tuple[list[SearchUser], bool]:
+    """
+    Search the index, or the database while the index is still loading. the database
+    only does prefix matches on whole columns (LIKE 'x%' on the indexed columns), in username order
+
+    Args:
+        db: database session, only used while the index loads
+        query: words to look for, each has to start a username, first or last name
+        limit: page size
+        offset: matches to skip
+        exclude: user to leave out, e.g. the one searching
+
+    Returns:
+        tuple: the page of users, and whether there are more after it
+    """
+    if user_search.loaded:
+        return user_search.search(query, limit, offset, exclude)
+
+    words = query_words(query)
+    if not words:
+        return [], False
+    conditions = [or_(UserModel.username.startswith(word, autoescape=True),
+                      UserModel.first_name.startswith(word, autoescape=True),
+                      UserModel.last_name.startswith(word, autoescape=True)) for word in words]
+    if exclude is not None:
+        conditions.append(UserModel.user_id != exclude)
+    rows = (await db.execute(
+        select(UserModel.user_id, UserModel.username, UserModel.first_name, UserModel.last_name)
+        .filter(and_(UserModel.removal_date.is_(None), *conditions))
+        .order_by(UserModel.username)
+        .offset(offset)
+        .limit(limit + 1)
+    )).all()
+    return [SearchUser(*row) for row in rows[:limit]], len(rows) > limit
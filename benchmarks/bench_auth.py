@@ -0,0 +1,167 @@
+"""
+What does checking a token cost an authenticated read?
+
+Logs a user in and runs --concurrency clients hammering get_pin and get_all_pins
+(warm cache) through the ASGI app, in these modes:
+
+  anonymous   no Authorization header, the baseline
+  token       bearer token, after the first request it is an LRU hit (app/auth.py)
+  token_cold  bearer token with the verified-token LRU turned off, an HMAC check per request
+  naive       what per-request auth done naively costs: HTTP Basic, a users query and a
+              bcrypt check on every request (--naive-requests of them, it is slow)
+
+plus the cost of SessionStore.validate on its own, in microseconds.
+
+    python -m benchmarks.bench_auth --requests 2000 --concurrency 16
+
+Results go to benchmarks/results/auth-<commit>.json.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+
+from benchmarks.common import REPO_ROOT, git_commit, summarize, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+
+import httpx  # noqa: E402
+from fastapi import HTTPException, Request  # noqa: E402
+from sqlalchemy import insert, select, text  # noqa: E402
+
+from app import auth, hashing  # noqa: E402
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import PinModel, UserModel  # noqa: E402
+from app.routes import auth_routes, user_routes  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+def naive_authorize(password_hasher: hashing.PasswordHasher):
+    async def authorize(user_id: int, request: Request):
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        username, _, password = base64.b64decode(credentials).decode().partition(":")
+        async with SessionLocal() as db:
+            user = (await db.execute(select(UserModel.user_id, UserModel.hashed_password)
+                                     .filter(UserModel.username == username))).first()
+        if user is None or user.user_id != user_id or not await password_hasher.verify(password, user.hashed_password):
+            raise HTTPException(status_code=401)
+    return authorize
+
+
+async def hammer(client: httpx.AsyncClient, paths: list[str], headers: dict, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for index in queue:
+            started = time.perf_counter()
+            response = await client.get(paths[index % len(paths)], headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def measure_validate(token: str, repeat: int) -> dict:
+    report = {}
+    for mode, store in (("lru_hit", auth.SessionStore()), ("hmac", auth.SessionStore(max_tokens=0))):
+        store.validate(token)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            store.validate(token)
+        report[f"{mode}_us"] = round((time.perf_counter() - started) / repeat * 1e6, 3)
+    return report
+
+
+async def run(args) -> dict:
+    password_hasher = hashing.PasswordHasher(rounds=args.rounds)
+    user_routes.password_hasher = auth_routes.password_hasher = password_hasher
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    report = {"modes": {}}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        (await client.post("/create_user", json={"username": "bench", "email": "bench@luna", "first_name": "B",
+                                                 "last_name": "B", "password": PASSWORD})).raise_for_status()
+        user_id = (await client.post("/login", json={"login": "bench", "password": PASSWORD})).json()["user_id"]
+        async with engine.begin() as connection:
+            await connection.execute(insert(PinModel), [{"pin_id": pin_id, "user_id": user_id, "title": f"pin {pin_id}",
+                                                         "latitude": 40 + pin_id / 1000, "longitude": -74 + pin_id / 1000,
+                                                         "details": ""} for pin_id in range(1, args.pins + 1)])
+            # sqlite has no after_pin_create trigger
+            await connection.execute(text("INSERT INTO user_pins (user_id, pin_id, ownership_type) "
+                                          "SELECT user_id, pin_id, 'primary' FROM pins"))
+
+        login = (await client.post("/login", json={"login": "bench", "password": PASSWORD})).json()
+        bearer = {"authorization": f"Bearer {login['access_token']}"}
+        basic = {"authorization": "Basic " + base64.b64encode(f"bench:{PASSWORD}".encode()).decode()}
+        routes = {"get_pin": [f"/get_pin/{user_id}/{pin_id}" for pin_id in range(1, args.pins + 1)],
+                  "get_all_pins": [f"/get_all_pins/{user_id}"]}
+        for paths in routes.values():
+            for path in paths:
+                (await client.get(path)).raise_for_status()  # warm the cache
+
+        lru_store = auth.sessions
+        for route, paths in routes.items():
+            report["modes"][route] = {
+                "anonymous": await hammer(client, paths, {}, args.requests, args.concurrency),
+                "token": await hammer(client, paths, bearer, args.requests, args.concurrency),
+            }
+            auth.sessions = auth.SessionStore(max_tokens=0)
+            report["modes"][route]["token_cold"] = await hammer(client, paths, bearer, args.requests, args.concurrency)
+            auth.sessions = lru_store
+            app.dependency_overrides[auth.authorize_user] = naive_authorize(password_hasher)
+            report["modes"][route]["naive"] = await hammer(client, paths, basic, args.naive_requests, args.concurrency)
+            app.dependency_overrides.clear()
+
+    report["validate"] = measure_validate(login["access_token"], args.validations)
+    password_hasher.shutdown()
+    await engine.dispose()
+    return report
+
+
+def main(args):
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "bcrypt_rounds": args.rounds,
+        "concurrency": args.concurrency,
+        **asyncio.run(run(args)),
+    }
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"auth-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+        results_file.write("\n")
+
+    for route, modes in report["modes"].items():
+        print(route)
+        for mode, numbers in modes.items():
+            print(f"  {mode:<11} {numbers['throughput_rps']:>9} req/s   p50 {numbers['p50_ms']:>8} ms   "
+                  f"p99 {numbers['p99_ms']:>8} ms   errors {numbers['errors']}")
+    print(f"SessionStore.validate: {report['validate']['lru_hit_us']} us on an LRU hit, "
+          f"{report['validate']['hmac_us']} us with the HMAC check")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per route and mode")
+    parser.add_argument("--naive-requests", type=int, default=40, help="requests for the naive mode")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--pins", type=int, default=100, help="pins of the benchmark user")
+    parser.add_argument("--rounds", type=int, default=hashing.BCRYPT_ROUNDS, help="bcrypt work factor")
+    parser.add_argument("--validations", type=int, default=100_000, help="calls for the validate timing")
+    parser.add_argument("--output", help="results file, default benchmarks/results/auth-<commit>.json")
+    main(parser.parse_args())
@@ -0,0 +1,106 @@
+"""
+Does signing up users slow down everyone else?
+
+Runs concurrent get_user reads against a throwaway SQLite database while a
+stream of create_user signups is going on, once with bcrypt running inline on
+the event loop (how create_user used to work) and once through
+app.hashing.password_hasher, and prints read latency percentiles for both.
+
+    python -m benchmarks.bench_password_hashing --signups 40 --readers 8
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from benchmarks.common import percentile, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+
+import httpx  # noqa: E402
+
+from app import hashing  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.routes import user_routes  # noqa: E402
+
+
+class InlineHasher:
+    """
+    The old behaviour: bcrypt straight on the event loop
+    """
+
+    def __init__(self, rounds: int):
+        self.rounds = rounds
+
+    async def hash(self, password: str) -> str:
+        return hashing._hash_password(password, self.rounds)
+
+
+async def run_mode(client: httpx.AsyncClient, mode: str, signups: int, readers: int) -> dict:
+    signups_done = asyncio.Event()
+    latencies = []
+
+    async def reader():
+        while not signups_done.is_set():
+            start = time.perf_counter()
+            response = await client.get("/get_user/1")
+            latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+
+    async def signup(i: int):
+        response = await client.post("/create_user", json={
+            "username": f"{mode}-{i}", "email": f"{mode}-{i}@bench", "first_name": "bench",
+            "last_name": "user", "password": "correct horse battery staple",
+        })
+        response.raise_for_status()
+
+    reader_tasks = [asyncio.create_task(reader()) for _ in range(readers)]
+    start = time.perf_counter()
+    await asyncio.gather(*(signup(i) for i in range(signups)))
+    elapsed = time.perf_counter() - start
+    signups_done.set()
+    await asyncio.gather(*reader_tasks)
+
+    return {
+        "mode": mode,
+        "signups": signups,
+        "signup_seconds": round(elapsed, 3),
+        "reads": len(latencies),
+        "read_p50_ms": round(percentile(latencies, 50), 2),
+        "read_p95_ms": round(percentile(latencies, 95), 2),
+        "read_p99_ms": round(percentile(latencies, 99), 2),
+        "read_mean_ms": round(statistics.fmean(latencies), 2),
+    }
+
+
+async def main(args):
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/create_user", json={
+            "username": "reader", "email": "reader@bench", "first_name": "bench",
+            "last_name": "reader", "password": "hunter2",
+        })
+        response.raise_for_status()
+
+        results = []
+        user_routes.password_hasher = InlineHasher(args.rounds)
+        results.append(await run_mode(client, "inline", args.signups, args.readers))
+        user_routes.password_hasher = hashing.PasswordHasher(rounds=args.rounds)
+        results.append(await run_mode(client, "pool", args.signups, args.readers))
+
+    print(json.dumps(results, indent=2))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=40)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=hashing.BCRYPT_ROUNDS)
+    asyncio.run(main(parser.parse_args()))
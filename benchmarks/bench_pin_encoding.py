@@ -0,0 +1,147 @@
+"""
+How much smaller and faster is the MessagePack pin listing than the JSON one?
+
+Seeds one user with --pins pins (for every size in --pins) and compares the two
+representations of get_all_pins:
+
+  payload  response bytes, raw and gzipped (what a proxy compressing responses would send)
+  encode   time to turn the cached listing into bytes: validating and dumping it through
+           the route's response_model, then orjson, for JSON (what FastAPI and ORJSONResponse
+           do on every request), encode_dicts for MessagePack (done once per cached listing)
+  request  p50 / p99 of the whole request with a warm cache, through the ASGI app
+  decode   time for a client to turn the bytes back into dicts (orjson.loads vs decode_columns)
+
+    python -m benchmarks.bench_pin_encoding --pins 10000 50000
+
+Results go to benchmarks/results/pin_encoding-<commit>.json.
+"""
+import argparse
+import asyncio
+import decimal
+import gzip
+import json
+import os
+import random
+import time
+
+from benchmarks.common import REPO_ROOT, git_commit, percentile, random_coordinate, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+
+import httpx  # noqa: E402
+import orjson  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import delete, insert  # noqa: E402
+
+from app.cache import cache, user_pins_key  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import PinModel, UserModel  # noqa: E402
+from app.pin_encoding import decode_columns, encode_dicts  # noqa: E402
+from app.routes.pin_routes import PIN_PUBLIC_COLUMN_NAMES  # noqa: E402
+from app.schemas.pin_schema import PinResponseSchema  # noqa: E402
+
+MSGPACK = {"accept": "application/msgpack"}
+LISTING = TypeAdapter(list[PinResponseSchema])
+
+
+async def seed(pins: int, seed: int = 0):
+    rng = random.Random(seed)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.execute(delete(PinModel))
+        await connection.execute(delete(UserModel))
+        await connection.execute(insert(UserModel), [{"user_id": 1, "username": "bench", "first_name": "B",
+                                                      "last_name": "B", "email": "bench@luna", "hashed_password": "x"}])
+        rows = []
+        for pin_id in range(1, pins + 1):
+            latitude, longitude = random_coordinate(rng)
+            rows.append({"pin_id": pin_id, "user_id": 1, "title": f"pin {pin_id}",
+                         "latitude": decimal.Decimal(str(latitude)), "longitude": decimal.Decimal(str(longitude)),
+                         "details": rng.choice(["", "coffee", "best tacos in town", "where we met"])})
+        for start in range(0, len(rows), 1000):
+            await connection.execute(insert(PinModel), rows[start:start + 1000])
+    await cache.delete(user_pins_key(1))
+
+
+def timed(function, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def stats(samples: list[float]) -> dict:
+    return {"p50_ms": round(percentile(samples, 50), 3), "p99_ms": round(percentile(samples, 99), 3)}
+
+
+async def measure(pins: int, repeat: int) -> dict:
+    await seed(pins)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # warms the cache with the listing, the same dicts both encoders start from
+        as_json = (await client.get("/get_all_pins/1")).content
+        as_msgpack = (await client.get("/get_all_pins/1", headers=MSGPACK)).content
+        assert len(decode_columns(as_msgpack)) == len(orjson.loads(as_json)) == pins
+
+        listing = (await cache.get(user_pins_key(1)))["pins"]
+        report = {"pins": pins, "payload": {}, "encode": {}, "request": {}, "decode": {}}
+        for name, payload in (("json", as_json), ("msgpack", as_msgpack)):
+            report["payload"][name] = {"bytes": len(payload), "gzip_bytes": len(gzip.compress(payload, 6))}
+        report["encode"]["json"] = stats(timed(
+            lambda: orjson.dumps(LISTING.dump_python(LISTING.validate_python(listing), mode="json")), repeat))
+        report["encode"]["msgpack"] = stats(timed(lambda: encode_dicts(listing, PIN_PUBLIC_COLUMN_NAMES), repeat))
+        report["decode"]["json"] = stats(timed(lambda: orjson.loads(as_json), repeat))
+        report["decode"]["msgpack"] = stats(timed(lambda: decode_columns(as_msgpack), repeat))
+
+        for name, headers in (("json", {}), ("msgpack", MSGPACK)):
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = await client.get("/get_all_pins/1", headers=headers)
+                samples.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200
+            report["request"][name] = stats(samples)
+    return report
+
+
+async def run(sizes: list[int], repeat: int) -> list[dict]:
+    try:
+        return [await measure(pins, repeat) for pins in sizes]
+    finally:
+        await engine.dispose()
+
+
+def main(args):
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "columns": PIN_PUBLIC_COLUMN_NAMES,
+        "sizes": asyncio.run(run(args.pins, args.repeat)),
+    }
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"pin_encoding-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+        results_file.write("\n")
+
+    for size in report["sizes"]:
+        print(f"{size['pins']} pins")
+        for name in ("json", "msgpack"):
+            payload = size["payload"][name]
+            print(f"  {name:<8} {payload['bytes']:>10} bytes  {payload['gzip_bytes']:>9} gzipped   "
+                  f"encode p50 {size['encode'][name]['p50_ms']:>8} ms   "
+                  f"request p50 {size['request'][name]['p50_ms']:>8} ms   "
+                  f"decode p50 {size['decode'][name]['p50_ms']:>8} ms")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pins", type=int, nargs="+", default=[10_000, 50_000], help="listing sizes to compare")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="results file, default benchmarks/results/pin_encoding-<commit>.json")
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+"""
+Does batching create_pin help when pins come in bursts?
+
+Runs --clients concurrent clients, each creating --pins-per-client pins as fast as
+it can (think of a trip's worth of pins being synced), once with every request
+written on its own and once per batch window in --windows, and reports throughput,
+latency percentiles and the batch sizes the pipeline ended up with.
+
+SQLite commits are cheap compared to a round trip to MySQL, so against the real
+database the gap between per-request and batched writes is wider than here.
+
+    python -m benchmarks.bench_pin_writes --clients 64 --pins-per-client 20 --windows 1 2 5 10
+
+Results go to benchmarks/results/pin_writes-<commit>.json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.common import REPO_ROOT, git_commit, summarize, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+# admission control would only let ADMISSION_WRITE_LIMIT (8) requests wait in a batch at once
+os.environ.setdefault("ADMISSION_WRITE_LIMIT", "256")
+os.environ.setdefault("ADMISSION_WRITE_QUEUE", "1024")
+os.environ.setdefault("ADMISSION_WRITE_WAIT_SECONDS", "30")
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app import pin_bulk  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import UserModel  # noqa: E402
+from app.routes import pin_routes  # noqa: E402
+
+
+async def run_mode(client: httpx.AsyncClient, mode_index: int, window_ms, clients: int, pins_per_client: int,
+                   max_rows: int) -> dict:
+    if window_ms is None:
+        pin_routes.PIN_WRITE_BATCHING = False
+    else:
+        pin_routes.PIN_WRITE_BATCHING = True
+        pin_routes.pin_writes = pin_bulk.PinWriteBatcher(window_ms=window_ms, max_rows=max_rows)
+    latencies = []
+    errors = 0
+
+    async def sync_trip(client_index: int):
+        nonlocal errors
+        user_id = client_index + 1
+        for pin_index in range(pins_per_client):
+            # ~100 m apart, and every mode in its own area, so nothing is a duplicate
+            pin = {"user_id": user_id, "title": f"pin {pin_index}", "details": "",
+                   "latitude": -80 + client_index * 0.01, "longitude": -170 + mode_index * 30 + pin_index * 0.001}
+            started = time.perf_counter()
+            response = await client.post(f"/create_pin/{user_id}", json=pin)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sync_trip(index) for index in range(clients)))
+    report = {"window_ms": window_ms, **summarize(latencies, errors, time.perf_counter() - started)}
+    if window_ms is not None:
+        stats = pin_routes.pin_writes.stats()
+        report.update({"batches": stats["batches"], "avg_batch": stats["avg_batch"], "largest_batch": stats["largest_batch"]})
+    return report
+
+
+async def run(args) -> list[dict]:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.execute(insert(UserModel), [
+            {"user_id": user_id, "username": f"user{user_id}", "first_name": "B", "last_name": "B",
+             "email": f"user{user_id}@bench", "hashed_password": "x"} for user_id in range(1, args.clients + 1)])
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        for mode_index, window_ms in enumerate([None, *args.windows]):
+            results.append(await run_mode(client, mode_index, window_ms, args.clients, args.pins_per_client, args.max_rows))
+    await engine.dispose()
+    return results
+
+
+def main(args):
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "clients": args.clients,
+        "pins_per_client": args.pins_per_client,
+        "max_rows": args.max_rows,
+        "modes": asyncio.run(run(args)),
+    }
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"pin_writes-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+        results_file.write("\n")
+
+    for mode in report["modes"]:
+        name = "per request" if mode["window_ms"] is None else f"{mode['window_ms']} ms window"
+        batches = f"   avg batch {mode['avg_batch']:>6} (max {mode['largest_batch']})" if "avg_batch" in mode else ""
+        print(f"{name:<14} {mode['throughput_rps']:>9} pins/s   p50 {mode['p50_ms']:>8} ms   "
+              f"p99 {mode['p99_ms']:>8} ms   errors {mode['errors']}{batches}")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=64, help="clients creating pins at the same time")
+    parser.add_argument("--pins-per-client", type=int, default=20)
+    parser.add_argument("--windows", type=float, nargs="+", default=[1, 2, 5, 10], help="batch windows to try, in ms")
+    parser.add_argument("--max-rows", type=int, default=pin_bulk.PIN_WRITE_BATCH_MAX_ROWS, help="rows that close a batch early")
+    parser.add_argument("--output", help="results file, default benchmarks/results/pin_writes-<commit>.json")
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""
+What does it cost to turn 1k pins into a response body?
+
+Seeds a throwaway SQLite database, then times the get_all_pins path both ways,
+per 1000 pins:
+
+  before: select(PinModel) -> ORM instances -> dict per instance ->
+          jsonable_encoder -> JSONResponse (json.dumps)
+  after:  select(columns) -> rows -> list[PinResponseSchema] validated and
+          dumped by pydantic-core (what FastAPI does with a response_model) ->
+          ORJSONResponse
+
+fetch and serialize are reported separately so the ORM and the encoder costs
+can be told apart. Both bodies are checked to decode to the same JSON.
+
+    python -m benchmarks.bench_serialization --pins 1000 --repeat 50
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from benchmarks.common import seed_database, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+from app.database import SessionLocal, engine  # noqa: E402
+from app.models import PinModel  # noqa: E402
+from app.routes.pin_routes import PIN_PUBLIC_COLUMNS  # noqa: E402
+from app.schemas.pin_schema import PinResponseSchema  # noqa: E402
+
+pins_adapter = TypeAdapter(list[PinResponseSchema])
+
+
+async def fetch_orm(db, user_id: int) -> list[dict]:
+    pins = (await db.execute(select(PinModel).filter(PinModel.user_id == user_id))).scalars().all()
+    # what get_all_pins cached before: every column of the instance, geo_cell included
+    return [{column.name: getattr(pin, column.name) for column in pin.__table__.columns} for pin in pins]
+
+
+async def fetch_columns(db, user_id: int) -> list:
+    return (await db.execute(select(*PIN_PUBLIC_COLUMNS).filter(PinModel.user_id == user_id))).all()
+
+
+def serialize_before(pins: list[dict]) -> bytes:
+    return JSONResponse(jsonable_encoder(pins)).body
+
+
+def serialize_after(rows: list) -> bytes:
+    content = pins_adapter.dump_python(pins_adapter.validate_python(rows, from_attributes=True), mode="json")
+    return ORJSONResponse(content).body
+
+
+async def time_mode(fetch, serialize, repeat: int, pins: int) -> tuple[dict, bytes]:
+    fetch_ms, serialize_ms = [], []
+    body = b""
+    for _ in range(repeat):
+        async with SessionLocal() as db:
+            start = time.perf_counter()
+            data = await fetch(db, 1)
+            fetched = time.perf_counter()
+            body = serialize(data)
+            done = time.perf_counter()
+        fetch_ms.append((fetched - start) * 1000)
+        serialize_ms.append((done - fetched) * 1000)
+    per_1k = 1000 / pins
+    return {
+        "fetch_ms_per_1k": round(statistics.median(fetch_ms) * per_1k, 3),
+        "serialize_ms_per_1k": round(statistics.median(serialize_ms) * per_1k, 3),
+        "total_ms_per_1k": round(statistics.median(f + s for f, s in zip(fetch_ms, serialize_ms)) * per_1k, 3),
+        "body_bytes": len(body),
+    }, body
+
+
+async def main(args):
+    await seed_database(engine, users=1, pins_per_user=args.pins, partnership_ratio=0)
+
+    before, before_body = await time_mode(fetch_orm, serialize_before, args.repeat, args.pins)
+    after, after_body = await time_mode(fetch_columns, serialize_after, args.repeat, args.pins)
+
+    # the new body drops geo_cell / removal_date, everything else has to match
+    hidden = ("geo_cell", "removal_date")
+    expected = [{k: v for k, v in pin.items() if k not in hidden} for pin in json.loads(before_body)]
+    assert expected == json.loads(after_body), "before and after bodies differ"
+
+    print(json.dumps({"pins": args.pins, "repeat": args.repeat, "before": before, "after": after,
+                      "serialize_speedup": round(before["serialize_ms_per_1k"] / after["serialize_ms_per_1k"], 2),
+                      "total_speedup": round(before["total_ms_per_1k"] / after["total_ms_per_1k"], 2)}, indent=2))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pins", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
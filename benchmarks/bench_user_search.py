@@ -0,0 +1,180 @@
+"""
+How fast is search_users, and what does its index cost?
+
+Builds the in-memory user search index from synthetic users (common first and
+last names, so prefixes like "jo" match a lot of people) and reports:
+
+  load     time to build the index from --users users, and the memory it holds
+  lookup   p50 / p99 per query for 1, 2, 3 letter and two word queries
+  update   time per add (a new or renamed user) and remove
+  database the same queries against SQLite for --db-users users, as the
+           index's fallback (LIKE 'x%' per column) and as a naive
+           LIKE '%x%' scan, for comparison
+
+    python -m benchmarks.bench_user_search --users 1000000 --db-users 100000
+
+Results go to benchmarks/results/user_search-<commit>.json.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from benchmarks.common import REPO_ROOT, git_commit, percentile, temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+
+from sqlalchemy import insert, or_, select  # noqa: E402
+
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.models import UserModel  # noqa: E402
+from app.user_search import SearchUser, UserSearchIndex, search_users, user_search  # noqa: E402
+
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael", "Linda", "William", "Elizabeth",
+               "David", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen",
+               "José", "María", "Juan", "Ana", "Luis", "Sofía", "Wei", "Yuki", "Olga", "Ahmed", "Fatima", "Chloé"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+              "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+              "Lee", "Pérez", "Thompson", "White", "Harris", "Sánchez", "Clark", "Ramirez", "Lewis", "Robinson",
+              "Van der Berg", "O'Brien", "Nguyen", "Kim", "Müller", "Rossi"]
+QUERIES = {
+    "1 letter": ["j", "m", "s", "a", "w"],
+    "2 letters": ["jo", "ma", "sm", "ga", "wi"],
+    "3 letters": ["joh", "mar", "smi", "gar", "wil"],
+    "username": ["user12345", "user99", "user4242"],
+    "two words": ["john sm", "maria gar", "ana ro", "wei ki"],
+}
+
+
+def make_users(count: int, seed: int = 0) -> list[SearchUser]:
+    rng = random.Random(seed)
+    return [SearchUser(user_id, f"user{user_id}", rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+            for user_id in range(1, count + 1)]
+
+
+def measure_load(users: list[SearchUser]) -> tuple[UserSearchIndex, dict]:
+    started = time.perf_counter()
+    index = UserSearchIndex()
+    index.load(users)
+    elapsed = time.perf_counter() - started
+
+    # tracing slows the build down a lot, so memory is measured on a second one
+    gc.collect()
+    tracemalloc.start()
+    traced = UserSearchIndex()
+    traced.load(users)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced
+    return index, {"users": len(users), "entries": index.stats()["entries"], "seconds": round(elapsed, 3),
+                   "memory_mb": round(memory / 2 ** 20, 1)}
+
+
+def measure_lookups(index: UserSearchIndex, repeat: int) -> dict:
+    report = {}
+    for kind, queries in QUERIES.items():
+        samples = []
+        matches = 0
+        for _ in range(repeat):
+            for query in queries:
+                started = time.perf_counter()
+                users, _ = index.search(query, limit=20)
+                samples.append((time.perf_counter() - started) * 1000)
+                matches += len(users)
+        report[kind] = {"p50_ms": round(percentile(samples, 50), 4), "p99_ms": round(percentile(samples, 99), 4),
+                        "avg_results": round(matches / len(samples), 1)}
+    return report
+
+
+def measure_updates(index: UserSearchIndex, count: int) -> dict:
+    rng = random.Random(1)
+    next_id = max(index._users) + 1 if index._users else 1
+    new_users = [SearchUser(next_id + offset, f"new{offset}", rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+                 for offset in range(count)]
+    started = time.perf_counter()
+    for user in new_users:
+        index.add(user)
+    add_ms = (time.perf_counter() - started) * 1000 / count
+    started = time.perf_counter()
+    for user in new_users:
+        index.remove(user.user_id)
+    remove_ms = (time.perf_counter() - started) * 1000 / count
+    return {"add_ms": round(add_ms, 4), "remove_ms": round(remove_ms, 4)}
+
+
+async def measure_database(users: list[SearchUser], repeat: int) -> dict:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        rows = [{"user_id": user.user_id, "username": user.username, "first_name": user.first_name,
+                 "last_name": user.last_name, "email": f"{user.username}@bench.luna", "hashed_password": "x"}
+                for user in users]
+        for start in range(0, len(rows), 1000):
+            await connection.execute(insert(UserModel), rows[start:start + 1000])
+
+    report = {}
+    async with SessionLocal() as db:
+        for kind, queries in QUERIES.items():
+            fallback, naive = [], []
+            for _ in range(repeat):
+                for query in queries:
+                    started = time.perf_counter()
+                    await search_users(db, query, limit=20)
+                    fallback.append((time.perf_counter() - started) * 1000)
+                    word = query.split()[0]
+                    started = time.perf_counter()
+                    await db.execute(select(UserModel.user_id).filter(or_(
+                        UserModel.username.contains(word), UserModel.first_name.contains(word),
+                        UserModel.last_name.contains(word))).limit(20))
+                    naive.append((time.perf_counter() - started) * 1000)
+            report[kind] = {"prefix_fallback_p50_ms": round(percentile(fallback, 50), 3),
+                            "naive_like_p50_ms": round(percentile(naive, 50), 3)}
+    await engine.dispose()
+    return report
+
+
+def main(args):
+    users = make_users(args.users)
+    index, load = measure_load(users)
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "load": load,
+        "lookup": measure_lookups(index, args.repeat),
+        "update": measure_updates(index, args.updates),
+    }
+    del index, users
+    if args.db_users:
+        assert not user_search.loaded  # search_users has to take the database path
+        report["database"] = {"users": args.db_users, **asyncio.run(measure_database(make_users(args.db_users), args.repeat))}
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"user_search-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+        results_file.write("\n")
+
+    print(f"index of {load['users']} users ({load['entries']} entries): built in {load['seconds']} s, {load['memory_mb']} MB")
+    for kind, numbers in report["lookup"].items():
+        print(f"  {kind:<12} p50 {numbers['p50_ms']:>8} ms   p99 {numbers['p99_ms']:>8} ms   {numbers['avg_results']} results")
+    print(f"  add {report['update']['add_ms']} ms, remove {report['update']['remove_ms']} ms")
+    if "database" in report:
+        print(f"sqlite, {args.db_users} users:")
+        for kind, numbers in report["database"].items():
+            if isinstance(numbers, dict):
+                print(f"  {kind:<12} LIKE 'x%' p50 {numbers['prefix_fallback_p50_ms']:>8} ms   "
+                      f"LIKE '%x%' p50 {numbers['naive_like_p50_ms']:>8} ms")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000, help="users in the in-memory index")
+    parser.add_argument("--db-users", type=int, default=100_000, help="users in the SQLite comparison, 0 to skip it")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=1000, help="users added and removed for the update timing")
+    parser.add_argument("--output", help="results file, default benchmarks/results/user_search-<commit>.json")
+    main(parser.parse_args())
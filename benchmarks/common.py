@@ -0,0 +1,133 @@
+"""
+Helpers shared by the benchmark scripts: throwaway databases, seeding and stats
+"""
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def temp_sqlite_url(name: str = "bench.db") -> str:
+    """
+    A file-backed SQLite database in a fresh temp dir, so every run starts empty
+    """
+    return f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='luna-bench-'), name)}"
+
+
+def use_database(url: str):
+    """
+    Point app.database at url. Has to run before anything under app/ is imported
+    """
+    os.environ["DATABASE_URL"] = url
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(latencies_ms: list[float], errors: int, elapsed_seconds: float) -> dict:
+    """
+    Throughput and latency percentiles for one route
+    """
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "throughput_rps": round(len(latencies_ms) / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies_ms), 3) if latencies_ms else 0.0,
+    }
+
+
+def random_coordinate(rng: random.Random) -> tuple[float, float]:
+    # spread pins over a few metro-sized areas so the spatial index has realistic density
+    centers = [(40.7128, -74.0060), (34.0522, -118.2437), (51.5074, -0.1278), (35.6762, 139.6503)]
+    latitude, longitude = rng.choice(centers)
+    return round(latitude + rng.uniform(-0.5, 0.5), 6), round(longitude + rng.uniform(-0.5, 0.5), 6)
+
+
+async def seed_database(engine, users: int, pins_per_user: int, partnership_ratio: float = 0.5,
+                        seed: int = 0, chunk_size: int = 1000) -> dict:
+    """
+    Create the schema and fill it with users, partnerships, pins and their user_pins rows
+
+    Inserts go through multi-row statements with explicit ids so we don't need a
+    round trip per row (and don't rely on the MySQL triggers that normally fill user_pins)
+
+    Returns:
+        dict: how many of each row were inserted
+    """
+    import bcrypt
+    from sqlalchemy import bindparam, insert, update
+    from app.database import Base
+    from app.models import OwnershipType, PinModel, UserModel, UserPartnershipModel, UserPinModel
+    from app.spatial import encode_geohash
+
+    rng = random.Random(seed)
+    # every seeded user shares one cheap hash, hashing per row would dominate seeding time
+    hashed_password = bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4)).decode("utf-8")
+
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+    user_rows = [{
+        "user_id": user_id,
+        "first_name": f"first{user_id}",
+        "last_name": f"last{user_id}",
+        "username": f"user{user_id}",
+        "email": f"user{user_id}@bench.luna",
+        "hashed_password": hashed_password,
+    } for user_id in range(1, users + 1)]
+
+    partnership_rows = []
+    partnered = list(range(1, users + 1))
+    rng.shuffle(partnered)
+    for index in range(0, int(len(partnered) * partnership_ratio) - 1, 2):
+        partnership_id = len(partnership_rows) + 1
+        partnership_rows.append({"partnership_id": partnership_id,
+                                 "user_id_1": partnered[index], "user_id_2": partnered[index + 1]})
+
+    pin_rows = []
+    user_pin_rows = []
+    for user_id in range(1, users + 1):
+        for _ in range(pins_per_user):
+            pin_id = len(pin_rows) + 1
+            latitude, longitude = random_coordinate(rng)
+            pin_rows.append({"pin_id": pin_id, "user_id": user_id, "title": f"pin {pin_id}",
+                             "latitude": latitude, "longitude": longitude, "details": "seeded",
+                             "geo_cell": encode_geohash(latitude, longitude)})
+            user_pin_rows.append({"user_id": user_id, "pin_id": pin_id, "ownership_type": OwnershipType.primary})
+
+    async with engine.begin() as connection:
+        for model, rows in ((UserModel, user_rows), (UserPartnershipModel, partnership_rows),
+                            (PinModel, pin_rows), (UserPinModel, user_pin_rows)):
+            for start in range(0, len(rows), chunk_size):
+                await connection.execute(insert(model), rows[start:start + chunk_size])
+        # users and partnerships point at each other, so partnership_id is filled in after both exist
+        link_rows = [{"member_id": row[member], "linked_partnership_id": row["partnership_id"]}
+                     for row in partnership_rows for member in ("user_id_1", "user_id_2")]
+        link_users = (update(UserModel)
+                      .where(UserModel.user_id == bindparam("member_id"))
+                      .values(partnership_id=bindparam("linked_partnership_id")))
+        for start in range(0, len(link_rows), chunk_size):
+            await connection.execute(link_users, link_rows[start:start + chunk_size])
+
+    return {"users": len(user_rows), "partnerships": len(partnership_rows), "pins": len(pin_rows)}
@@ -0,0 +1,45 @@
+"""
+Compare two load test result files route by route.
+
+    python -m benchmarks.compare benchmarks/results/loadtest-abc123.json benchmarks/results/loadtest-def456.json
+"""
+import argparse
+import json
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main(args):
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = json.load(before_file)
+        after = json.load(after_file)
+
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    if before.get("config") != after.get("config"):
+        print("warning: the two runs used different configs")
+
+    print(f"{'route':<14}" + "".join(f"{metric:>24}" for metric in METRICS))
+    routes = sorted(set(before["routes"]) | set(after["routes"]))
+    for route in [*routes, "total"]:
+        old = before["routes"].get(route, {}) if route != "total" else before["total"]
+        new = after["routes"].get(route, {}) if route != "total" else after["total"]
+        cells = []
+        for metric in METRICS:
+            if metric in old and metric in new:
+                cells.append(f"{old[metric]:>8} -> {new[metric]:<8}{change(old[metric], new[metric]):>7}")
+            else:
+                cells.append("missing")
+        print(f"{route:<14}" + "".join(f"{cell:>24}" for cell in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    main(parser.parse_args())
@@ -0,0 +1,220 @@
+"""
+Mixed-traffic load test for the API.
+
+Seeds a throwaway database (SQLite by default, or any disposable database given
+with --database-url), boots app.main:app under uvicorn against it, drives a mix
+of get_pin / get_all_pins / create_pin / create_user requests at a fixed
+concurrency and writes throughput and p50/p95/p99 per route to a JSON file.
+
+    python -m benchmarks.loadtest --users 200 --pins-per-user 50 --concurrency 32 --duration 20
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+
+--in-process skips uvicorn and calls the app through httpx's ASGI transport,
+which takes the network out of the numbers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.common import (REPO_ROOT, git_commit, random_coordinate, seed_database, summarize, temp_sqlite_url,
+                               use_database)
+
+DEFAULT_MIX = "get_pin=50,get_all_pins=30,create_pin=15,create_user=5"
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        route, weight = part.split("=")
+        weights[route.strip()] = int(weight)
+    return weights
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(client, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = await client.get("/check-db")
+            if response.status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not come up in time")
+
+
+class TrafficGenerator:
+    """
+    Builds requests for each route in the mix from what was seeded
+    """
+
+    def __init__(self, users: int, pins_per_user: int, seed: int):
+        self.users = users
+        self.pins_per_user = pins_per_user
+        self.rng = random.Random(seed)
+        self.created = 0
+
+    def request(self, route: str) -> tuple[str, str, dict]:
+        user_id = self.rng.randint(1, self.users)
+        if route == "get_pin":
+            # seeded pins are numbered user by user
+            pin_id = (user_id - 1) * self.pins_per_user + self.rng.randint(1, self.pins_per_user)
+            return "GET", f"/get_pin/{user_id}/{pin_id}", {}
+        if route == "get_all_pins":
+            return "GET", f"/get_all_pins/{user_id}", {}
+        if route == "create_pin":
+            latitude, longitude = random_coordinate(self.rng)
+            return "POST", f"/create_pin/{user_id}", {"json": {
+                "latitude": latitude, "longitude": longitude, "title": "load test",
+                "details": "created by benchmarks.loadtest", "user_id": user_id,
+            }}
+        if route == "create_user":
+            self.created += 1
+            name = f"load{os.getpid()}-{self.created}"
+            return "POST", "/create_user", {"json": {
+                "username": name, "email": f"{name}@bench.luna", "first_name": "load",
+                "last_name": "test", "password": "benchmark",
+            }}
+        raise ValueError(f"unknown route in mix: {route}")
+
+
+async def drive(client, generator: TrafficGenerator, mix: dict[str, int], concurrency: int,
+                duration: float, total_requests: int) -> dict:
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    latencies = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    issued = 0
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        nonlocal issued
+        while time.monotonic() < deadline and (not total_requests or issued < total_requests):
+            issued += 1
+            route = generator.rng.choices(routes, weights)[0]
+            method, url, kwargs = generator.request(route)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                ok = response.status_code < 500
+            except Exception:
+                ok = False
+            latencies[route].append((time.perf_counter() - start) * 1000)
+            if not ok:
+                errors[route] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [latency for route in routes for latency in latencies[route]]
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "total": summarize(all_latencies, sum(errors.values()), elapsed),
+        "routes": {route: summarize(latencies[route], errors[route], elapsed) for route in routes},
+    }
+
+
+async def main(args):
+    import httpx
+
+    database_url = args.database_url or temp_sqlite_url()
+    use_database(database_url)
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    seed_engine = create_async_engine(database_url)
+    seed_start = time.perf_counter()
+    seeded = await seed_database(seed_engine, args.users, args.pins_per_user, args.partnership_ratio, args.seed)
+    seed_seconds = time.perf_counter() - seed_start
+    await seed_engine.dispose()
+
+    server = None
+    if args.in_process:
+        from app.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+    else:
+        port = free_port()
+        env = {**os.environ, "DATABASE_URL": database_url}
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=REPO_ROOT, env=env,
+        )
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30.0)
+
+    try:
+        await wait_until_up(client)
+        generator = TrafficGenerator(args.users, args.pins_per_user, args.seed)
+        if args.warmup:
+            await drive(client, generator, parse_mix(args.mix), args.concurrency, args.warmup, 0)
+        results = await drive(client, generator, parse_mix(args.mix), args.concurrency, args.duration, args.requests)
+    finally:
+        await client.aclose()
+        if args.in_process:
+            from app.database import engine
+            await engine.dispose()
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "database": database_url.split("://")[0],
+            "mode": "in-process" if args.in_process else f"uvicorn x{args.workers}",
+            "users": args.users,
+            "pins_per_user": args.pins_per_user,
+            "partnership_ratio": args.partnership_ratio,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "seeded": {**seeded, "seconds": round(seed_seconds, 3)},
+        **results,
+    }
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"loadtest-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2, sort_keys=True)
+        results_file.write("\n")
+
+    print(f"{'route':<14}{'reqs':>8}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in [*report["routes"].items(), ("total", report["total"])]:
+        print(f"{route:<14}{stats['requests']:>8}{stats['errors']:>8}{stats['throughput_rps']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="disposable database to seed, default: a temp SQLite file")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--pins-per-user", type=int, default=20)
+    parser.add_argument("--partnership-ratio", type=float, default=0.5, help="fraction of users in a partnership")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of measured traffic")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests (0 = no limit)")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of unmeasured traffic first")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"route weights, default {DEFAULT_MIX}")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--in-process", action="store_true", help="call the app directly instead of over HTTP")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file, default benchmarks/results/loadtest-<commit>.json")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,166 @@
+"""
+How many SQL statements does each route run? Fails when that changes.
+
+Runs every route of user_routes and pin_routes through the ASGI app against a fresh
+SQLite database, in an order where each request finds the state the previous ones
+left behind (cold and warm caches, the pin index loading on first use), and counts
+the statements each request sends with an engine event. Every request has the count
+it is expected to make in CHECKS; the script prints a table and exits with 1 if any
+request made a different number of statements (or got an unexpected status), so a
+route that picks up an extra round trip is caught before it ships.
+
+Counts are for SQLite. MySQL runs the same statements, its triggers (after_pin_create,
+the partnership ones) run inside the statement that fires them and aren't round trips.
+When a route changes on purpose, update its expected count in the same commit.
+
+    python -m benchmarks.query_counts -v
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from benchmarks.common import temp_sqlite_url, use_database
+
+use_database(temp_sqlite_url())
+# create_user hashes passwords, nothing here measures bcrypt
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+import httpx  # noqa: E402
+from sqlalchemy import event, insert, text  # noqa: E402
+
+from app.database import Base, SessionLocal, engine  # noqa: E402
+from app.hashing import password_hasher  # noqa: E402
+from app.main import app  # noqa: E402
+from app.models import PinModel  # noqa: E402
+from app.spatial import encode_geohash  # noqa: E402
+from app.user_search import user_search  # noqa: E402
+
+USER = {"first_name": "Ann", "last_name": "Smith", "password": "hunter22"}
+PIN = {"title": "coffee", "details": "", "latitude": 40.7, "longitude": -74.0}
+# around the seeded pins, small enough for the pin index's cells
+VIEWPORT = {"min_lat": 40, "min_lon": -74, "max_lat": 40.06, "max_lon": -73.94}
+
+# (name, method, path, request kwargs, expected status, expected statements), run in this order
+CHECKS = [
+    ("create_user", "POST", "/create_user", {"json": {**USER, "username": "ann", "email": "ann@luna"}}, 200, 1),
+    ("create_user (second)", "POST", "/create_user", {"json": {**USER, "username": "bob", "email": "bob@luna"}}, 200, 1),
+    ("create_user (third)", "POST", "/create_user", {"json": {**USER, "username": "cat", "email": "cat@luna"}}, 200, 1),
+    ("create_user (email taken)", "POST", "/create_user", {"json": {**USER, "username": "ann2", "email": "ann@luna"}}, 400, 1),
+    ("create_user (username taken)", "POST", "/create_user", {"json": {**USER, "username": "ann", "email": "ann2@luna"}}, 400, 1),
+    ("get_all_users", "GET", "/get_all_users", {}, 200, 1),
+    ("get_all_users (page)", "GET", "/get_all_users", {"params": {"limit": 2}}, 200, 1),
+    ("get_all_users (stream)", "GET", "/get_all_users", {"params": {"stream": True}}, 200, 1),
+    ("get_user", "GET", "/get_user/1", {}, 200, 1),
+    ("get_user (cached)", "GET", "/get_user/1", {}, 200, 0),
+    ("search_users (index loading)", "GET", "/search_users/1", {"params": {"q": "b"}}, 200, 1),
+    ("search_users", "GET", "/search_users/1", {"params": {"q": "c"}}, 200, 0),
+    ("update_user", "PUT", "/update_user/1", {"json": {"first_name": "Anne"}}, 200, 3),
+    ("create_partnership", "POST", "/create_partnership/1/2", {}, 200, 2),
+    ("create_partnership (unknown user)", "POST", "/create_partnership/1/99", {}, 400, 1),
+    ("delete_partnership", "DELETE", "/delete_partnership/1", {}, 200, 2),
+    ("delete_partnership (unknown)", "DELETE", "/delete_partnership/1", {}, 400, 2),
+
+    ("get_pin", "GET", "/get_pin/1/1", {}, 200, 1),
+    ("get_pin (cached)", "GET", "/get_pin/1/1", {}, 200, 0),
+    ("get_pin (not the owner)", "GET", "/get_pin/2/1", {}, 400, 0),
+    ("get_pin (missing)", "GET", "/get_pin/1/99", {}, 400, 1),
+    ("get_pin (missing again, not cached)", "GET", "/get_pin/1/99", {}, 400, 1),
+    ("get_all_pins", "GET", "/get_all_pins/1", {}, 200, 1),
+    ("get_all_pins (cached)", "GET", "/get_all_pins/1", {}, 200, 0),
+    ("get_all_pins (page)", "GET", "/get_all_pins/1", {"params": {"limit": 2}}, 200, 1),
+    ("get_all_pins (stream)", "GET", "/get_all_pins/1", {"params": {"stream": True}}, 200, 1),
+    ("sync_pins", "GET", "/sync_pins/1", {}, 200, 2),
+    ("get_pin_feed", "GET", "/get_pin_feed/1", {}, 200, 1),
+    ("get_pins_in_bbox (loads cells)", "GET", "/get_pins_in_bbox/1", {"params": VIEWPORT}, 200, 1),
+    ("get_pins_in_bbox", "GET", "/get_pins_in_bbox/1", {"params": VIEWPORT}, 200, 0),
+    ("get_pins_in_bbox (zoomed out)", "GET", "/get_pins_in_bbox/1",
+     {"params": {"min_lat": 30, "min_lon": -85, "max_lat": 50, "max_lon": -65}}, 200, 1),
+    ("get_pins_near", "GET", "/get_pins_near/1", {"params": {"latitude": 40.02, "longitude": -73.98, "radius": 500}}, 200, 0),
+    ("get_pin_clusters", "GET", "/get_pin_clusters/1", {"params": {"zoom": 3}}, 200, 1),
+    ("create_pin", "POST", "/create_pin/1", {"json": {**PIN, "user_id": 1, "latitude": 10.5}}, 200, 2),
+    ("create_pin (duplicate)", "POST", "/create_pin/1", {"json": {**PIN, "user_id": 1, "latitude": 10.5}}, 400, 1),
+    # a duplicate check, the pins, then user_pins (checked first, the trigger fills it on MySQL).
+    # sqlite gets the pins one INSERT per row to return their ids in order, MySQL in one
+    ("bulk_create_pins", "POST", "/bulk_create_pins/1",
+     {"json": [{**PIN, "user_id": 1, "latitude": 20 + index} for index in range(3)]}, 200, 6),
+    ("export_pins", "GET", "/export_pins/1", {}, 200, 1),
+    ("delete_pin", "DELETE", "/delete_pin/1/1", {}, 200, 3),
+    ("delete_pin (not the owner)", "DELETE", "/delete_pin/2/2", {}, 400, 1),
+
+    ("delete_user", "DELETE", "/delete_user/3", {}, 200, 4),
+    ("create_user (deleted user's email)", "POST", "/create_user", {"json": {**USER, "username": "cat", "email": "cat@luna"}}, 200, 1),
+]
+
+
+async def seed_pins():
+    async with engine.begin() as connection:
+        await connection.execute(insert(PinModel), [
+            {"pin_id": pin_id, "user_id": 1, "title": f"pin {pin_id}", "details": "",
+             "latitude": 40 + pin_id / 100, "longitude": -74 + pin_id / 100,
+             "geo_cell": encode_geohash(40 + pin_id / 100, -74 + pin_id / 100)} for pin_id in range(1, 6)])
+        # sqlite has no after_pin_create trigger
+        await connection.execute(text("INSERT INTO user_pins (user_id, pin_id, ownership_type) "
+                                      "SELECT user_id, pin_id, 'primary' FROM pins"))
+
+
+async def load_search_index():
+    async with SessionLocal() as db:
+        await user_search.refresh(db)
+
+
+# run before the check of the same name, outside of its count
+SETUP = {"search_users": load_search_index, "get_pin": seed_pins}
+
+
+async def run() -> list[dict]:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    statements = None
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statements is not None:
+            statements.append(" ".join(statement.split()))
+
+    results = []
+    # a route that raises is a 500 in the table, not a traceback
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://checks") as client:
+            for name, method, path, kwargs, expected_status, expected in CHECKS:
+                if name in SETUP:
+                    await SETUP[name]()
+                statements = []
+                response = await client.request(method, path, **kwargs)
+                # streamed bodies run their query while being read, httpx has read them by now
+                results.append({"name": name, "status": response.status_code, "expected_status": expected_status,
+                                "statements": statements, "expected": expected})
+                statements = None
+    finally:
+        password_hasher.shutdown()
+        await engine.dispose()
+    return results
+
+
+def main(args) -> int:
+    results = asyncio.run(run())
+    failures = 0
+    for result in results:
+        ok = len(result["statements"]) == result["expected"] and result["status"] == result["expected_status"]
+        failures += not ok
+        status = "" if result["status"] == result["expected_status"] else f"   status {result['status']}, expected {result['expected_status']}"
+        print(f"{'ok  ' if ok else 'FAIL'} {result['name']:<36} {len(result['statements']):>3} statements "
+              f"(expected {result['expected']}){status}")
+        if args.verbose or not ok:
+            for statement in result["statements"]:
+                print(f"       {statement[:200]}")
+    print(f"{len(results) - failures} of {len(results)} requests ran the expected statements")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every request's statements")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,162 @@
+"""
+How long does a worker take to come up?
+
+Two reports against a throwaway SQLite database:
+
+  imports  runs `python -X importtime -c "import app.main"` and breaks the import
+           time down by top-level package and by app module
+  startup  starts uvicorn --runs times and measures, from spawning the process,
+           the time to the first served request (GET /) and to the first request
+           that touches the database (GET /check-db), plus the per-phase
+           luna_startup_seconds the worker reports on /metrics
+
+    python -m benchmarks.startup --runs 5
+    git worktree add /tmp/luna-old HEAD~1 && python -m benchmarks.startup --repo /tmp/luna-old
+
+Results go to benchmarks/results/startup-<commit>.json.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.common import REPO_ROOT, git_commit, seed_database, temp_sqlite_url
+from benchmarks.loadtest import free_port
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_breakdown(repo: str, env: dict, top: int) -> dict:
+    """
+    Self time per top-level package and cumulative time per app module, in ms
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"],
+                            cwd=repo, env=env, capture_output=True, text=True, check=True)
+    packages: dict[str, float] = {}
+    app_modules: dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, module = int(match[1]), int(match[2]), match[4]
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_us / 1000
+        total += self_us / 1000
+        if package == "app":
+            app_modules[module] = cumulative_us / 1000
+    return {
+        "total_ms": round(total, 1),
+        "by_package_ms": {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        "app_modules_cumulative_ms": {name: round(ms, 1) for name, ms in sorted(app_modules.items(), key=lambda item: -item[1])},
+        "heavy_modules_loaded": sorted(name for name in ("boto3", "botocore.client", "PIL", "aiomysql", "aiosqlite")
+                                       if re.search(rf"\| *{re.escape(name)}$", result.stderr, re.MULTILINE)),
+    }
+
+
+def wait_for(client, path: str, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            if client.get(path).status_code == 200:
+                return time.perf_counter()
+        except Exception:
+            pass
+        time.sleep(0.005)
+    raise RuntimeError(f"{path} did not answer in time")
+
+
+def startup_run(repo: str, env: dict, timeout: float) -> dict:
+    import httpx
+
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=repo, env=env,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5.0) as client:
+            first_request = wait_for(client, "/", started + timeout)
+            first_db_request = wait_for(client, "/check-db", started + timeout)
+            phases = {}
+            for line in client.get("/metrics").text.splitlines():
+                match = re.match(r'luna_startup_seconds\{phase="([^"]+)"\} (\S+)', line)
+                if match:
+                    phases[match[1]] = float(match[2]) * 1000
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return {
+        "first_request_ms": (first_request - started) * 1000,
+        "first_db_request_ms": (first_db_request - started) * 1000,
+        "phases_ms": phases,
+    }
+
+
+def median_of(runs: list[dict], key: str) -> float:
+    return round(statistics.median(run[key] for run in runs), 1)
+
+
+async def create_schema(database_url: str):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    engine = create_async_engine(database_url)
+    await seed_database(engine, users=0, pins_per_user=0)
+    await engine.dispose()
+
+
+def main(args):
+    repo = os.path.abspath(args.repo)
+    database_url = args.database_url or temp_sqlite_url()
+    # an empty schema, so startup work that queries tables runs like it would in production
+    asyncio.run(create_schema(database_url))
+    env = {**os.environ, "DATABASE_URL": database_url, "PYTHONPATH": repo}
+
+    imports = import_breakdown(repo, env, args.top)
+    runs = [startup_run(repo, env, args.timeout) for _ in range(args.runs)]
+    phase_names = sorted({name for run in runs for name in run["phases_ms"]})
+    report = {
+        "commit": git_commit() if repo == REPO_ROOT else os.path.basename(repo),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "runs": args.runs,
+        "imports": imports,
+        "startup": {
+            "first_request_ms": median_of(runs, "first_request_ms"),
+            "first_db_request_ms": median_of(runs, "first_db_request_ms"),
+            "phases_ms": {name: round(statistics.median(run["phases_ms"].get(name, 0.0) for run in runs), 1)
+                          for name in phase_names},
+            "first_request_ms_all": [round(run["first_request_ms"], 1) for run in runs],
+        },
+    }
+
+    output = args.output or os.path.join(REPO_ROOT, "benchmarks", "results", f"startup-{report['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+        results_file.write("\n")
+
+    print(f"import app.main: {imports['total_ms']} ms (heavy modules loaded: {', '.join(imports['heavy_modules_loaded']) or 'none'})")
+    for name, ms in imports["by_package_ms"].items():
+        print(f"  {name:<24}{ms:>10} ms")
+    print(f"process start -> first request: {report['startup']['first_request_ms']} ms (median of {args.runs})")
+    print(f"process start -> first db request: {report['startup']['first_db_request_ms']} ms")
+    for name, ms in report["startup"]["phases_ms"].items():
+        print(f"  phase {name:<18}{ms:>10} ms")
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repo", default=REPO_ROOT, help="checkout to measure, default this one")
+    parser.add_argument("--database-url", help="database the workers point at, default: a temp SQLite file")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="packages to list in the import breakdown")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for a worker to answer")
+    parser.add_argument("--output", help="results file, default benchmarks/results/startup-<commit>.json")
+    main(parser.parse_args())
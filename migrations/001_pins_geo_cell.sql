@@ -0,0 +1,8 @@
+-- geohash cell for spatial lookups on pins (see app/spatial.py)
+ALTER TABLE pins ADD COLUMN geo_cell VARCHAR(12) NULL;
+CREATE INDEX ix_pins_geo_cell ON pins (geo_cell);
+
+-- backfill existing pins, precision 7 matches GEOHASH_PRECISION
+UPDATE pins
+SET geo_cell = ST_GeoHash(longitude, latitude, 7)
+WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND geo_cell IS NULL;
@@ -0,0 +1,3 @@
+-- composite index for the couple feed (see get_pin_feed in app/routes/pin_routes.py)
+CREATE INDEX ix_user_pins_user_ownership_removal_pin
+    ON user_pins (user_id, ownership_type, removal_date, pin_id);
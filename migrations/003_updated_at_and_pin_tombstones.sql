@@ -0,0 +1,15 @@
+-- change tracking for incremental sync (see app/sync.py)
+ALTER TABLE users
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+
+ALTER TABLE pins
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    ADD COLUMN removal_date TIMESTAMP NULL;
+CREATE INDEX ix_pins_updated_at ON pins (updated_at);
+
+ALTER TABLE user_pins
+    ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+CREATE INDEX ix_user_pins_user_updated ON user_pins (user_id, updated_at);
+
+-- delete_pin now leaves tombstones (removal_date on pins and user_pins) instead of deleting rows,
+-- so the pin delete trigger on user_pins no longer fires for it
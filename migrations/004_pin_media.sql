@@ -0,0 +1,19 @@
+-- photos attached to pins, the bytes are in S3 (see app/media.py)
+CREATE TABLE pin_media (
+    media_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    pin_id INT NOT NULL,
+    user_id INT NOT NULL,
+    object_key VARCHAR(255) NOT NULL,
+    thumbnail_key VARCHAR(255) NULL,
+    content_type VARCHAR(100) NOT NULL,
+    size_bytes INT NULL,
+    upload_id VARCHAR(255) NULL,
+    status ENUM('pending', 'uploaded', 'ready', 'failed') NOT NULL DEFAULT 'pending',
+    creation_date TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_pin_media_object_key (object_key),
+    KEY ix_pin_media_pin_id (pin_id),
+    KEY ix_pin_media_status (status),
+    CONSTRAINT fk_pin_media_pin FOREIGN KEY (pin_id) REFERENCES pins (pin_id) ON DELETE CASCADE,
+    CONSTRAINT fk_pin_media_user FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+);
@@ -0,0 +1,18 @@
+-- delete_user now tombstones the user and the purge worker removes the rows in batches (see app/purge.py)
+ALTER TABLE users
+    ADD COLUMN removal_date TIMESTAMP NULL;
+
+CREATE TABLE user_purges (
+    purge_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    phase VARCHAR(32) NOT NULL,
+    rows_purged INT NOT NULL DEFAULT 0,
+    creation_date TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    finished_date TIMESTAMP NULL,
+    KEY ix_user_purges_user_id (user_id),
+    KEY ix_user_purges_phase (phase)
+);
+
+-- tombstoned pins are purged once they are older than PURGE_RETENTION_SECONDS, this finds them
+CREATE INDEX ix_pins_removal_date ON pins (removal_date);
@@ -0,0 +1,11 @@
+-- logins, access tokens name their session so it can be revoked (see app/auth.py)
+CREATE TABLE user_sessions (
+    session_id VARCHAR(32) NOT NULL PRIMARY KEY,
+    user_id INT NOT NULL,
+    creation_date TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_date TIMESTAMP NOT NULL,
+    revoked_date TIMESTAMP NULL,
+    KEY ix_user_sessions_user_id (user_id),
+    KEY ix_user_sessions_expires_date (expires_date),
+    KEY ix_user_sessions_revoked_date (revoked_date)
+);